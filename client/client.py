@@ -9,6 +9,7 @@
 import getpass
 import logging
 import multiprocessing
+import os
 import Queue
 import sys
 import time
@@ -18,6 +19,12 @@ import cli
 import django_sendrcv
 import tornado_sendrcv
 
+# The event logging module is shared with the Tornado server, and lives with
+# it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "tornado_server"))
+import eventlog
+
 class Client(object):
     """PiConga Client."""
     
@@ -28,13 +35,25 @@ class Client(object):
     tornado_server_ip = "localhost"
     tornado_server_port = 8888
     
+    # What to ask the Tornado server for on HELLO.  Each is off unless
+    # turned on here, so that the client works with any server.
+    tornado_protocol = "text"
+    tornado_compression = None
+    tornado_delivery = None
+    tornado_broadcast = False
+    tornado_heartbeat = False
+    tornado_resume = False
+    
     def __init__(self, username, password):
         """Constructor.  Create the three subcomponents."""
         
         self._cli = cli.Cli()
         self._django_sr = django_sendrcv.DjangoSendRcv(self.base_url)
         self._tornado_sr = tornado_sendrcv.TornadoSendRcv(
-            self.tornado_server_ip, self.tornado_server_port)
+            self.tornado_server_ip, self.tornado_server_port,
+            self.tornado_protocol, self.tornado_compression,
+            self.tornado_delivery, self.tornado_heartbeat,
+            self.tornado_resume)
         
         # Store off the username and password.
         self._username = username
@@ -43,6 +62,11 @@ class Client(object):
         # Initialise other variables.
         self._userid = None
         
+        # The last conga we joined, and the newest message we saw in it, so
+        # that we can catch up on what we missed if we rejoin it.
+        self._last_conga = None
+        self._last_message_id = None
+        
         return
         
         
@@ -87,6 +111,14 @@ class Client(object):
                         conga_name, self._password)
                     tornado_sendrcv.start_connection(out_msgs)
                     tornado_sendrcv.send_hello(out_msgs, self._userid)
+                    if (conga_name == self._last_conga and
+                            self._last_message_id is not None):
+                        # We're back: catch up on what we missed.
+                        tornado_sendrcv.send_replay(out_msgs,
+                                                    self._last_message_id)
+                    else:
+                        self._last_conga = conga_name
+                        self._last_message_id = None
                     events.put(cli.Event(cli.Event.CONGA_JOINED,
                         "Conga name: %s" % conga_name, conga_name))
                 elif recvd_action.type == cli.Action.LEAVE_CONGA:
@@ -113,8 +145,11 @@ class Client(object):
                 elif recvd_action.type == cli.Action.SEND_MSG:
                     # Send a message along the Conga.
                     message = recvd_action.params["text"]
-                    tornado_sendrcv.send_msg(out_msgs, message,
-                                             {"From": self._username})
+                    headers = {"From": self._username}
+                    if self.tornado_broadcast:
+                        # Have the server send it to everyone at once.
+                        headers["Delivery"] = "broadcast"
+                    tornado_sendrcv.send_msg(out_msgs, message, headers)
                     events.put(cli.Event(cli.Event.TEXT,
                                          "%s: %s" %
                                          (self._username, message)))                         
@@ -138,10 +173,20 @@ class Client(object):
             # Check for any new messages.
             recvd_msg = tornado_sendrcv.get_message(in_msgs)
             if recvd_msg is not None:
-                logger.debug("@@@PAB: %s" % str(recvd_msg))
-                if recvd_msg[0] == "MSG":
+                logger.debug("@@@PAB: %s", recvd_msg)
+                if (recvd_msg[0] == "MSG" and
+                        "Delivered" in recvd_msg[1]):
+                    # The server has finished broadcasting something we
+                    # sent.
+                    events.put(cli.Event(cli.Event.TEXT,
+                        "Delivered to %s people." % recvd_msg[1]["Delivered"]))
+                elif recvd_msg[0] == "MSG":
                     # New message from the Tornado server.  Tell the CLI.
                     (verb, headers, body) = recvd_msg
+                    if "Message-ID" in headers:
+                        self._last_message_id = max(
+                            self._last_message_id,
+                            int(headers["Message-ID"]))
                     if "From" in headers:
                         msg_from = headers["From"]
                         msg_text = "%s: %s" % (msg_from, body)
@@ -151,13 +196,26 @@ class Client(object):
                     events.put(cli.Event(cli.Event.MSG_RECVD, msg_text))
                     
                     # Now forward it on through the Conga, as long as we
-                    # didn't send it in the first place!
-                    if msg_from != self._username:
-                        new_headers = {"From": msg_from,
-                                       "Message-ID": headers["Message-ID"]}
+                    # didn't send it in the first place, and the server
+                    # hasn't already done it for us or sent it to everyone.
+                    if (msg_from != self._username and
+                            headers.get("Delivery") not in ("express",
+                                                            "broadcast")):
+                        new_headers = {
+                            "From": msg_from,
+                            "Message-ID": headers["Message-ID"],
+                            "Origin-ID": headers.get("Origin-ID"),
+                            "Hops-Remaining": headers.get("Hops-Remaining")}
                         tornado_sendrcv.send_msg(out_msgs,
                                                  body,
                                                  new_headers)
+                elif recvd_msg[0] == "REPLAY":
+                    # The server has sent everything we missed.
+                    text = "Caught up on %s messages." % \
+                        recvd_msg[1]["Replayed"]
+                    if "Truncated" in recvd_msg[1]:
+                        text += " Some were too old to replay."
+                    events.put(cli.Event(cli.Event.TEXT, text))
                 elif recvd_msg[0] == "BYE":
                     # Lost connection to the Tornado server.
                     events.put(cli.Event(cli.Event.LOST_CONN))
@@ -183,6 +241,12 @@ if __name__ == "__main__":
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+    # Every message passes through the log several times over, so keep one
+    # in ten of the raw data. The client's processes exit without flushing
+    # the log, so write it as we go rather than from a background thread.
+    eventlog.install(logger, rates={'received': 10, 'sent': 10},
+                     background=False)
+
     # Redirect stderr - we want errors to appear in their own file.
     errorlog = open("errors.%s.log" % username, "w")
     sys.stderr = errorlog    
@@ -10,10 +10,73 @@ import logging
 import socket
 import multiprocessing
 import Queue
+import struct
+import time
+import zlib
 
 # Set up logging. Child of the core client logger.
 logger = logging.getLogger("piconga.tornado")
 
+# The binary frame format, which must match tornado_server/framing.py. Each
+# frame is this fixed header (verb code, flags, hops remaining, length of the
+# extra headers, length of the body, message ID and sender ID), then any
+# other headers as text lines, then the body.
+FRAME = struct.Struct("!BBHIIQQ")
+VERB_CODES = {"HELLO": 1, "MSG": 2, "BYE": 3, "PING": 4, "PONG": 5,
+              "REPLAY": 6}
+VERBS = dict((code, verb) for (verb, code) in VERB_CODES.items())
+NO_HOPS = 0xffff
+COMPRESSED = 0x01
+EXPRESS = 0x02
+BROADCAST = 0x04
+DELIVERY_FLAGS = {"express": EXPRESS, "broadcast": BROADCAST}
+
+# How long to wait for the server to agree to binary frames or compression
+# before giving up and carrying on without.
+PROTOCOL_TIMEOUT = 2.0
+
+# Compressed bodies are raw deflate streams that start from this dictionary,
+# which must match tornado_server/compression.py byte-for-byte.  zlib can't
+# be handed a dictionary in Python 2, so the compressor and decompressor are
+# primed by running it through them, and copied for each message.
+DICTIONARY = (
+    "the and you that was for are with his they this have from one had "
+    "word but not what all were when your can said there use each which "
+    "she how their will other about out many then them these some her "
+    "would make like him into time has look two more see way could people "
+    "than first been call who now find down day did get come made may part "
+    "thanks yes no okay please sorry great good morning afternoon evening "
+    "raspberry pi python code school class teacher conga message "
+    "Hello everyone! How are you? I'm fine. What's going on? "
+)
+
+def _primed():
+    """
+    Return a compressor and decompressor primed with the dictionary.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    prefix = compressor.compress(DICTIONARY)
+    prefix += compressor.flush(zlib.Z_SYNC_FLUSH)
+    decompressor = zlib.decompressobj(-15)
+    decompressor.decompress(prefix)
+    return compressor, decompressor
+
+_COMPRESSOR, _DECOMPRESSOR = _primed()
+
+def deflate(body):
+    """
+    Compress a message body.
+    """
+    compressor = _COMPRESSOR.copy()
+    return compressor.compress(body) + compressor.flush()
+
+def inflate(data):
+    """
+    Decompress a message body.
+    """
+    decompressor = _DECOMPRESSOR.copy()
+    return decompressor.decompress(data) + decompressor.flush()
+
 class SendError(socket.error):
     """
     Error when sending data.  Subclasses directly from socket.error - this
@@ -60,23 +123,47 @@ class TornadoSendRcv(object):
     Class to talk to the Tornado server.
     """
     
-    valid_verbs = ["HELLO", "MSG", "BYE"]
+    valid_verbs = ["HELLO", "MSG", "BYE", "PING", "PONG", "REPLAY"]
     
     # Private functions
     
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, protocol="text",
+                 compression=None, delivery=None, heartbeat=False,
+                 resume=False):
         """
-        Constructor.  Store off the server IP and port.
+        Constructor.  Store off the server IP and port, the message format
+        to ask the server for ("text" or "binary"), the compression to ask
+        for ("deflate" or None), whether to ask the server to pass
+        messages round the conga for us ("express" or None), whether
+        to tell the server we answer its PINGs, and whether to ask for a
+        token to pick up our place with if the connection drops.
         """
  
         # Store off the server IP and port.
         self._server_ip = server_ip
         self._server_port = server_port
+        self._wanted_protocol = protocol
+        self._wanted_compression = compression
+        self._wanted_delivery = delivery
+        self._wanted_heartbeat = heartbeat
+        self._wanted_resume = resume
 
         # Create initial versions of all other internal class variables.
         self._sock = None
         self._send_queue = None
         self._recv_queue = None
+        self._protocol = "text"
+        self._compression = None
+        self._recv_buffer = ""
+
+        # The token the server gave us to resume with, kept from one
+        # connection to the next.
+        self._resume_token = None
+
+        # While we wait for the server to agree to what we asked for on
+        # HELLO, messages to send are held here, until _held_until.
+        self._held = None
+        self._held_until = None
         
         return
         
@@ -92,14 +179,21 @@ class TornadoSendRcv(object):
                 try:
                     data = self._sock.recv(4096)
                     if data:
-                        logger.debug("Received message: %s", data)
-                    
-                        # Parse the message as a Conga protocol message.
-                        conga_msg = self._parse_conga_msg(data)
+                        logger.debug("Received data: %r", data,
+                                     extra={'event': 'received'})
+                        self._recv_buffer += data
 
-                        # Put this data onto the receive queue.
-                        if conga_msg is not None:
-                            self._recv_queue.put(conga_msg)
+                        # Parse each whole message as a Conga protocol
+                        # message, and put it onto the receive queue.
+                        while True:
+                            conga_msg = self._next_conga_msg()
+                            if conga_msg is None:
+                                break
+                            if conga_msg[0] == "PING":
+                                # The server is checking we're still here.
+                                self._send_conga_message(("PONG", {}, ""))
+                            elif conga_msg[0] != "PONG":
+                                self._recv_queue.put(conga_msg)
                 except socket.timeout:
                     # It's fine for the socket to timeout, we just don't 
                     # want it sitting there forever.
@@ -121,7 +215,7 @@ class TornadoSendRcv(object):
                     # branch.
                     msg = self._send_queue.get(block=False)
                     
-                    logger.debug("Process message of type %d" % msg.type)
+                    logger.debug("Process message of type %d", msg.type)
                     if msg.type == QueueMsg.SERVER_MSG:
                         # Message to send to the server.
                         self._send_conga_message(msg.data)
@@ -138,9 +232,101 @@ class TornadoSendRcv(object):
                         
             except Queue.Empty:
                 pass
+
+            # If the server never answered our HELLO, it doesn't know about
+            # what we asked for: carry on without.
+            if self._held is not None and time.time() > self._held_until:
+                logger.debug("No reply to HELLO, carrying on without.")
+                self._release_held()
         return
 
 
+    def _next_conga_msg(self):
+        """
+        Take the next whole message off the receive buffer, and parse it.
+        Returns None if there isn't a whole message yet.
+        """
+        
+        if self._protocol == "binary":
+            if len(self._recv_buffer) < FRAME.size:
+                return None
+            fields = FRAME.unpack(self._recv_buffer[:FRAME.size])
+            length = FRAME.size + fields[3] + fields[4]
+            if len(self._recv_buffer) < length:
+                return None
+            frame = self._recv_buffer[:length]
+            self._recv_buffer = self._recv_buffer[length:]
+            return self._parse_binary_msg(frame)
+
+        end = self._recv_buffer.find("\r\n\r\n")
+        if end == -1:
+            return None
+        length = 0
+        for line in self._recv_buffer[:end].split("\r\n")[1:]:
+            name, sep, value = line.partition(":")
+            if name == "Content-Length":
+                length = int(value)
+        if len(self._recv_buffer) < end + 4 + length:
+            return None
+        raw = self._recv_buffer[:end + 4 + length]
+        self._recv_buffer = self._recv_buffer[end + 4 + length:]
+        conga_msg = self._parse_conga_msg(raw)
+
+        if conga_msg[0] == "HELLO" and self._held is not None:
+            # The server has answered our HELLO.  If it agreed to binary
+            # frames, everything from here on, both ways, is binary.
+            logger.debug("Server agreed to %s", conga_msg[1])
+            if conga_msg[1].get("Protocol") == "binary":
+                self._protocol = "binary"
+            if conga_msg[1].get("Compression") == "deflate":
+                self._compression = "deflate"
+            if "Resume-Token" in conga_msg[1]:
+                self._resume_token = conga_msg[1]["Resume-Token"]
+            if conga_msg[1].get("Resumed") == "yes":
+                # Our place was kept, along with everything sent to us
+                # meanwhile, so there's nothing to catch up on.
+                self._held = [msg for msg in self._held
+                              if msg[0] != "REPLAY"]
+            self._release_held()
+            return self._next_conga_msg()
+
+        return conga_msg
+
+
+    def _parse_binary_msg(self, frame):
+        """
+        Parse a binary frame.  Returns the same tuple as _parse_conga_msg:
+        the message's verb, a dictionary of its headers, and its body.
+        """
+        
+        (code, flags, hops, extra_length, body_length, message_id,
+         sender_id) = FRAME.unpack(frame[:FRAME.size])
+        verb = VERBS[code]
+        
+        headers = {}
+        if message_id:
+            headers["Message-ID"] = str(message_id)
+        if sender_id:
+            headers["Origin-ID"] = str(sender_id)
+        if hops != NO_HOPS:
+            headers["Hops-Remaining"] = str(hops)
+        for delivery, flag in DELIVERY_FLAGS.items():
+            if flags & flag:
+                headers["Delivery"] = delivery
+        
+        extra = frame[FRAME.size:FRAME.size + extra_length].decode("utf_8")
+        for line in extra.split("\r\n"):
+            if line:
+                name, sep, value = line.partition(":")
+                headers[name] = value.lstrip()
+        
+        body = frame[FRAME.size + extra_length:]
+        if flags & COMPRESSED:
+            body = inflate(body)
+        
+        return (verb, headers, body.decode("utf_8"))
+
+
     def _parse_conga_msg(self, msg):
         """
         Parse a message as a Conga protocol message.  Returns a tuple 
@@ -152,47 +338,84 @@ class TornadoSendRcv(object):
         if len(msg) == 0:
             return None
         
-        message = msg.decode("utf_8")
-        lines = message.split("\r\n")
+        # The blank line separates the headers from the body.  Split them
+        # before decoding anything, as the body may be compressed.
+        head, sep, body = msg.partition("\r\n\r\n")
+        lines = head.decode("utf_8").split("\r\n")
         
         # The verb must always be in the first line of the message.
         verb = lines[0]
         assert verb in self.valid_verbs
         
-        # Every line onwards that is not blank is a header.
+        # Every line onwards is a header.
         headers = {}
-        for line_no in range(1, len(lines)):
-            line = lines[line_no]
-            if len(line) == 0:
-                # Blank line - this is the separator between the headers and
-                # the body.  Store off the body and break out.
-                if line_no == len(lines) - 1:
-                    body = ""
-                else:
-                    body = "".join(lines[line_no+1:])
-                break
+        for line in lines[1:]:
             name, sep, value = line.partition(":")
             assert sep == ":", "No colon found in header"
             assert name not in headers.keys(), "Duplicate headers found"
             headers[name] = value.lstrip()
         
-        # We must have made it out of the loop by setting the body variable,
-        # so it's safe to return it here.        
-        return (verb, headers, body)
+        if headers.get("Content-Encoding") == "deflate":
+            del headers["Content-Encoding"]
+            body = inflate(body)
+        
+        return (verb, headers, body.decode("utf_8"))
         
         
     def _send_conga_message(self, msg):
         """
-        Send a message to the Tornado server.  This function assumes that
-        you have already created the message, ready to send.
+        Send a message to the Tornado server.  The message is a tuple of
+        (verb, headers, body), as made by create_conga_msg, and is encoded
+        in whichever format the server has agreed to.
         """
 
         if self._sock is None:
             # Connection to the server is not active.  Drop this message.
             return
         
+        verb, headers, body = msg
+        
+        if self._held is not None:
+            # Don't know which format to use yet.
+            self._held.append(msg)
+            return
+        
+        if verb == "BYE":
+            # We're leaving for good, so there's nothing to resume.
+            self._resume_token = None
+        
+        if verb == "HELLO":
+            # HELLO is always text.  Ask for binary frames, compression,
+            # express delivery, heartbeats or a resume token if we want
+            # them, and hold everything else back until we know whether
+            # we've got them.  If we have a token, pick up where we left
+            # off.
+            headers = dict(headers)
+            if self._wanted_protocol == "binary":
+                headers["Protocol"] = "binary"
+            if self._wanted_compression == "deflate":
+                headers["Compression"] = "deflate"
+            if self._wanted_delivery == "express":
+                headers["Delivery"] = "express"
+            if self._wanted_heartbeat:
+                headers["Heartbeat"] = "ping"
+            if self._wanted_resume:
+                headers["Resume"] = "yes"
+            if self._resume_token is not None:
+                headers["Resume-Token"] = self._resume_token
+            if len(headers) > 1:
+                self._held = []
+                self._held_until = time.time() + PROTOCOL_TIMEOUT
+        
+        compress = self._compression == "deflate"
+        if self._protocol == "binary":
+            msg = encode_binary_msg(verb, headers, body, compress)
+        else:
+            msg = encode_text_msg(verb, headers, body, compress)
+        
         try:
-            logger.debug("Sending message: %s", msg)
+            logger.debug("Sending message: %s", msg,
+                         extra={'event': 'sent'})
             bytes_sent = self._sock.send(msg)
         except socket.error as e:
             send_error = SendError()
@@ -246,8 +469,26 @@ class TornadoSendRcv(object):
         self._sock.shutdown(socket.SHUT_RDWR)
         self._sock.close()
         self._sock = None
+        self._protocol = "text"
+        self._compression = None
+        self._recv_buffer = ""
+        self._held = None
         
         return  
+
+
+    def _release_held(self):
+        """
+        Send the messages held back while we waited to hear which format
+        the server would use.
+        """
+        
+        held = self._held
+        self._held = None
+        for msg in held:
+            self._send_conga_message(msg)
+        
+        return
         
         
     # Public functions
@@ -300,24 +541,82 @@ def get_message(recv_q):
     
 def create_conga_msg(verb, headers, body=""):
     """
-    Create a Conga-protocol message, ready to send over the wire.
-    Parameters are as follows:
-    verb    - HELLO, MSG or BYE
+    Create a Conga-protocol message, ready to hand to the SendRcv object,
+    which encodes it for the wire.  Parameters are as follows:
+    verb    - HELLO, MSG, BYE, PING or PONG
     headers - Dictionary of headers to send.  Keys are the names of the 
               headers to send, values are the values of those headers.
               The Content-Length header should not be included.
     body    - Body of the message to send (optional).
     """
     
+    return QueueMsg(QueueMsg.SERVER_MSG, (verb, headers, body))
+
+
+def _encode_body(body, compress):
+    """
+    Encode a message body for the wire, compressing it if asked to and if
+    that makes it any smaller.  Returns the body, and whether it was
+    compressed.
+    """
+    
+    body = body.encode("utf_8")
+    if compress and body:
+        deflated = deflate(body)
+        if len(deflated) < len(body):
+            return deflated, True
+    
+    return body, False
+
+
+def encode_text_msg(verb, headers, body="", compress=False):
+    """
+    Encode a Conga-protocol message in the text format.  Parameters are as
+    for create_conga_msg, plus whether to compress the body.
+    """
+    
+    body, compressed = _encode_body(body, compress)
+    
     message = "%s\r\n" % verb
     for name in headers.keys():
         if headers[name] is not None:
             message += "%s: %s\r\n" % (name, headers[name])
+    if compressed:
+        message += "Content-Encoding: deflate\r\n"
     message += "Content-Length: %d\r\n" % len(body)
     message += "\r\n"
-    message += body
     
-    return QueueMsg(QueueMsg.SERVER_MSG, message.encode("utf_8"))
+    return message.encode("utf_8") + body
+
+
+def encode_binary_msg(verb, headers, body="", compress=False):
+    """
+    Encode a Conga-protocol message as a binary frame.  Parameters are as
+    for create_conga_msg, plus whether to compress the body.
+    """
+    
+    fields = {"Message-ID": 0, "Origin-ID": 0, "Hops-Remaining": NO_HOPS}
+    flags = 0
+    extra = ""
+    for name in headers.keys():
+        if headers[name] is None:
+            continue
+        if name == "Delivery":
+            flags |= DELIVERY_FLAGS.get(headers[name], 0)
+        elif name in fields:
+            fields[name] = int(headers[name])
+        else:
+            extra += "%s: %s\r\n" % (name, headers[name])
+    
+    extra = extra.encode("utf_8")
+    body, compressed = _encode_body(body, compress)
+    if compressed:
+        flags |= COMPRESSED
+    header = FRAME.pack(VERB_CODES[verb], flags, fields["Hops-Remaining"],
+                        len(extra), len(body), fields["Message-ID"],
+                        fields["Origin-ID"])
+    
+    return header + extra + body
 
         
 def send_hello(send_q, userid):
@@ -346,6 +645,20 @@ def send_msg(send_q, data, headers={}):
     return
     
     
+def send_replay(send_q, message_id):
+    """
+    Ask the Tornado server for the messages sent in our conga since the one
+    with the given ID.  They arrive as usual, followed by a REPLAY saying
+    how many there were.
+    """
+    
+    msg = create_conga_msg("REPLAY", {"Message-ID": message_id})
+    
+    send_q.put(msg)
+    
+    return
+    
+    
 def send_bye(send_q):
     """
     Send a BYE message to the Tornado server, then disconnect.
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.compression
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Clients that say so with a Compression header on HELLO may send and receive
+compressed message bodies. The server never compresses anything itself: a
+compressed body is passed on untouched to a participant who can read it, and
+only inflated for one who can't.
+
+Bodies are raw deflate streams that start from a shared dictionary of text
+common in conga messages, which is what makes compressing short messages
+worthwhile. Python 2's zlib can't be given a dictionary, so instead each end
+primes a compressor or decompressor by running the dictionary through it,
+then works on a copy of the primed object for every message.
+"""
+import zlib
+
+#: The only compression there is.
+DEFLATE = 'deflate'
+
+#: The text every compressed body starts from. The clients have a copy, which
+#: must stay byte-for-byte the same.
+DICTIONARY = (
+    b"the and you that was for are with his they this have from one had "
+    b"word but not what all were when your can said there use each which "
+    b"she how their will other about out many then them these some her "
+    b"would make like him into time has look two more see way could people "
+    b"than first been call who now find down day did get come made may part "
+    b"thanks yes no okay please sorry great good morning afternoon evening "
+    b"raspberry pi python code school class teacher conga message "
+    b"Hello everyone! How are you? I'm fine. What's going on? "
+)
+
+#: The most bytes a compressed body may inflate to.
+MAX_INFLATED = 16 * 1024 * 1024
+
+
+def _primed_inflater():
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    prefix = compressor.compress(DICTIONARY) + \
+        compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    inflater = zlib.decompressobj(-15)
+    inflater.decompress(prefix)
+    return inflater
+
+
+_INFLATER = _primed_inflater()
+
+
+def inflate(data, limit=MAX_INFLATED):
+    """
+    Inflate a compressed body. Raises ValueError if it would inflate to more
+    than limit bytes, and zlib.error if it isn't a compressed body at all.
+    """
+    inflater = _INFLATER.copy()
+    body = inflater.decompress(data, limit)
+
+    if inflater.unconsumed_tail:
+        raise ValueError(
+            "Compressed body inflates to more than %d bytes." % limit
+        )
+
+    return body
@@ -8,12 +8,20 @@ object provides detailed knowledge of how Congas are constructed from
 Participants.
 """
 import logging
-import random
+from collections import OrderedDict
+from histogram import Histogram
+from replay import ReplayBuffer
+from ring import Ring
+from timers import TimingWheel, monotonic
 from tornado_exceptions import JoinError, LeaveError
 
 
 __congas = {}
 
+#: The bits of each message ID below the ID of the server that gave it out.
+#: A server on its own has ID 0, so its message IDs are plain counts.
+MESSAGE_ID_BITS = 48
+
 
 def conga_from_id(conga_id):
     """
@@ -28,6 +36,20 @@ def conga_from_id(conga_id):
     return conga
 
 
+def congas():
+    """
+    Returns every Conga object there is.
+    """
+    return __congas.values()
+
+
+def message_node(msg_id):
+    """
+    Returns the ID of the server that gave out a message ID.
+    """
+    return int(msg_id) >> MESSAGE_ID_BITS
+
+
 class Conga(object):
     """
     An object representing a single Conga. A Conga is made up of multiple
@@ -36,87 +58,120 @@ class Conga(object):
     and is placed into the correct position in the conga based on its
     user-ID.
     """
+    #: Whether loop termination should be decided from the Origin-ID and
+    #: Hops-Remaining headers the server stamps on each message, rather than
+    #: from the table of outstanding messages.
+    stateless_loops = False
+
+    #: How long, in seconds, to remember a message that hasn't yet made it
+    #: back round to its sender.
+    message_ttl = 60.0
+
+    #: The most outstanding messages to remember at once. Beyond this the
+    #: oldest messages are forgotten, and so stop looping.
+    max_outstanding = 10000
+
+    #: Whether to time messages on their way round the conga. Only messages
+    #: in the outstanding message table are timed, so there is nothing to
+    #: time in stateless mode.
+    trace_latency = True
+
+    #: The most messages, and the most bytes of them, to keep for
+    #: participants catching up after rejoining. 0 messages keeps none.
+    replay_messages = 100
+    replay_bytes = 64 * 1024
+
+    #: This server's ID among its peers, which goes in the top bits of every
+    #: message ID it gives out, so that IDs from different servers never
+    #: collide.
+    node_id = 0
+
+    #: The Peering that links congas to other servers, if there is one. It
+    #: is told whenever a participant joins or leaves.
+    peering = None
+
     def __init__(self, conga_id):
         #: The ID of this conga in the DB.
         self.conga_id = conga_id
 
-        #: A list of the participants in the conga, in their conga order. Each
-        #: element of this list is a tuple of
-        #: (Participant id, Participant object). This allows for linear-time
-        #: insertion of and removal of conga participants.
-        self.participants = []
+        #: The participants in the conga, in their conga order. This is a Ring
+        #: keyed by participant ID, which allows for logarithmic-time
+        #: insertion and removal of conga participants, and constant-time
+        #: lookup of a participant and their neighbours.
+        self.participants = Ring()
 
         # A dict of the outstanding messages being sent around the conga, and
-        # the participant ID that sent them. Used to prevent a message looping
-        # forever.
-        self.outstanding_messages = {}
+        # the participant ID that sent them, oldest first. Used to prevent a
+        # message looping forever.
+        self.outstanding_messages = OrderedDict()
+
+        # Expires outstanding messages that never make it back round.
+        self._expiry = TimingWheel()
+
+        # The ID to give the next new message. IDs are never reused within a
+        # conga, so they can't collide.
+        self._next_message_id = 1
+
+        #: The number of outstanding messages forgotten because they were
+        #: older than message_ttl.
+        self.expired_messages = 0
+
+        #: The number of outstanding messages forgotten to keep the table
+        #: within max_outstanding.
+        self.evicted_messages = 0
+
+        # The times at which each outstanding message was first received,
+        # and last received from a participant on its way round, or None if
+        # it hasn't been passed round yet.
+        self._traces = {}
+
+        #: The microseconds taken by messages to get all the way round the
+        #: conga, from the server first receiving them to the server
+        #: stopping them in front of their sender.
+        self.loop_latency = Histogram()
+
+        #: The microseconds between the server sending a message to a
+        #: participant and receiving it back from them.
+        self.hop_latency = Histogram()
+
+        #: The newest messages sent in the conga, for anyone catching up.
+        self.replay = ReplayBuffer(self.replay_messages, self.replay_bytes)
 
     def join(self, participant, participant_id):
         """
         Have a participant join this Conga. Their position in the Conga is
         defined by their participant_id.
 
-        Functions by finding the correct place for the participant in the
-        conga. Finds the participants who will logically come before and after
-        the new participant. Changes people's destinations.
+        Functions by inserting the participant into the ordered ring, which
+        finds the participants who will logically come before and after the
+        new participant. Changes people's destinations.
         """
-        logging.info("Participant id %d joining." % participant_id)
+        logging.info("Participant id %d joining.", participant_id,
+                     extra={'event': 'join', 'conga': self.conga_id})
 
-        # Special case: the first person joining a conga. Just add them to the
-        # list and move on.
-        if not self.participants:
-            logging.info("No participants.")
-            self.participants.append((participant_id, participant))
+        try:
+            node = self.participants.insert(participant_id, participant)
+        except KeyError:
+            logging.error(
+                "Attempted to add duplicate participant %s in %s.",
+                participant_id, self.conga_id
+            )
+            raise JoinError(
+                "Identical participant IDs: %s" % participant_id
+            )
 
-            # Point the participant at self initially.
+        # Special case: the first person joining a conga. Point the
+        # participant at self initially.
+        if node.next is node:
+            logging.info("No participants.", extra={'event': 'join'})
             participant.add_destination(participant)
-            return
-
-        # Special case: usually participants will join in ascending participant
-        # ID order. Check for that possibility first. Then, check whether we're
-        # at the start of the list as well.
-        tail_id = self.participants[-1][0]
-
-        if tail_id < participant_id:
-            logging.info("At start.")
-            prev = self.participants[-1][1]
-            next = self.participants[0][1]
-
-            self.participants.append((participant_id, participant))
         else:
-            # Walk the list until we find someone whose participant ID is
-            # larger than the joining person's.
-            for index, person in enumerate(self.participants):
-                if person[0] > participant_id:
-                    logging.info("Found insert index: %d" % index)
-                    break
-
-            # Get the previous and next participants.
-            if index == 0:
-                prev_id, prev = self.participants[-1]
-            else:
-                prev_id, prev = self.participants[index - 1]
-
-            next_id, next = self.participants[index]
-
-            # Confirm that neither ID is the same as ours. That would be bad.
-            if participant_id in (prev_id, next_id):
-                logging.error(
-                    "Attempted to add duplicate participant %s in %s." %
-                    (participant_id, self.conga_id)
-                )
-                raise JoinError(
-                    "Identical participant IDs: %s" % participant_id
-                )
-
-            # Insert ourselves into the participant list.
-            self.participants.insert(index, (participant_id, participant))
+            # Line the participants up.
+            node.prev.participant.add_destination(participant)
+            participant.add_destination(node.next.participant)
 
-        # Line the participants up.
-        prev.add_destination(participant)
-        participant.add_destination(next)
-
-        return
+        if self.peering is not None:
+            self.peering.changed(self, participant_id)
 
     def leave(self, participant, participant_id):
         """
@@ -126,74 +181,82 @@ class Conga(object):
         Finds the participant in the current conga. Takes the person before
         them and sets their new target to the person after them.
         """
-        logging.info("Participant id %d leaving." % participant_id)
-
-        # Find the participant.
-        match = False
-
-        # There's a special case here: if the conga has only one participant.
-        # Handle that case.
-        if len(self.participants) == 1:
-            logging.info("One participant.")
-            self.participants.pop()
-            return
+        logging.info("Participant id %d leaving.", participant_id,
+                     extra={'event': 'leave', 'conga': self.conga_id})
 
-        for index, person in enumerate(self.participants):
-            if person[0] == participant_id:
-                logging.info("Match at index %d, id %d" % (index, person[0]))
-                match = True
-                break
+        node = self.participants.get(participant_id)
 
-        if not match:
-            # Called on an incorrect conga. Log and bail early.
+        if node is None or node.participant is not participant:
+            # Called on an incorrect conga, or by someone who never got the
+            # place, which is someone else's. Log and bail early.
             logging.error(
-                "Attempted to remove participant %s from incorrect conga %s." %
-                (participant_id, self.conga_id)
+                "Attempted to remove participant %s from incorrect conga %s.",
+                participant_id, self.conga_id
             )
             raise LeaveError("Not in conga.")
 
-        if person == self.participants[0]:
-            # Special case: participant at 'start' of Conga.
-            logging.info("Start of conga.")
-            prev = self.participants[-1][1]
-            next = self.participants[1][1]
-        elif person == self.participants[-1]:
-            # Special case: person at 'end' of Conga.
-            logging.info("End of conga.")
-            prev = self.participants[-2][1]
-            next = self.participants[0][1]
-        else:
-            # Standard case.
-            logging.info("Normal.")
-            prev = self.participants[index - 1][1]
-            next = self.participants[index + 1][1]
-
-        # Remove from message path.
-        prev.add_destination(next)
+        node = self.participants.remove(participant_id)
 
-        # Remove from the participant list.
-        self.participants.pop(index)
+        # If the participant was alone in the conga there's nobody to relink,
+        # nor anyone left to remember its messages for.
+        if node.next is node:
+            logging.info("One participant.", extra={'event': 'leave'})
+            self.replay.clear()
+        else:
+            # Remove from message path.
+            node.prev.participant.add_destination(node.next.participant)
 
-        return
+        if self.peering is not None:
+            self.peering.changed(self, participant_id)
 
-    def new_message(self, participant_id):
+    def new_message(self, participant_id, broadcast=False):
         """
         Notify the conga about a new message.  Should be called whenever a
         message is received without a Message-ID header. Returns the ID to give
         that message.
+
+        In stateless mode the message is not recorded: the participant
+        stamps the origin and hop count onto the message itself. Nor is a
+        broadcast message, which the server sends to everyone at once: any
+        copy that comes back round is then stopped as unknown.
         """
-        msg_id = '%10d' % (random.randint(1, 4294967296)) # From 1 to 2^32.
-        msg_id = msg_id.strip()
-        self.outstanding_messages[msg_id] = participant_id
+        msg_id = str(self.node_id << MESSAGE_ID_BITS | self._next_message_id)
+        self._next_message_id += 1
+
+        if not self.stateless_loops and not broadcast:
+            self.track_message(msg_id, participant_id, self.trace_latency)
+
         logging.info(
-            "Added new message: ID %s, Participant %s." % (
-                msg_id,
-                participant_id
-            )
+            "Added new message: ID %s, Participant %s.", msg_id,
+            participant_id, extra={'event': 'new_message',
+                                   'conga': self.conga_id}
         )
         return msg_id
 
-    def stop_loop(self, msg_id, participant_id):
+    def track_message(self, msg_id, participant_id, trace=False):
+        """
+        Add a message to the outstanding message table, as sent by the given
+        participant, and time it on its way round if trace is set. Called
+        for new messages, and for messages from other servers as they
+        arrive.
+        """
+        now = monotonic()
+        self._expire(now)
+
+        while len(self.outstanding_messages) >= self.max_outstanding:
+            old_id, _ = self.outstanding_messages.popitem(last=False)
+            self._expiry.cancel(old_id)
+            self._traces.pop(old_id, None)
+            self.evicted_messages += 1
+
+        self.outstanding_messages[msg_id] = participant_id
+        self._expiry.schedule(msg_id, self.message_ttl, now)
+
+        if trace:
+            self._traces[msg_id] = [now, None]
+
+    def stop_loop(self, msg_id, participant_id, origin_id=None,
+                  hops_remaining=None):
         """
         Check with the conga whether the message currently looping around the
         conga has reached the participant who originally sent it. Returns
@@ -203,31 +266,173 @@ class Conga(object):
         This will also confirm that the participant who originally sent
         the message is still in the conga. If they aren't, the message will
         be stopped immediately.
+
+        In stateless mode, the origin_id and hops_remaining stamped on the
+        message are used instead of the outstanding message table.
         """
+        if self.stateless_loops and origin_id is not None:
+            return self._stop_stateless(participant_id, origin_id,
+                                        hops_remaining)
+
         # First, check whether the participant who sent the message is the
         # one we're about to send to.
         msg_id = msg_id.strip()
-        print self.outstanding_messages
+        now = monotonic()
+        self._expire(now)
 
         try:
             original_sender_id = self.outstanding_messages[msg_id]
         except KeyError:
             # Unknown message ID. Kill it with fire.
-            logging.info("Unknown message ID %s" % msg_id)
+            logging.info("Unknown message ID %s", msg_id,
+                         extra={'event': 'stop_loop'})
             return True
 
+        if msg_id in self._traces:
+            self._trace(msg_id, now, original_sender_id == participant_id)
+
         if original_sender_id == participant_id:
-            logging.info("Message returning to original sender.")
-            del self.outstanding_messages[msg_id]
+            logging.info("Message returning to original sender.",
+                         extra={'event': 'stop_loop'})
+            self._forget(msg_id)
             return True
 
         # Next, confirm the original sender is still in the conga.
-        for pid in (participant[0] for participant in self.participants):
-            if pid == original_sender_id:
-                logging.info("Original sender still in Conga")
-                return False
+        if original_sender_id in self.participants:
+            logging.info("Original sender still in Conga",
+                         extra={'event': 'stop_loop'})
+            return False
 
         # If we got here the original sender has gone: terminate the message.
-        logging.info("Original sender no longer in conga.")
-        del self.outstanding_messages[msg_id]
+        logging.info("Original sender no longer in conga.",
+                     extra={'event': 'stop_loop'})
+        self._forget(msg_id)
         return True
+
+    def _forget(self, msg_id):
+        """
+        Stop tracking an outstanding message.
+        """
+        del self.outstanding_messages[msg_id]
+        self._expiry.cancel(msg_id)
+        self._traces.pop(msg_id, None)
+
+    def snapshot(self):
+        """
+        Returns the state of this conga as plain data, for a new server
+        process to pick up with restore: the counters, the outstanding
+        messages with the seconds each has left to live, and the state of
+        each participant in ring order. Latency traces and the replay buffer
+        aren't kept.
+        """
+        now = monotonic()
+        self._expire(now)
+
+        return {
+            'conga_id': self.conga_id,
+            'next_message_id': self._next_message_id,
+            'expired_messages': self.expired_messages,
+            'evicted_messages': self.evicted_messages,
+            'outstanding_messages': [
+                (msg_id, sender_id, self._expiry.remaining(msg_id, now))
+                for (msg_id, sender_id) in self.outstanding_messages.items()
+            ],
+            'participants': [
+                node.participant.snapshot() for node in self.participants
+            ],
+        }
+
+    def restore(self, state):
+        """
+        Pick up the counters and outstanding messages from a snapshot. The
+        participants rejoin by themselves.
+        """
+        now = monotonic()
+
+        self._next_message_id = max(self._next_message_id,
+                                    state['next_message_id'])
+        self.expired_messages += state['expired_messages']
+        self.evicted_messages += state['evicted_messages']
+
+        # Whatever the old process kept for catching up is gone.
+        self.replay.lost(
+            self.node_id << MESSAGE_ID_BITS | self._next_message_id - 1
+        )
+
+        for msg_id, sender_id, ttl in state['outstanding_messages']:
+            msg_id = str(msg_id)
+            self.outstanding_messages[msg_id] = sender_id
+            self._expiry.schedule(msg_id, ttl, now)
+
+    def _trace(self, msg_id, now, returned):
+        """
+        Time a message that has just come back to the server on its way
+        round, and has either returned to its sender or is about to be sent
+        on.
+        """
+        trace = self._traces[msg_id]
+        received, sent = trace
+
+        if sent is not None:
+            self.hop_latency.record((now - sent) * 1e6)
+
+        if returned:
+            self.loop_latency.record((now - received) * 1e6)
+
+        trace[1] = now
+
+    def latency(self):
+        """
+        Returns summaries of the loop and hop latency histograms, in
+        microseconds.
+        """
+        return {
+            'loop': self.loop_latency.summary(),
+            'hop': self.hop_latency.summary(),
+        }
+
+    def log_latency(self):
+        """
+        Log how long messages have taken to go round this conga.
+        """
+        for name, summary in sorted(self.latency().items()):
+            if summary['count']:
+                logging.info(
+                    "Conga %s %s latency: %d messages, p50 %dus, p90 %dus, "
+                    "p99 %dus, max %dus", self.conga_id, name,
+                    summary['count'], summary['p50'], summary['p90'],
+                    summary['p99'], summary['max']
+                )
+
+    def _expire(self, now):
+        """
+        Forget any outstanding messages that have been around for longer
+        than message_ttl.
+        """
+        for msg_id in self._expiry.advance(now):
+            del self.outstanding_messages[msg_id]
+            self._traces.pop(msg_id, None)
+            self.expired_messages += 1
+
+    def _stop_stateless(self, participant_id, origin_id, hops_remaining):
+        """
+        Decide whether to stop a message using only the Origin-ID and
+        Hops-Remaining headers stamped on it. This costs the same no matter
+        how large the conga is or how many messages are in flight.
+        """
+        if origin_id == participant_id:
+            logging.info("Message returning to original sender.",
+                         extra={'event': 'stop_loop'})
+            return True
+
+        if hops_remaining is None or hops_remaining <= 0:
+            logging.info("Message has no hops remaining.",
+                         extra={'event': 'stop_loop'})
+            return True
+
+        if origin_id not in self.participants:
+            logging.info("Original sender no longer in conga.",
+                         extra={'event': 'stop_loop'})
+            return True
+
+        return False
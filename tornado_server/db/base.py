@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.db.base
+~~~~~~~~~~~~~~~~~~~~~~
+
+This file implements the parts of the database abstraction shared by every
+database: a connection per thread, and an asynchronous API that runs queries
+on a bounded pool of threads so that the IOLoop never waits on the database.
+Writes that nobody needs to wait for can be held back and committed together.
+"""
+import functools
+import logging
+import sys
+import threading
+import Queue
+
+from tornado.concurrent import TracebackFuture as Future
+from tornado.ioloop import IOLoop
+
+
+class ThreadPool(object):
+    """
+    A fixed number of threads that run functions handed to them, resolving a
+    Future on the submitting IOLoop with the result of each.
+    """
+    def __init__(self, size):
+        #: The number of threads in the pool.
+        self.size = size
+
+        #: The work waiting for a thread. Each item is a tuple of
+        #: (future, io_loop, function, args), or None to stop a thread.
+        self._queue = Queue.Queue()
+
+        self._threads = []
+
+    def submit(self, fn, *args):
+        """
+        Run fn(*args) on one of the pool's threads. Returns a Future that
+        resolves on the current IOLoop. Must be called from the IOLoop's
+        thread.
+        """
+        if not self._threads:
+            self._start()
+
+        future = Future()
+        self._queue.put((future, IOLoop.current(), fn, args))
+        return future
+
+    def shutdown(self):
+        """
+        Stop the pool's threads once they've finished the work already
+        queued, and wait for them.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def _start(self):
+        for _ in range(self.size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, io_loop, fn, args = item
+
+            try:
+                result = fn(*args)
+            except Exception:
+                io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                io_loop.add_callback(future.set_result, result)
+
+
+class WriteBehind(object):
+    """
+    Holds writes back and commits them in batches, a single transaction per
+    batch, so that tearing down a conga costs one commit rather than one per
+    member. A batch is committed at the end of the IOLoop iteration it was
+    started in or after a fixed delay, or as soon as it is full.
+    """
+    def __init__(self, db, delay=0, limit=100):
+        #: The database to write to.
+        self.db = db
+
+        #: Milliseconds to hold a batch open, or 0 to commit it at the end of
+        #: the current IOLoop iteration.
+        self.delay = delay
+
+        #: The most writes to hold back at once. This is the most that can be
+        #: lost if the server dies.
+        self.limit = limit
+
+        # The writes waiting to be committed. Each item is a tuple of
+        # (query, parameters, future).
+        self._pending = []
+
+        # The timeout or callback that will commit the current batch.
+        self._scheduled = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def queue(self, query, parameters):
+        """
+        Add a write to the current batch. Returns a Future that resolves
+        once the write has been committed.
+        """
+        future = Future()
+        self._pending.append((query, parameters, future))
+
+        if len(self._pending) >= self.limit:
+            self.flush()
+        elif self._scheduled is None:
+            io_loop = IOLoop.current()
+
+            if self.delay:
+                self._scheduled = io_loop.add_timeout(
+                    io_loop.time() + self.delay / 1000.0, self.flush
+                )
+            else:
+                self._scheduled = True
+                io_loop.add_callback(self.flush)
+
+        return future
+
+    def flush(self):
+        """
+        Commit the current batch on the database's thread pool.
+        """
+        batch = self._take()
+        if not batch:
+            return
+
+        done = self.db._thread_pool().submit(self._commit, batch)
+        IOLoop.current().add_future(
+            done, functools.partial(self._committed, batch)
+        )
+
+    def close(self):
+        """
+        Commit the current batch on this thread, and wait for it. Used at
+        shutdown, once the IOLoop has stopped.
+        """
+        batch = self._take()
+        if not batch:
+            return
+
+        for (query, parameters, _), error in zip(batch, self._commit(batch)):
+            if error is not None:
+                logging.error("%s with %s failed because of %s",
+                              query, parameters, error)
+
+    def _take(self):
+        """
+        Returns the current batch, and starts a new one.
+        """
+        if self._scheduled not in (None, True):
+            IOLoop.current().remove_timeout(self._scheduled)
+
+        self._scheduled = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _commit(self, batch):
+        """
+        Commit a batch of writes. Runs on a database thread. Returns a list
+        holding the exception raised by each write, or None where it
+        succeeded.
+        """
+        statements = [(query, parameters) for query, parameters, _ in batch]
+
+        try:
+            self.db.execute_batch(statements)
+            return [None] * len(batch)
+        except Exception:
+            pass
+
+        # One bad write shouldn't cost us the rest of the batch, so fall back
+        # to a transaction each.
+        errors = []
+
+        for query, parameters in statements:
+            try:
+                self.db.execute(query, parameters)
+                errors.append(None)
+            except Exception, e:
+                errors.append(e)
+
+        return errors
+
+    def _committed(self, batch, done):
+        """
+        Called on the IOLoop once a batch has been committed, to resolve the
+        Future for each write.
+        """
+        try:
+            errors = done.result()
+        except Exception, e:
+            errors = [e] * len(batch)
+
+        for (_, _, future), error in zip(batch, errors):
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+
+class BaseDatabase(object):
+    """
+    The common parts of every database. Subclasses provide _open, which
+    returns a new DB-API connection, along with get, execute and
+    execute_batch. A write that fails must leave no transaction open.
+
+    Every thread gets its own connection, opened the first time that thread
+    uses the database.
+    """
+    #: The number of threads used to run queries asynchronously.
+    pool_size = 4
+
+    #: Milliseconds to hold back writes made with execute_later, or 0 to
+    #: commit them at the end of the IOLoop iteration.
+    write_behind_ms = 0
+
+    #: The most writes made with execute_later to hold back at once.
+    write_behind_limit = 100
+
+    def __init__(self):
+        self._local = threading.local()
+        self._connect_args = None
+        self._pool = None
+        self._writes = WriteBehind(self, self.write_behind_ms,
+                                   self.write_behind_limit)
+
+    @property
+    def conn(self):
+        """
+        The database connection for the current thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None and self._connect_args is not None:
+            args, kwargs = self._connect_args
+            conn = self._local.conn = self._open(*args, **kwargs)
+
+        return conn
+
+    def connect(self, *args, **kwargs):
+        """
+        Remember how to connect to the database, and connect the current
+        thread. The arguments are those taken by _open.
+        """
+        self._connect_args = (args, kwargs)
+        self._local.conn = self._open(*args, **kwargs)
+
+    def get_async(self, query, parameters=()):
+        """
+        Like get, but runs the query on the thread pool. Returns a Future
+        that resolves to the operation result.
+        """
+        return self._thread_pool().submit(self.get, query, parameters)
+
+    def execute_async(self, query, parameters):
+        """
+        Like execute, but runs the query on the thread pool. Returns a Future
+        that resolves once the query has been committed.
+        """
+        return self._thread_pool().submit(self.execute, query, parameters)
+
+    def execute_later(self, query, parameters):
+        """
+        Like execute_async, but the query is held back to be committed in
+        the same transaction as other writes. Returns a Future that resolves
+        once the query has been committed.
+        """
+        return self._writes.queue(query, parameters)
+
+    def close(self):
+        """
+        Stop the thread pool, once any queries already queued have run, then
+        commit any writes still held back.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        self._writes.close()
+
+    def _thread_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.pool_size)
+        return self._pool
+
+    def _open(self, *args, **kwargs):
+        raise NotImplementedError()
+
+
+def log_failure(description):
+    """
+    Builds a callback for a Future returned by the asynchronous API, which
+    logs the query's exception if it failed.
+    """
+    def callback(future):
+        exc = future.exception()
+        if exc is not None:
+            logging.error("%s failed because of %s", description, exc)
+
+    return callback
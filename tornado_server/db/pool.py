@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.db.pool
+~~~~~~~~~~~~~~~~~~~~~~
+
+A pool of DB-API connections shared between the database threads. Keeps a
+minimum number open, never opens more than a maximum, and checks that a
+connection is still alive before handing it out if it has been idle a while.
+"""
+import logging
+import threading
+
+from timers import monotonic
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of connections. connect is called with no arguments
+    to open a new connection. errors is the tuple of exceptions that mean a
+    connection is dead.
+    """
+    def __init__(self, connect, min_size=1, max_size=4, check_interval=30.0,
+                 idle_timeout=300.0, errors=(Exception,)):
+        #: Opens a new connection.
+        self.connect = connect
+
+        #: The fewest connections to keep open.
+        self.min_size = min_size
+
+        #: The most connections to have open at once. Threads wanting a
+        #: connection wait for one to be released once this many are open.
+        self.max_size = max(min_size, max_size)
+
+        #: Seconds a connection can be idle before it's checked on its way
+        #: out of the pool.
+        self.check_interval = check_interval
+
+        #: Seconds a connection above the minimum can be idle before it's
+        #: closed.
+        self.idle_timeout = idle_timeout
+
+        #: The exceptions that mean a connection is dead.
+        self.errors = errors
+
+        #: Connections replaced because they had died.
+        self.reconnects = 0
+
+        # The idle connections, as (connection, time last used) pairs, least
+        # recently used first.
+        self._idle = []
+
+        # The number of connections open, whether idle or in use.
+        self._size = 0
+
+        self._cond = threading.Condition()
+
+        for _ in range(min_size):
+            self._idle.append((self._open(), monotonic()))
+
+    def __len__(self):
+        return self._size
+
+    def acquire(self):
+        """
+        Take a connection from the pool, opening one if none are idle and
+        there's room. Blocks if the pool is exhausted.
+        """
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                self._cond.wait()
+
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, None
+                self._size += 1
+
+        if conn is None:
+            return self._open_reserved()
+
+        if monotonic() - last_used > self.check_interval and \
+                not self._healthy(conn):
+            logging.warning("Replacing a dead database connection.")
+            self._close(conn)
+            self.reconnects += 1
+            return self._open_reserved()
+
+        return conn
+
+    def release(self, conn, broken=False):
+        """
+        Return a connection to the pool. A broken connection is closed
+        instead, and will be replaced when next needed.
+        """
+        if broken:
+            self._close(conn)
+
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+            return
+
+        now = monotonic()
+        stale = []
+
+        with self._cond:
+            self._idle.append((conn, now))
+
+            # Close connections above the minimum that nobody has wanted for
+            # a while.
+            while self._size > self.min_size and \
+                    now - self._idle[0][1] > self.idle_timeout:
+                stale.append(self._idle.pop(0)[0])
+                self._size -= 1
+
+            self._cond.notify()
+
+        for conn in stale:
+            self._close(conn)
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _open(self):
+        conn = self.connect()
+        self._size += 1
+        return conn
+
+    def _open_reserved(self):
+        """
+        Open a connection for a slot already counted in the pool's size,
+        giving the slot back if that fails.
+        """
+        try:
+            return self.connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _healthy(self, conn):
+        """
+        Whether a connection still works.
+        """
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            conn.rollback()
+        except self.errors:
+            return False
+
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except self.errors:
+            pass
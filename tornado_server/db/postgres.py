@@ -4,30 +4,78 @@ tornado_server.db.postgres
 ~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 This file implements the PostgreSQL portion of the database abstraction.
+Connections come from a pool shared by the database threads, and the queries
+run on every HELLO and BYE are prepared on the server when each connection
+is opened.
 """
+import sys
+
 try:
     import psycopg2
 except ImportError:
     # Probably on Windows, which is a pain. Give up.
     psycopg2 = object
 
+from .base import BaseDatabase
+from .pool import ConnectionPool
+from .queries import MEMBER_ROSTER, REMOVE_MEMBER
+
 
-class Database(object):
+class Database(BaseDatabase):
     """
     Defines an abstraction around a PostgreSQL database.
     """
+    #: The DB-API module used to connect. Tests can replace this with a fake.
+    driver = psycopg2
+
+    #: The fewest connections to keep open.
+    min_connections = 1
+
+    #: The most connections to have open at once.
+    max_connections = 4
+
+    #: Seconds a connection can be idle before it's checked before use.
+    check_interval = 30.0
+
+    #: The queries to prepare on every connection, and the name of the
+    #: prepared statement for each.
+    prepared_statements = {
+        MEMBER_ROSTER: 'member_roster',
+        REMOVE_MEMBER: 'remove_member',
+    }
+
     def __init__(self):
-        self.conn = None
+        super(Database, self).__init__()
+
+        #: The ConnectionPool, once connected.
+        self.connections = None
 
     def connect(self, db_name, **kwargs):
         """
-        Connect to the PostgreSQL database. Requires the database name.
-        Optionally takes any/all of the following keyword arguments: user,
-        password, host, port.
+        Open the connection pool. Takes the same arguments as _open.
+        """
+        self.connections = ConnectionPool(
+            lambda: self._open(db_name, **kwargs),
+            self.min_connections, self.max_connections, self.check_interval,
+            errors=(self.driver.OperationalError, self.driver.InterfaceError)
+        )
+
+    def _open(self, db_name, **kwargs):
+        """
+        Connect to the PostgreSQL database, and prepare our statements on the
+        new connection. Requires the database name. Optionally takes any/all
+        of the following keyword arguments: user, password, host, port.
 
         :param db_name: The name of the PostgreSQL database.
         """
-        self.conn = psycopg2.connect(database=db_name, **kwargs)
+        conn = self.driver.connect(database=db_name, **kwargs)
+        cursor = conn.cursor()
+
+        for query, name in self.prepared_statements.items():
+            cursor.execute("PREPARE %s AS %s" % (name, _number_params(query)))
+
+        conn.commit()
+        return conn
 
     def get(self, query, parameters=()):
         """
@@ -38,10 +86,12 @@ class Database(object):
         :param parameters: The parameters to add to the query. DO NOT ADD THEM
                            YOURSELF YOU WILL GET IT WRONG.
         """
-        cursor = self.conn.cursor()
-        cursor.execute(query, parameters)
-
-        return cursor.fetchall()
+        try:
+            return self._run([(query, parameters)], fetch=True)
+        except self.connections.errors:
+            # The connection died under us. Reads are safe to repeat, so try
+            # again on a fresh one.
+            return self._run([(query, parameters)], fetch=True)
 
     def execute(self, query, parameters):
         """
@@ -52,9 +102,80 @@ class Database(object):
         :param parameters: The parameters to add to the query. DO NOT ADD THEM
                            YOURSELF YOU WILL GET IT WRONG.
         """
-        cursor = self.conn.cursor()
-        cursor.execute(query, parameters)
+        self._run([(query, parameters)])
+
+    def execute_batch(self, statements):
+        """
+        Executes several queries that will not return data against the
+        PostgreSQL database, in a single transaction. Returns nothing.
+
+        :param statements: A list of (query, parameters) pairs, each as
+                           taken by execute.
+        """
+        self._run(statements)
+
+    def close(self):
+        """
+        Finish any outstanding queries, then close every connection.
+        """
+        super(Database, self).close()
+
+        if self.connections is not None:
+            self.connections.close()
+
+    def _run(self, statements, fetch=False):
+        """
+        Run statements in a single transaction on a pooled connection.
+        Returns the rows from the last one if fetch is set.
+        """
+        conn = self.connections.acquire()
+        result = None
+
+        try:
+            cursor = conn.cursor()
+
+            for query, parameters in statements:
+                name = self.prepared_statements.get(query)
+
+                if name is None:
+                    cursor.execute(query, parameters)
+                else:
+                    cursor.execute(
+                        "EXECUTE %s (%s)" %
+                        (name, ", ".join(["%s"] * len(parameters))),
+                        parameters
+                    )
+
+            if fetch:
+                result = cursor.fetchall()
+
+            conn.commit()
+        except Exception:
+            exc_info = sys.exc_info()
+            broken = isinstance(exc_info[1], self.connections.errors)
+
+            if not broken:
+                try:
+                    conn.rollback()
+                except self.connections.errors:
+                    broken = True
+
+            self.connections.release(conn, broken)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.connections.release(conn)
+        return result
+
+
+def _number_params(query):
+    """
+    Turns the %s placeholders in a query into the $1, $2, ... placeholders
+    used by PREPARE.
+    """
+    parts = query.split("%s")
+    numbered = [parts[0]]
 
-        self.conn.commit()
+    for index, part in enumerate(parts[1:]):
+        numbered.append("$%d%s" % (index + 1, part))
 
-        return
+    return "".join(numbered)
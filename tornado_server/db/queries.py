@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.db.queries
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The queries the Tornado server runs on every HELLO and BYE. They live here
+so that databases can recognise them, for instance to prepare them ahead of
+time.
+"""
+
+#: Finds every member of every conga the given member belongs to. Run when a
+#: member says HELLO and isn't already cached.
+MEMBER_ROSTER = (
+    "SELECT member_id, conga_id FROM conga_congamember WHERE conga_id IN "
+    "(SELECT conga_id FROM conga_congamember WHERE member_id=%s)"
+)
+
+#: Removes a member from their conga. Run when a member says BYE.
+REMOVE_MEMBER = "DELETE FROM conga_congamember WHERE id=%s"
@@ -6,22 +6,20 @@ tornado_server.db.sqlite
 This file implements the Sqlite portion of the database abstraction.
 """
 import sqlite3
+from .base import BaseDatabase
 
 
-class Database(object):
+class Database(BaseDatabase):
     """
     Defines an abstraction around the Sqlite3 database.
     """
-    def __init__(self):
-        self.conn = None
-
-    def connect(self, db_path, **kwargs):
+    def _open(self, db_path, **kwargs):
         """
         Connect to the Sqlite3 database. Returns a database connection object.
 
         :param db_path: The path to the database.
         """
-        self.conn = sqlite3.connect(db_path)
+        return sqlite3.connect(db_path)
 
     def get(self, query, parameters=()):
         """
@@ -56,9 +54,32 @@ class Database(object):
         # just never need them, eh?
         query = query.replace("%s", "?")
 
-        cursor = self.conn.cursor()
-        cursor.execute(query, parameters)
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(query, parameters)
+        except Exception:
+            self.conn.rollback()
+            raise
 
         self.conn.commit()
 
         return
+
+    def execute_batch(self, statements):
+        """
+        Executes several queries that will not return data against the
+        Sqlite3 database, in a single transaction. Returns nothing.
+
+        :param statements: A list of (query, parameters) pairs, each as
+                           taken by execute.
+        """
+        try:
+            cursor = self.conn.cursor()
+
+            for query, parameters in statements:
+                cursor.execute(query.replace("%s", "?"), parameters)
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.conn.commit()
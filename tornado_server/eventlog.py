@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.eventlog
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Logging cheap enough to leave on in the hot paths, built on the standard
+logging module:
+
+- Call sites pass their arguments to logging rather than formatting them
+  with %, so nothing is formatted unless a record is actually written.
+- Sampler is a filter that keeps one in every so many records of each event
+  type, and no more than a cap of them a second, counting what it drops.
+- AsyncHandler hands records to a background thread, which formats and
+  writes them, so the caller never waits on a disk.
+- JSONFormatter writes each record as one line of JSON, with any extra
+  fields the call site gave.
+
+A record's event type is the event field it was logged with, as in
+extra={'event': 'hop'}, or otherwise its unformatted message, so every
+call site is sampled separately.
+
+The client imports this module from here too, so it must not depend on
+anything else in the server.
+"""
+import json
+import logging
+import os
+import Queue
+import threading
+
+#: The attributes every LogRecord has. Anything else on a record was passed
+#: in extra, and is written out as a field by JSONFormatter.
+_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord('', 0, '', 0, '', (), None).__dict__
+) | frozenset(['message', 'asctime', 'event', 'dropped'])
+
+
+def event_type(record):
+    """
+    Returns the type of event a record is for.
+    """
+    return getattr(record, 'event', None) or record.msg
+
+
+class Sampler(logging.Filter):
+    """
+    Keeps one in every rates[event] records of each event type, or one in
+    every default records of types not given, and then at most cap records
+    of each type a second. Warnings and worse are never sampled, only
+    capped. The first record kept after some have been dropped says how
+    many, in its dropped attribute.
+    """
+    def __init__(self, rates=None, default=1, cap=None):
+        logging.Filter.__init__(self)
+
+        #: Keep one in this many records of each event type.
+        self.rates = dict(rates or {})
+        self.default = default
+
+        #: The most records of each event type to keep a second, or None.
+        self.cap = cap
+
+        #: The records seen, and the records dropped, of each event type.
+        self.seen = {}
+        self.dropped = {}
+
+        # The second each event type's cap was last counted in, and the
+        # records kept in it.
+        self._windows = {}
+
+    def filter(self, record):
+        event = event_type(record)
+        seen = self.seen[event] = self.seen.get(event, 0) + 1
+
+        if record.levelno < logging.WARNING:
+            every = self.rates.get(event, self.default)
+            if every > 1 and seen % every:
+                return self._drop(event)
+
+        if self.cap is not None:
+            second = int(record.created)
+            window, kept = self._windows.get(event, (second, 0))
+            if window != second:
+                kept = 0
+            if kept >= self.cap:
+                return self._drop(event)
+            self._windows[event] = (second, kept + 1)
+
+        dropped = self.dropped.pop(event, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+    def _drop(self, event):
+        self.dropped[event] = self.dropped.get(event, 0) + 1
+        return False
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Passes records to other handlers on a background thread. The queue
+    between them holds at most capacity records: past that, records are
+    dropped and counted rather than making the caller wait.
+
+    Records should only carry arguments that won't change after they are
+    logged, as they are formatted later. Exceptions are formatted straight
+    away, while the traceback still exists.
+    """
+    def __init__(self, handlers, capacity=10000):
+        logging.Handler.__init__(self)
+
+        #: The handlers that write the records.
+        self.handlers = list(handlers)
+
+        #: The most records to hold at once.
+        self.capacity = capacity
+
+        #: The records dropped because the queue was full.
+        self.overflowed = 0
+
+        self._pid = None
+        self._start()
+
+    def _start(self):
+        self._queue = Queue.Queue(self.capacity)
+        self._thread = threading.Thread(target=self._write,
+                                        name='eventlog')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # We've been forked, leaving our thread behind.
+            self._start()
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.overflowed += 1
+
+    def _write(self):
+        queue = self._queue
+
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def flush(self):
+        """
+        Wait for every record so far to be written.
+        """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        for handler in self.handlers:
+            handler.flush()
+        self._start()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as a single line of JSON.
+    """
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+
+        for name, value in record.__dict__.iteritems():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+
+        if getattr(record, 'dropped', None):
+            entry['dropped'] = record.dropped
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, separators=(',', ':'), sort_keys=True,
+                          default=repr)
+
+
+def parse_rates(spec):
+    """
+    Parses sampling rates given like "hop=100,join=10" into a dictionary.
+    """
+    rates = {}
+
+    for item in spec.split(','):
+        if item.strip():
+            event, _, every = item.partition('=')
+            rates[event.strip()] = int(every)
+
+    return rates
+
+
+def install(logger=None, json_lines=False, rates=None, default=1, cap=None,
+            background=False, capacity=10000):
+    """
+    Route a logger's records through a Sampler, and then a background
+    thread if background is set, to the handlers it already has, formatting
+    them as JSON lines if json_lines is set. Returns the handlers now on the
+    logger.
+
+    With json_lines, records no longer note their thread or process, for
+    any logger in the process.
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    handlers = list(logger.handlers)
+
+    if json_lines:
+        # JSON lines don't give the thread or process a record came from, so
+        # don't look them up for every record. These are the logging
+        # module's own switches, and apply to the whole process.
+        logging.logThreads = 0
+        logging.logProcesses = 0
+
+        for handler in handlers:
+            handler.setFormatter(JSONFormatter())
+
+    if background:
+        for handler in handlers:
+            logger.removeHandler(handler)
+        handler = AsyncHandler(handlers, capacity)
+        logger.addHandler(handler)
+        handlers = [handler]
+
+    # Sampling happens before anything is queued. Each handler left on the
+    # logger samples separately.
+    for handler in handlers:
+        handler.addFilter(Sampler(rates, default, cap))
+
+    return handlers
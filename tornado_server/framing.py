@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.framing
+~~~~~~~~~~~~~~~~~~~~~~
+
+Defines the binary message format, which a client can ask for in place of
+the text format by sending a Protocol header on HELLO. The server answers a
+client that asks with a HELLO of its own carrying the same header, and every
+message after that goes both ways as a binary frame.
+
+A binary frame is a fixed header, followed by any headers that don't have a
+field of their own as text lines, followed by the body. Participants using
+either format can share a conga: the server only translates a message when
+it passes from one to the other.
+
+A client can also ask on HELLO, with a Delivery header, for express
+delivery. The server then passes each message it delivers to that client on
+round the conga itself, rather than waiting for the client to send it back.
+Messages delivered this way are marked, so the client knows not to.
+
+A new message marked for broadcast delivery isn't passed round the ring at
+all: the server sends it to everyone in the conga at once, marked so that
+nobody passes it on, then tells the sender how many people it reached.
+
+Either side can send a PING, which has no headers or body, and the other
+answers with a PONG. A client that sends "Heartbeat: ping" on HELLO is sent a
+PING whenever it goes quiet, and is taken out of its conga if it doesn't
+answer.
+
+A client that has rejoined its conga can send a REPLAY to catch up on the
+messages it missed, as described in replay.py. In a binary frame, the
+Message-ID header of a REPLAY is the message ID field, as for a MSG. A client
+that asks for a resume token on HELLO can pick up its place in the conga on
+a new connection if its old one drops, as described in resume.py.
+
+Servers linked to one another send each other binary frames too, as
+described in peering.py. The JOIN and LEAVE verbs only pass between them.
+"""
+import struct
+
+# Define the formats a participant can speak.
+TEXT = 'text'
+BINARY = 'binary'
+
+# Define how a message gets round a conga: each client sends it back to the
+# server to go on to the next, the server passes it on by itself, or the
+# server sends it to everyone at once.
+RING = 'ring'
+EXPRESS = 'express'
+BROADCAST = 'broadcast'
+
+#: The fixed header: verb code, flags, hops remaining, length of the extra
+#: headers, length of the body, message ID and the ID of the participant who
+#: first sent the message.
+FRAME = struct.Struct('!BBHIIQQ')
+
+#: The code for each verb.
+VERB_CODES = {'HELLO': 1, 'MSG': 2, 'BYE': 3, 'PING': 4, 'PONG': 5,
+              'REPLAY': 6, 'JOIN': 7, 'LEAVE': 8}
+
+#: The verb for each code.
+VERBS = dict((code, verb) for (verb, code) in VERB_CODES.items())
+
+#: Marks the hop count as missing.
+NO_HOPS = 0xffff
+
+#: The flag marking a compressed body, the binary form of a
+#: Content-Encoding header.
+COMPRESSED = 0x01
+
+#: The flags marking how a message is delivered, the binary form of a
+#: Delivery header.
+DELIVERY_FLAGS = {EXPRESS: 0x02, BROADCAST: 0x04}
+
+#: The headers that have fields of their own in the fixed header.
+FIXED_HEADERS = frozenset([
+    'Content-Length', 'Content-Encoding', 'Delivery', 'Message-ID',
+    'Origin-ID', 'Hops-Remaining'
+])
+
+
+def pack_frame(verb, extra_length, body_length, message_id=None,
+               sender_id=None, hops=None, compressed=False, delivery=RING):
+    """
+    Builds the fixed header of a binary frame. Message and sender IDs are
+    numbers, with None for missing.
+    """
+    flags = DELIVERY_FLAGS.get(delivery, 0)
+    if compressed:
+        flags |= COMPRESSED
+
+    return FRAME.pack(
+        VERB_CODES[verb], flags,
+        NO_HOPS if hops is None else max(hops, 0),
+        extra_length, body_length, int(message_id or 0), sender_id or 0
+    )
+
+
+def unpack_frame(data):
+    """
+    Reads the fixed header of a binary frame. Returns a tuple of (verb,
+    extra length, body length, message ID, sender ID, hops, compressed,
+    delivery), where the message ID is a string like the text format's and
+    anything missing is None. An unknown verb code comes back as None.
+    """
+    code, flags, hops, extra_length, body_length, message_id, sender_id = \
+        FRAME.unpack(data)
+
+    delivery = RING
+    for mode, flag in DELIVERY_FLAGS.items():
+        if flags & flag:
+            delivery = mode
+
+    return (
+        VERBS.get(code), extra_length, body_length,
+        str(message_id) if message_id else None,
+        sender_id or None,
+        None if hops == NO_HOPS else hops,
+        bool(flags & COMPRESSED),
+        delivery,
+    )
+
+
+def text_header(verb, extra, body_length, message_id=None, sender_id=None,
+                hops=None, compressed=False, delivery=RING):
+    """
+    Builds the header block of a text message with the same contents as a
+    binary frame. extra is the frame's extra headers, which are already text.
+    """
+    lines = [verb, b'\r\n', extra]
+
+    if message_id is not None:
+        lines.append(b'Message-ID: %s\r\n' % message_id)
+    if sender_id is not None:
+        lines.append(b'Origin-ID: %d\r\n' % sender_id)
+    if hops is not None:
+        lines.append(b'Hops-Remaining: %d\r\n' % hops)
+    if compressed:
+        lines.append(b'Content-Encoding: deflate\r\n')
+    if delivery != RING:
+        lines.append(b'Delivery: %s\r\n' % delivery)
+
+    lines.append(b'Content-Length: %d\r\n\r\n' % body_length)
+    return b''.join(lines)
+
+
+def extra_headers(headers):
+    """
+    Given the headers of a text message, returns the text lines for those
+    that a binary frame has no field for.
+    """
+    return b''.join(
+        b'%s:%s\r\n' % (name, value) for (name, value) in headers.items()
+        if name not in FIXED_HEADERS
+    )
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.histogram
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+An HDR-style histogram for recording latencies. Values are counted in a
+flat array of buckets whose width grows with the value: every power of two
+is split into the same number of sub-buckets, so every value is recorded to
+within the same relative precision, and recording costs the same however
+many values have been seen.
+"""
+from array import array
+
+
+class Histogram(object):
+    """
+    Counts values in the range [0, highest], to within one part in
+    2 ** (precision_bits - 1). Values above highest are counted as highest.
+    """
+    def __init__(self, highest=2 ** 32, precision_bits=5):
+        #: The number of sub-buckets in each power of two, and below it the
+        #: number of values counted exactly.
+        self._sub_buckets = 1 << precision_bits
+        self._half = self._sub_buckets >> 1
+        self._precision_bits = precision_bits
+
+        #: The largest value that can be recorded.
+        self.highest = highest
+
+        #: The count in each bucket.
+        self.counts = array('L', [0]) * (self._index(highest) + 1)
+
+        #: The number of values recorded.
+        self.count = 0
+
+        #: The sum of the values recorded.
+        self.total = 0
+
+        #: The smallest and largest values recorded, or None.
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        """
+        Returns the index of the bucket a value belongs in.
+        """
+        if value < self._sub_buckets:
+            return value
+
+        shift = value.bit_length() - self._precision_bits
+        return (self._sub_buckets + (shift - 1) * self._half +
+                (value >> shift) - self._half)
+
+    def _value(self, index):
+        """
+        Returns the largest value that belongs in a bucket.
+        """
+        if index < self._sub_buckets:
+            return index
+
+        shift, sub_bucket = divmod(index - self._sub_buckets, self._half)
+        shift += 1
+        return ((sub_bucket + self._half + 1) << shift) - 1
+
+    def record(self, value):
+        """
+        Count a value, which is rounded down to an integer.
+        """
+        value = int(value)
+        if value > self.highest:
+            value = self.highest
+        elif value < 0:
+            value = 0
+
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the counts from another histogram with the same shape.
+        """
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """
+        Returns the value that percent percent of the recorded values are at
+        or below, or None if nothing has been recorded.
+        """
+        if not self.count:
+            return None
+
+        wanted = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._value(index), self.max)
+
+        return self.max
+
+    def summary(self, percents=(50, 90, 99, 99.9)):
+        """
+        Returns a dictionary of the count, min, mean, max and the given
+        percentiles, keyed like 'p99' and 'p99.9'.
+        """
+        summary = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': float(self.total) / self.count if self.count else None,
+        }
+
+        for percent in percents:
+            summary['p%s' % percent] = self.percentile(percent)
+
+        return summary
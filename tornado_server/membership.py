@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.membership
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Provides a cache of which conga each member belongs to, so that a class full
+of Pis reconnecting at once doesn't turn into hundreds of identical trips to
+the database. The first time any member of a conga is looked up, the whole
+conga's roster is fetched and cached.
+"""
+import functools
+import logging
+import sys
+from collections import OrderedDict
+
+from tornado.concurrent import TracebackFuture as Future
+from tornado.ioloop import IOLoop
+
+from db.queries import MEMBER_ROSTER
+from timers import monotonic
+
+
+class MembershipCache(object):
+    """
+    A size-bounded, least-recently-used cache mapping member IDs to conga
+    IDs. Entries expire after a fixed time, so that changes made through the
+    web app are picked up eventually even if nobody tells us about them.
+    """
+    def __init__(self, db, ttl=30.0, max_size=100000):
+        #: The database to fall back to.
+        self.db = db
+
+        #: How long, in seconds, to trust a cached entry.
+        self.ttl = ttl
+
+        #: The most entries to hold at once.
+        self.max_size = max_size
+
+        #: Lookups answered from the cache.
+        self.hits = 0
+
+        #: Lookups that had to go to the database.
+        self.misses = 0
+
+        #: Entries dropped to keep the cache within max_size.
+        self.evictions = 0
+
+        # Maps member ID to (conga ID, expiry time), least recently used
+        # first.
+        self._entries = OrderedDict()
+
+        # Lookups waiting on the database, by member ID, so that we never
+        # have two identical queries in flight.
+        self._pending = {}
+
+        # Counts invalidations. While any lookup is waiting on the database,
+        # each member invalidated maps to the count at the time, so that a
+        # roster fetched before they left doesn't put them back.
+        self._generation = 0
+        self._invalidated = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, member_id):
+        """
+        Find the conga a member belongs to. Returns a Future that resolves to
+        the conga ID, or fails with KeyError if they aren't in a conga.
+        """
+        entry = self._entries.pop(member_id, None)
+
+        if entry is not None and entry[1] > monotonic():
+            # Put the entry back as the most recently used.
+            self._entries[member_id] = entry
+            self.hits += 1
+
+            future = Future()
+            future.set_result(entry[0])
+            return future
+
+        self.misses += 1
+
+        try:
+            return self._pending[member_id]
+        except KeyError:
+            pass
+
+        future = self._pending[member_id] = Future()
+        roster = self.db.get_async(MEMBER_ROSTER, (member_id,))
+        IOLoop.current().add_future(roster, functools.partial(
+            self._fill, member_id, future, self._generation
+        ))
+        return future
+
+    def invalidate(self, member_id):
+        """
+        Forget a member, for instance because they've said BYE. Any roster
+        still being fetched won't bring them back.
+        """
+        self._entries.pop(member_id, None)
+        self._generation += 1
+
+        if self._pending:
+            self._invalidated[member_id] = self._generation
+
+    def remove(self, member_id, deleted):
+        """
+        Forget a member who is leaving, now and again once the given Future,
+        for deleting them from the database, resolves. Until then, a roster
+        read from the database may still have them in it.
+        """
+        self.invalidate(member_id)
+        IOLoop.current().add_future(
+            deleted, functools.partial(self._removed, member_id)
+        )
+
+    def _removed(self, member_id, deleted):
+        self.invalidate(member_id)
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache's statistics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+    def log_stats(self):
+        """
+        Log the cache's statistics.
+        """
+        logging.info(
+            "Membership cache: %(entries)d entries, %(hits)d hits, "
+            "%(misses)d misses, %(evictions)d evictions, "
+            "hit rate %(hit_rate).2f",
+            self.stats()
+        )
+
+    def _fill(self, member_id, future, generation, roster):
+        """
+        Called with the roster query for a member once it completes. Caches
+        the whole roster, apart from anyone invalidated since the query was
+        made at the given generation, then resolves the member's lookup.
+        """
+        del self._pending[member_id]
+        invalidated = self._invalidated
+
+        if not self._pending:
+            self._invalidated = {}
+
+        try:
+            rows = roster.result()
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return
+
+        now = monotonic()
+        expires = now + self.ttl
+        entries = self._entries
+        conga_id = None
+
+        for row_member, row_conga in rows:
+            # When a whole conga reconnects at once, every member's lookup
+            # brings back the same roster: don't store it all again each
+            # time.
+            entry = entries.get(row_member)
+            fresh = (entry is not None and entry[0] == row_conga and
+                     entry[1] > now)
+
+            # The query may have been answered before their row went.
+            if not fresh and invalidated.get(row_member, 0) <= generation:
+                self._store(row_member, row_conga, expires)
+
+            if row_member == member_id and conga_id is None:
+                conga_id = row_conga
+
+        if conga_id is None:
+            future.set_exception(KeyError(member_id))
+        else:
+            future.set_result(conga_id)
+
+    def _store(self, member_id, conga_id, expires):
+        self._entries.pop(member_id, None)
+        self._entries[member_id] = (conga_id, expires)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
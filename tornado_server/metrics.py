@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.metrics
+~~~~~~~~~~~~~~~~~~~~~~
+
+Counts what the server is doing, and serves the counts over HTTP in the
+Prometheus text format at /metrics and as JSON at /metrics.json.
+
+Counting is kept cheap enough to do on every hop: the counters are plain
+attributes on the module's Metrics object, bumped in place. Everything else
+(the participants in each conga, their outbound buffers, the outstanding
+message tables) is only looked at when someone asks for the metrics.
+"""
+import json
+import weakref
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import PeriodicCallback
+from tornado.web import Application, RequestHandler
+from conga import congas
+from timers import monotonic
+
+# The names to report each connection state under, in the order of the
+# states in participant.py.
+STATE_NAMES = ('opening', 'up', 'closing', 'held')
+
+
+class Metrics(object):
+    """
+    The server's counters, and the participants it knows about. Rates are
+    worked out from the counters every interval seconds, but only while the
+    metrics are being served.
+    """
+    #: The seconds between samples of the counters.
+    interval = 1.0
+
+    def __init__(self):
+        #: The messages handed to a participant to send.
+        self.messages_forwarded = 0
+
+        #: The bytes in those messages.
+        self.bytes_forwarded = 0
+
+        #: The messages dropped because a participant wasn't keeping up.
+        self.messages_dropped = 0
+
+        #: The participants disconnected for not keeping up.
+        self.slow_consumers_disconnected = 0
+
+        #: The messages sent again to participants catching up.
+        self.messages_replayed = 0
+
+        #: The participants who picked up their place on a new connection
+        #: with a resume token.
+        self.participants_resumed = 0
+
+        #: The connections accepted, including those handed over by another
+        #: worker.
+        self.connections_opened = 0
+
+        #: The messages and bytes forwarded per second over the last
+        #: interval.
+        self.messages_per_second = 0.0
+        self.bytes_per_second = 0.0
+
+        #: Every participant that hasn't been garbage collected.
+        self.participants = weakref.WeakSet()
+
+        # The time and counters at the last sample.
+        self._last_sample = (monotonic(), 0, 0)
+
+    def track(self, participant):
+        """
+        Count a new connection, and keep an eye on its participant.
+        """
+        self.connections_opened += 1
+        self.participants.add(participant)
+
+    def sample(self):
+        """
+        Work out the rates since the last sample.
+        """
+        now = monotonic()
+        then, messages, sent = self._last_sample
+        elapsed = now - then
+
+        if elapsed > 0:
+            self.messages_per_second = \
+                (self.messages_forwarded - messages) / elapsed
+            self.bytes_per_second = (self.bytes_forwarded - sent) / elapsed
+
+        self._last_sample = (now, self.messages_forwarded,
+                             self.bytes_forwarded)
+
+    def snapshot(self, members=None):
+        """
+        Returns a dictionary of everything there is to report. If members is
+        given, the MembershipCache's statistics are included.
+        """
+        states = dict((name, 0) for name in STATE_NAMES)
+        buffered = []
+
+        for participant in list(self.participants):
+            states[STATE_NAMES[participant.state]] += 1
+
+        conga_stats = {}
+        for conga in congas():
+            if not conga.participants and not conga.loop_latency.count:
+                continue
+
+            conga_buffered = 0
+            for node in conga.participants:
+                size = node.participant.buffered_bytes
+                conga_buffered += size
+                buffered.append(size)
+
+            conga_stats[str(conga.conga_id)] = {
+                'participants': len(conga.participants),
+                'outstanding_messages': len(conga.outstanding_messages),
+                'buffered_bytes': conga_buffered,
+                'expired_messages': conga.expired_messages,
+                'evicted_messages': conga.evicted_messages,
+                'replay_bytes': conga.replay.bytes,
+                'latency': conga.latency(),
+            }
+
+        snapshot = {
+            'messages_forwarded': self.messages_forwarded,
+            'bytes_forwarded': self.bytes_forwarded,
+            'messages_dropped': self.messages_dropped,
+            'slow_consumers_disconnected': self.slow_consumers_disconnected,
+            'messages_replayed': self.messages_replayed,
+            'participants_resumed': self.participants_resumed,
+            'connections_opened': self.connections_opened,
+            'messages_per_second': self.messages_per_second,
+            'bytes_per_second': self.bytes_per_second,
+            'connections': states,
+            'buffered_bytes': sum(buffered),
+            'max_buffered_bytes': max(buffered) if buffered else 0,
+            'congas': conga_stats,
+        }
+
+        if members is not None:
+            snapshot['membership_cache'] = members.stats()
+
+        return snapshot
+
+
+#: The metrics for this process.
+metrics = Metrics()
+
+
+def prometheus(snapshot):
+    """
+    Formats a snapshot in the Prometheus text format.
+    """
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP piconga_%s %s' % (name, help))
+        lines.append('# TYPE piconga_%s %s' % (name, kind))
+        for labels, value in samples:
+            lines.append('piconga_%s%s %s' % (name, labels, value))
+
+    def total(name, key, help):
+        metric(name, 'counter', help, [('', snapshot[key])])
+
+    def gauge(name, key, help):
+        metric(name, 'gauge', help, [('', snapshot[key])])
+
+    def per_conga(name, key, help):
+        metric(name, 'gauge', help, [
+            ('{conga="%s"}' % conga_id, stats[key])
+            for (conga_id, stats) in sorted(snapshot['congas'].items())
+        ])
+
+    total('messages_forwarded_total', 'messages_forwarded',
+          'Messages handed to a participant to send.')
+    total('bytes_forwarded_total', 'bytes_forwarded',
+          'Bytes handed to a participant to send.')
+    total('messages_dropped_total', 'messages_dropped',
+          'Messages dropped for a participant not keeping up.')
+    total('slow_consumers_disconnected_total', 'slow_consumers_disconnected',
+          'Participants disconnected for not keeping up.')
+    total('messages_replayed_total', 'messages_replayed',
+          'Messages sent again to participants catching up.')
+    total('participants_resumed_total', 'participants_resumed',
+          'Participants who resumed their place on a new connection.')
+    total('connections_opened_total', 'connections_opened',
+          'Connections accepted.')
+    gauge('messages_per_second', 'messages_per_second',
+          'Messages forwarded per second.')
+    gauge('bytes_per_second', 'bytes_per_second',
+          'Bytes forwarded per second.')
+    metric('connections', 'gauge', 'Connections in each state.', [
+        ('{state="%s"}' % state, snapshot['connections'][state])
+        for state in STATE_NAMES
+    ])
+    gauge('buffered_bytes', 'buffered_bytes',
+          'Bytes waiting to be sent to participants.')
+    gauge('max_buffered_bytes', 'max_buffered_bytes',
+          'The most bytes waiting to be sent to any one participant.')
+    per_conga('conga_participants', 'participants',
+              'Participants in each conga.')
+    per_conga('conga_outstanding_messages', 'outstanding_messages',
+              'Messages yet to return to their sender in each conga.')
+    per_conga('conga_buffered_bytes', 'buffered_bytes',
+              'Bytes waiting to be sent to participants in each conga.')
+    per_conga('conga_replay_bytes', 'replay_bytes',
+              'Bytes of messages kept for catching up in each conga.')
+
+    for kind, help in (
+            ('loop', 'Microseconds for a message to go round each conga.'),
+            ('hop', 'Microseconds from sending a message to a participant '
+                    'to receiving it back, in each conga.')):
+        samples = []
+        for conga_id, stats in sorted(snapshot['congas'].items()):
+            summary = stats['latency'][kind]
+            if not summary['count']:
+                continue
+
+            for percent in (50, 90, 99, 99.9):
+                samples.append((
+                    '{conga="%s",quantile="%s"}' % (conga_id, percent / 100.0),
+                    summary['p%s' % percent]
+                ))
+
+            samples.append(('_sum{conga="%s"}' % conga_id,
+                            summary['mean'] * summary['count']))
+            samples.append(('_count{conga="%s"}' % conga_id,
+                            summary['count']))
+
+        metric('conga_%s_latency_microseconds' % kind, 'summary', help,
+               samples)
+
+    if 'membership_cache' in snapshot:
+        cache = snapshot['membership_cache']
+        metric('membership_cache_entries', 'gauge',
+               'Members in the membership cache.', [('', cache['entries'])])
+        metric('membership_cache_lookups_total', 'counter',
+               'Membership lookups, by whether they were cached.', [
+                   ('{result="hit"}', cache['hits']),
+                   ('{result="miss"}', cache['misses']),
+               ])
+
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class PrometheusHandler(RequestHandler):
+    """
+    Serves the metrics in the Prometheus text format.
+    """
+    def initialize(self, members):
+        self.members = members
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(prometheus(metrics.snapshot(self.members)))
+
+
+class JSONHandler(RequestHandler):
+    """
+    Serves the metrics as JSON.
+    """
+    def initialize(self, members):
+        self.members = members
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(metrics.snapshot(self.members), indent=2,
+                              sort_keys=True))
+
+
+def listen(port, members=None, address=''):
+    """
+    Start serving the metrics on the given port, and start sampling the
+    counters. Returns the HTTPServer.
+    """
+    application = Application([
+        (r'/metrics', PrometheusHandler, {'members': members}),
+        (r'/metrics\.json', JSONHandler, {'members': members}),
+    ])
+
+    server = HTTPServer(application)
+    server.listen(port, address)
+
+    metrics.sample()
+    PeriodicCallback(metrics.sample, metrics.interval * 1000).start()
+
+    return server
@@ -5,32 +5,118 @@ tornado_server.participant
 
 Defines the representation of a single participant in a conga.
 """
+from collections import deque
+from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 from conga import Conga, conga_from_id
+from db.base import log_failure
+from db.queries import REMOVE_MEMBER
 from tornado_exceptions import JoinError, LeaveError
-from decorators import bye_on_error, bye_on_error_cb
+from decorators import bye_on_error
+from framing import (TEXT, BINARY, RING, EXPRESS, BROADCAST, FRAME,
+                     pack_frame, unpack_frame, text_header, extra_headers)
+from compression import DEFLATE, inflate
+from metrics import metrics
+from watchdog import watchdog
+import resume
+import functools
 import logging
 import traceback
-# Define some states for the Participant connection.
+import zlib
+# Define some states for the Participant connection. A participant whose
+# connection dropped, but who may yet resume it, is HELD.
 OPENING = 0
 UP = 1
 CLOSING = 2
+HELD = 3
+
+#: Messages up to this many bytes long are written to the stream as a single
+#: buffer. Copying them is cheaper than an extra send, and it keeps Nagle's
+#: algorithm from holding a small body back behind its header. Longer
+#: messages are written as separate header and body buffers, so the body is
+#: never joined onto its header here. (The IOStream still copies whatever it
+#: is given into its own write buffer.)
+COALESCE_LIMIT = 4096
+
+# Define what can happen to a message for a participant that isn't keeping
+# up: the oldest message waiting for them is dropped, the new message is
+# dropped, or they are disconnected.
+DROP_OLDEST = 'drop_oldest'
+DROP_NEW = 'drop_new'
+DISCONNECT = 'disconnect'
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DROP_NEW, DISCONNECT)
+
+#: The backlog of every participant with nothing waiting. Never added to.
+NO_BACKLOG = ()
 
 
 class Participant(object):
     """
     Participant wraps a single incoming IOStream. It knows about the next
     participant in the Conga chain, and correctly writes to it.
+
+    Messages for a participant are written straight to their stream until it
+    holds low_water bytes it hasn't managed to send. After that they wait in
+    a backlog until the stream drains. If the stream and backlog together
+    would go over high_water bytes, slow_consumer_policy decides what to do.
+    A message for a participant with nothing waiting is always sent.
+
+    A server may hold a great many of these at once, mostly idle, so they
+    have slots rather than a __dict__, reach everything they share with
+    the rest of the server through the one reference to it, and read their
+    messages with bound methods rather than building closures per message.
     """
-    def __init__(self, source, db):
+    __slots__ = (
+        'source_stream', 'destination', 'server', 'state', 'participant_id',
+        'conga_id', 'protocol', 'compression', 'delivery', 'backlog',
+        'backlog_bytes', 'flight_bytes', 'dropped_messages', 'heartbeat',
+        'resume_token', '_draining', '_heard', '_pinged', '_handler',
+        '__weakref__',
+    )
+
+    #: The most bytes to buffer for a participant.
+    high_water = 1024 * 1024
+
+    #: The most bytes to hand to a participant's stream at once. Anything
+    #: more waits in the backlog, where it can still be dropped.
+    low_water = 64 * 1024
+
+    #: What to do with a message that would take a participant over
+    #: high_water. One of SLOW_CONSUMER_POLICIES.
+    slow_consumer_policy = DROP_OLDEST
+
+    #: The seconds a new connection has to send HELLO and join a conga
+    #: before it is closed. 0 for no limit.
+    handshake_timeout = 10.0
+
+    #: The seconds a participant who asked for heartbeats can send nothing
+    #: before we PING them, and the seconds they then have to answer before
+    #: we say BYE for them. Either way, a dead peer is taken out of the
+    #: conga within 2 * idle_timeout + ping_timeout. 0 turns this off.
+    idle_timeout = 30.0
+    ping_timeout = 10.0
+
+    #: The seconds to hold a participant's place in the conga after their
+    #: connection drops, for them to resume it. 0 turns resuming off.
+    resume_grace = 30.0
+
+    #: Set while the server hands its connections to a new process (see
+    #: restart.py). Participants finish reading the message they're part
+    #: way through, but don't start reading another.
+    paused = False
+
+    def __init__(self, source, server):
         #: The tornado IOStream socket wrapper pointing to the end user.
         self.source_stream = source
 
         #: The Participant object representing the next link in the conga.
         self.destination = None
 
-        #: A reference to the database object.
-        self.db = db
+        #: The TCPProxy that accepted us, which holds the database object,
+        #: the MembershipCache used to find which conga we belong to, and
+        #: the ShardRouter used to find the worker that owns our conga (or
+        #: None if this is the only worker).
+        self.server = server
 
         #: An indiciation of the state of this connection.
         self.state = OPENING
@@ -41,6 +127,61 @@ class Participant(object):
         #: The ID of the conga.
         self.conga_id = None
 
+        #: The format this participant's messages are in: TEXT or BINARY.
+        self.protocol = TEXT
+
+        #: The compression this participant can read, or None.
+        self.compression = None
+
+        #: How messages delivered to this participant get to the next one:
+        #: RING if their client sends them back, EXPRESS if we pass them on.
+        self.delivery = RING
+
+        #: Messages waiting to be written to the stream. Each item is a tuple
+        #: of (buffers, size). Empty, it's the shared NO_BACKLOG, and a deque
+        #: is only made for a participant who falls behind.
+        self.backlog = NO_BACKLOG
+
+        #: The bytes in the backlog.
+        self.backlog_bytes = 0
+
+        #: The bytes written to the stream since it was last empty.
+        self.flight_bytes = 0
+
+        #: The number of messages for us that have been dropped.
+        self.dropped_messages = 0
+
+        #: Whether this participant answers PINGs, and so whether we send
+        #: them when they go quiet.
+        self.heartbeat = False
+
+        #: The token this participant can resume with, if they asked for
+        #: one.
+        self.resume_token = None
+
+        # Whether we're waiting to hear that the stream has drained.
+        self._draining = False
+
+        # What to do with the body being read, while one is.
+        self._handler = None
+
+        # Whether we've heard anything from them since the watchdog last
+        # looked, and whether it has sent them a PING since.
+        self._heard = False
+        self._pinged = False
+
+        self._opened()
+
+    def _opened(self):
+        """
+        Count the new connection, and give it handshake_timeout to join a
+        conga.
+        """
+        metrics.track(self)
+
+        if self.handshake_timeout:
+            watchdog.schedule(self, self.handshake_timeout)
+
     @bye_on_error
     def add_destination(self, destination):
         """
@@ -50,20 +191,147 @@ class Participant(object):
         self.destination = destination
 
     @bye_on_error
-    def write(self, data, message_id, conga):
+    def write(self, buffers, message_id, conga, origin_id=None,
+              hops_remaining=None):
         """
-        Write data on the downstream connection. If no such connection exists,
-        drop this stuff on the floor.
+        Write a message on the downstream connection. The message is passed
+        as a list of buffers, which are written in order. If no such
+        connection exists, drop this stuff on the floor.
         """
         # Before sending this, check whether we originally sent this message.
         # If we did, don't do anything.
-        if conga.stop_loop(message_id, self.participant_id):
+        if conga.stop_loop(message_id, self.participant_id, origin_id,
+                           hops_remaining):
             return
 
+        self.deliver(buffers)
+
+        if self.delivery == EXPRESS:
+            # Our client won't send this back, so pass it on for them. Each
+            # hop waits its turn on the IOLoop, so walking a large conga
+            # doesn't hold everything else up.
+            IOLoop.current().add_callback(self._express, buffers)
+
+    @bye_on_error
+    def deliver(self, buffers):
+        """
+        Send a message to this participant, whatever it is and wherever it
+        came from, subject to how much is already waiting for them.
+        """
+        size = 0
+        for data in buffers:
+            size += len(data)
+
+        metrics.messages_forwarded += 1
+        metrics.bytes_forwarded += size
+
+        # A participant with nothing waiting takes any message, however
+        # large: only a backlog is a sign they aren't keeping up.
+        buffered = self.buffered_bytes
+        if buffered and buffered + size > self.high_water:
+            self._overflow(buffers, size)
+        elif self.backlog or self.flight_bytes >= self.low_water or \
+                self.state == HELD:
+            self._queue(buffers, size)
+        else:
+            self._send(buffers, size)
+
+    @property
+    def buffered_bytes(self):
+        """
+        The bytes waiting to be sent to this participant.
+        """
+        return self.flight_bytes + self.backlog_bytes
+
+    def _queue(self, buffers, size):
+        """
+        Add a message to the end of the backlog.
+        """
+        if not self.backlog:
+            self.backlog = deque()
+
+        self.backlog.append((buffers, size))
+        self.backlog_bytes += size
+
+    def _send(self, buffers, size):
+        """
+        Write a message to the stream. If the stream can't send it all at
+        once, ask to be told when it has.
+        """
+        written = 0
+
         try:
-            self.source_stream.write(data)
+            for data in buffers:
+                self.source_stream.write(data)
+                written += 1
         except AttributeError:
-            pass
+            return
+        except StreamClosedError:
+            self._lost()
+            if self.state == HELD and not written:
+                # None of it went, so it can wait for them at the front of
+                # the backlog.
+                if not self.backlog:
+                    self.backlog = deque()
+                self.backlog.appendleft((buffers, size))
+                self.backlog_bytes += size
+            return
+
+        if self.source_stream.writing():
+            self.flight_bytes += size
+
+            if not self._draining:
+                self._draining = True
+                self.source_stream.write(b'', self._drained)
+
+    @bye_on_error
+    def _drained(self):
+        """
+        Called when the stream has sent everything written to it. Move
+        messages from the backlog to the stream, up to low_water bytes.
+        """
+        self._draining = False
+        self.flight_bytes = 0
+
+        while self.backlog and self.flight_bytes < self.low_water and \
+                self.state == UP:
+            buffers, size = self.backlog.popleft()
+            self.backlog_bytes -= size
+            self._send(buffers, size)
+
+        if not self.backlog:
+            self.backlog = NO_BACKLOG
+
+    def _overflow(self, buffers, size):
+        """
+        Deal with a message that would take us over high_water, with some
+        already waiting, according to slow_consumer_policy.
+        """
+        if self.slow_consumer_policy == DISCONNECT:
+            logging.error(
+                "Participant %s has %d bytes waiting. Disconnecting them.",
+                self.participant_id, self.buffered_bytes
+            )
+            metrics.slow_consumers_disconnected += 1
+            self._bye()
+            return
+
+        if self.slow_consumer_policy == DROP_OLDEST:
+            # Make room by dropping the oldest messages we haven't handed to
+            # the stream yet.
+            while self.backlog and \
+                    self.buffered_bytes + size > self.high_water:
+                _, dropped = self.backlog.popleft()
+                self.backlog_bytes -= dropped
+                self.dropped_messages += 1
+                metrics.messages_dropped += 1
+
+            if self.buffered_bytes + size <= self.high_water:
+                self._queue(buffers, size)
+                return
+
+        self.dropped_messages += 1
+        metrics.messages_dropped += 1
 
     @bye_on_error
     def wait_for_headers(self):
@@ -72,14 +340,18 @@ class Participant(object):
         us that the headers have ended.
         """
         try:
-            self.source_stream.read_until(b'\r\n\r\n', self._parse_headers)
+            if self.protocol == BINARY:
+                self.source_stream.read_bytes(FRAME.size, self._parse_frame)
+            else:
+                self.source_stream.read_until(b'\r\n\r\n',
+                                              self._parse_headers)
         except StreamClosedError:
             if self.state != CLOSING:
                 # Unexpected closure: run the Bye logic.
                 logging.error(
-                    "Unexpected close by participant %d" % self.participant_id
+                    "Unexpected close by participant %d", self.participant_id
                 )
-                self._bye()('')
+                self._lost()
 
     @bye_on_error
     def _parse_headers(self, header_data):
@@ -88,165 +360,965 @@ class Participant(object):
         reads that many bytes as the body. Most importantly, handles the
         request URI.
         """
-        headers = {}
-
-        decoded_data = header_data.decode('utf-8')
-        lines = decoded_data.split('\r\n')
-        request_uri = lines[0]
-
-        try:
-            header_lines = lines[1:]
-        except IndexError:
-            header_lines = []
-
-        for line in header_lines:
-            if line:
-                key, val = line.split(':', 1)
-                headers[key] = val
+        request_uri, headers = _split_headers(header_data)
+        self._heard = True
 
         # Get the content-length, and then read however many bytes we need to
         # get the body.
         length = int(headers.get('Content-Length', '0'))
 
         if (request_uri == 'HELLO') and (self.state == OPENING):
-            cb = self._hello(headers)
+            cb = functools.partial(self._hello, header_data, headers)
         elif (request_uri == 'BYE') and (self.state == UP):
-            cb = self._bye(headers)
+            cb = self._bye
         elif (request_uri == 'MSG') and (self.state == UP):
-            cb = self._repeat_data(header_data, headers)
+            cb = functools.partial(self._repeat_data, header_data, headers)
+        elif (request_uri == 'PING') and (self.state == UP):
+            cb = self._ping
+        elif (request_uri == 'PONG') and (self.state == UP):
+            cb = self._pong
+        elif (request_uri == 'REPLAY') and (self.state == UP):
+            cb = functools.partial(self._replay, headers)
+        else:
+            # Unexpected verb: bail.
+            logging.error(
+                "Unexpected verb %s on participant %s in state %d.",
+                request_uri, self.participant_id, self.state
+            )
+            self._bye()
+            return
+
+        if request_uri == 'HELLO':
+            # Don't read past a HELLO until it's been dealt with: the
+            # connection may yet be handed to another worker.
+            self.source_stream.read_bytes(length, cb)
+        else:
+            self._read_body(length, cb)
+
+    @bye_on_error
+    def _parse_frame(self, frame_data):
+        """
+        The binary counterpart to _parse_headers. Reads the rest of the frame,
+        and handles its verb.
+        """
+        frame = unpack_frame(frame_data)
+        verb, extra_length, body_length = frame[:3]
+        self._heard = True
+
+        if (verb == 'MSG') and (self.state == UP):
+            cb = functools.partial(self._repeat_frame, frame)
+        elif (verb == 'BYE') and (self.state == UP):
+            cb = self._bye
+        elif (verb == 'PING') and (self.state == UP):
+            cb = self._ping
+        elif (verb == 'PONG') and (self.state == UP):
+            cb = self._pong
+        elif (verb == 'REPLAY') and (self.state == UP):
+            cb = functools.partial(self._replay_frame, frame)
         else:
             # Unexpected verb: bail.
             logging.error(
-                "Unexpected verb %s on participant %s in state %d." %
-                (request_uri, self.participant_id, self.state)
+                "Unexpected verb %s on participant %s in state %d.",
+                verb, self.participant_id, self.state
             )
-            self._bye()('')
+            self._bye()
+            return
+
+        self._read_body(extra_length + body_length, cb)
 
-        self.source_stream.read_bytes(length, cb)
+    def _read_body(self, length, handler):
+        """
+        Read a message body of the given length and pass it to handler, then
+        wait for the next message. A stream only takes one read at a time,
+        so the next header isn't asked for until the body has arrived.
+        """
+        self._handler = handler
+        self.source_stream.read_bytes(length, self._body_read)
 
-        # If we're closing up shop, don't bother reading again.
-        if self.state != CLOSING:
+    @bye_on_error
+    def _body_read(self, data):
+        handler = self._handler
+        self._handler = None
+        handler(data)
+
+        # If we're closing up shop, or the connection dropped, don't bother
+        # reading again.
+        if self.state == UP and not self.paused:
             self.wait_for_headers()
 
-    def _hello(self, headers={}):
+    @property
+    def mid_message(self):
+        """
+        Whether we've read the header of a message, but not yet dealt with
+        its body.
         """
-        Builds a closure for use as a registration callback.
+        return self._handler is not None
 
-        Note that this closure does not take the header data but the actual
-        headers dictionary. This is deliberate: we'll actually use the headers
-        here, so there's no point parsing them twice.
+    def adopt(self, hello_data, conga_id):
         """
-        @bye_on_error_cb(self)
-        def callback(data):
-            try:
-                # Validate the participant against the DB.
-                received_id = headers['User-ID'].strip()
-                conga_id = self.db.get(
-                    "SELECT conga_id FROM conga_congamember WHERE member_id=%s",
-                    (received_id,)
-                )[0][0]
-
-                # At this stage we've successfully validated this participant.
-                # Bring them up.
-                self.participant_id = int(received_id)
-                self.conga_id = conga_id
-                self.state = UP
-
-                # Join the conga.
-                conga = conga_from_id(conga_id)
-                conga.join(self, self.participant_id)
-            except (KeyError, IndexError), e:
-                # This will catch a missing User-ID as well as a failed SQL
-                # lookup.
+        Take over a connection that has already sent its HELLO to another
+        worker, which found it belongs in a conga owned by this one.
+        """
+        _, headers = _split_headers(hello_data)
+        participant_id = int(headers['User-ID'].strip())
+
+        if not self._resume(headers, participant_id):
+            self._join_conga(participant_id, conga_id, headers)
+
+    def snapshot(self):
+        """
+        Returns what a new server process needs to know to take this
+        participant over, as plain data.
+        """
+        return {
+            'participant_id': self.participant_id,
+            'protocol': self.protocol,
+            'compression': self.compression,
+            'delivery': self.delivery,
+            'heartbeat': self.heartbeat,
+            'resume_token': self.resume_token,
+        }
+
+    def resume(self, state, conga_id, unsent=b''):
+        """
+        Take over a participant from the server process that had them, from
+        their snapshot. unsent is anything that process hadn't yet managed
+        to send them, which goes first.
+        """
+        self.protocol = str(state['protocol'])
+        self.compression = state['compression'] and str(state['compression'])
+        self.delivery = str(state['delivery'])
+        self.heartbeat = state['heartbeat']
+        self.resume_token = state.get('resume_token') and \
+            str(state['resume_token'])
+        self.participant_id = state['participant_id']
+        self.conga_id = conga_id
+        self.state = UP
+
+        try:
+            conga_from_id(conga_id).join(self, self.participant_id)
+        except JoinError:
+            self._bye()
+            return
+
+        if self.resume_token is not None:
+            resume.register(self.resume_token, self)
+
+        self.source_stream.set_close_callback(self._closed)
+
+        if self.heartbeat and self.idle_timeout:
+            watchdog.schedule(self, self.idle_timeout)
+        else:
+            watchdog.cancel(self)
+
+        if unsent:
+            self._send([unsent], len(unsent))
+
+        self.wait_for_headers()
+
+    def _join_conga(self, participant_id, conga_id, headers):
+        """
+        Bring this participant up in the given conga, then start reading its
+        messages. If their HELLO headers asked for binary frames, for
+        compression, for express delivery, for heartbeats or for a resume
+        token, answer with a HELLO saying they have them.
+        """
+        self.participant_id = participant_id
+        self.conga_id = conga_id
+        self.state = UP
+
+        conga = conga_from_id(conga_id)
+        node = conga.participants.get(participant_id)
+
+        if node is not None and node.participant.state in (UP, HELD):
+            # They've come back without their token, most likely because
+            # their old connection died without our hearing. The newest
+            # connection wins: their old place goes, but they're still a
+            # member.
+            if node.participant.state == UP:
                 logging.error(
-                    "Hit exception %s adding participant %s to conga %s." %
-                    (e, self.participant_id, self.conga_id)
+                    "Participant %d connected again. Dropping their old "
+                    "connection.", participant_id
                 )
-                logging.error(traceback.format_exc())
+            node.participant._leave()
+
+        try:
+            conga.join(self, self.participant_id)
+        except JoinError, e:
+            # Someone else has this place. Turn this connection away without
+            # touching them or the DB.
+            self._reject(e)
+            return
 
-                self.source_stream.close()
-                self.state = CLOSING
-            except JoinError:
-                # The attempt to join the conga failed. Close up, and
-                # additionally run the BYE logic.
-                self._bye()('')
+        if headers.get('Protocol', '').strip() == BINARY:
+            self.protocol = BINARY
 
-        return callback
+        if headers.get('Compression', '').strip() == DEFLATE:
+            self.compression = DEFLATE
 
-    def _bye(self, headers={}):
+        if headers.get('Delivery', '').strip() == EXPRESS:
+            self.delivery = EXPRESS
+
+        if headers.get('Heartbeat', '').strip() == 'ping':
+            self.heartbeat = True
+
+        if headers.get('Resume', '').strip() == 'yes' and self.resume_grace:
+            self.resume_token = resume.issue(self)
+
+        self._start(self._agreed())
+
+    def _agreed(self):
         """
-        Builds a closure for execution on receipt of a conga BYE.
+        Returns the header lines for everything this participant asked for
+        on HELLO and has.
         """
-        def callback(data):
-            # Begin by dumping ourselves out of the conga, so that we don't
-            # receive any more messages. If this fails, log the failure but
-            # keep going.
-            try:
-                conga = conga_from_id(self.conga_id)
-                conga.leave(self, self.participant_id)
-            except LeaveError, e:
+        agreed = []
+
+        if self.protocol == BINARY:
+            agreed.append(b'Protocol: %s\r\n' % BINARY)
+        if self.compression == DEFLATE:
+            agreed.append(b'Compression: %s\r\n' % DEFLATE)
+        if self.delivery == EXPRESS:
+            agreed.append(b'Delivery: %s\r\n' % EXPRESS)
+        if self.heartbeat:
+            agreed.append(b'Heartbeat: ping\r\n')
+        if self.resume_token is not None:
+            agreed.append(b'Resume-Token: %s\r\n' % self.resume_token)
+
+        return agreed
+
+    def _start(self, answer):
+        """
+        Finish the handshake: answer HELLO with the given header lines, if
+        there are any, and start reading messages. From here on, only
+        participants who answer PINGs have a deadline, and we hear as soon
+        as the connection closes.
+        """
+        self.source_stream.set_close_callback(self._closed)
+
+        if self.heartbeat and self.idle_timeout:
+            watchdog.schedule(self, self.idle_timeout)
+        else:
+            watchdog.cancel(self)
+
+        if answer:
+            self.source_stream.write(
+                text_header('HELLO', b''.join(answer), 0)
+            )
+
+        self.wait_for_headers()
+
+    @bye_on_error
+    def _hello(self, header_data, headers, data):
+        """
+        Called with the body of a HELLO, once it has been read.
+
+        Note that this takes the actual headers dictionary as well as the
+        header data. This is deliberate: we'll actually use the headers here,
+        so there's no point parsing them twice. The raw header data is kept
+        only in case the connection needs handing to another worker.
+        """
+        try:
+            participant_id = int(headers['User-ID'].strip())
+        except (KeyError, ValueError), e:
+            self._reject(e)
+            return
+
+        # A participant picking up where they left off needs no lookup.
+        if self._resume(headers, participant_id):
+            return
+
+        # Validate the participant against the membership cache, which goes
+        # to the DB off the IOLoop if it has to, so every other conga
+        # carries on while we wait.
+        lookup = self.server.members.lookup(participant_id)
+        IOLoop.current().add_future(lookup, functools.partial(
+            self._looked_up, header_data, headers, participant_id
+        ))
+
+    @bye_on_error
+    def _looked_up(self, header_data, headers, participant_id, lookup):
+        """
+        Called once the membership cache has found which conga a
+        participant saying HELLO belongs to.
+        """
+        try:
+            conga_id = lookup.result()
+        except KeyError, e:
+            # They aren't a member of any conga.
+            self._reject(e)
+            return
+
+        if self.source_stream.closed():
+            # They gave up on us while we were waiting for the DB.
+            self.state = CLOSING
+            return
+
+        shard = self.server.shard
+        if shard is not None and not shard.owns(conga_id):
+            # Another worker owns this conga: let it take over.
+            self.state = CLOSING
+            watchdog.cancel(self)
+            shard.hand_off(self.source_stream, header_data, conga_id)
+            return
+
+        # At this stage we've successfully validated this participant. Bring
+        # them up.
+        self._join_conga(participant_id, conga_id, headers)
+
+    def _reject(self, e):
+        """
+        Turn away a participant whose HELLO we couldn't make sense of.
+        """
+        logging.error(
+            "Hit exception %s adding participant %s to conga %s.",
+            e, self.participant_id, self.conga_id
+        )
+        logging.error(traceback.format_exc())
+
+        self.source_stream.close()
+        self.state = CLOSING
+        watchdog.cancel(self)
+
+    def _bye(self, data=b''):
+        """
+        Take this participant out of their conga and the DB, and close the
+        connection. Called on receipt of a conga BYE, and whenever the
+        connection has to go.
+        """
+        # A BYE's body may arrive after the connection has already gone
+        # another way, and we mustn't leave twice.
+        if self.state == CLOSING:
+            return
+
+        self._leave()
+
+        # Now remove ourselves from the DB. This is committed later alongside
+        # any other writes, so don't wait for it: if it fails, just log. The
+        # cache mustn't keep us in the conga meanwhile, nor pick us up again
+        # from a roster read before the delete is committed.
+        deleted = self.server.db.execute_later(
+            REMOVE_MEMBER, (self.participant_id,)
+        )
+        self.server.members.remove(self.participant_id, deleted)
+        IOLoop.current().add_future(deleted, log_failure(
+            "Removing %s from conga %s" % (self.participant_id, self.conga_id)
+        ))
+
+    def _leave(self):
+        """
+        Take this participant out of their conga and close the connection,
+        but leave them in the DB. Does nothing if they've already left.
+        """
+        if self.state == CLOSING:
+            return
+
+        # Begin by dumping ourselves out of the conga, so that we don't receive
+        # any more messages. If this fails, log the failure but keep going.
+        try:
+            conga = conga_from_id(self.conga_id)
+            conga.leave(self, self.participant_id)
+        except LeaveError, e:
+            logging.error(
+                "Failed to remove %s from conga %s because of %s",
+                self.participant_id, self.conga_id, e
+            )
+
+        if self.resume_token is not None:
+            resume.revoke(self.resume_token)
+
+        # Finally, close the connection here.
+        watchdog.cancel(self)
+        self.destination = None
+        self.backlog = NO_BACKLOG
+        self.backlog_bytes = 0
+
+        if not self.source_stream.closed():
+            self.source_stream.close()
+
+        self.state = CLOSING
+
+    def _lost(self):
+        """
+        Called when the connection drops without a BYE. A participant with a
+        resume token keeps their place in the conga for resume_grace
+        seconds, and anything sent to them meanwhile waits in their backlog.
+        Anyone else leaves, as though they'd said BYE.
+        """
+        if self.state in (HELD, CLOSING):
+            return
+
+        if self.state != UP or self.resume_token is None:
+            self._bye()
+            return
+
+        logging.info("Holding participant %s's place in conga %s.",
+                     self.participant_id, self.conga_id)
+
+        # Whatever the stream hadn't sent is gone with it.
+        self.state = HELD
+        self.flight_bytes = 0
+        self._draining = False
+
+        if not self.source_stream.closed():
+            self.source_stream.close()
+
+        watchdog.schedule(self, self.resume_grace)
+
+    def _closed(self):
+        """
+        Called once the connection has closed, whoever closed it.
+        """
+        if self.state == UP:
+            logging.error(
+                "Unexpected close by participant %d", self.participant_id
+            )
+            self._lost()
+
+    def _resume(self, headers, participant_id):
+        """
+        If a HELLO carried the resume token of the given participant, hand
+        this connection to them, and return True.
+        """
+        token = headers.get('Resume-Token', '').strip()
+        held = token and resume.claim(token, participant_id)
+
+        if not held:
+            return False
+
+        self.state = CLOSING
+        watchdog.cancel(self)
+        held._take_over(self.source_stream)
+        return True
+
+    def _take_over(self, stream):
+        """
+        Carry on in the conga on a new connection, which said HELLO with our
+        resume token. If the old connection hadn't been noticed dropping,
+        it's closed now. The answering HELLO says we've resumed, and then
+        everything in the backlog follows.
+        """
+        logging.info("Participant %s resumed in conga %s.",
+                     self.participant_id, self.conga_id)
+        metrics.participants_resumed += 1
+
+        # The old connection closing now isn't the new one dropping.
+        self.source_stream.set_close_callback(None)
+        if not self.source_stream.closed():
+            self.source_stream.close()
+
+        self.source_stream = stream
+        self.state = UP
+        self.flight_bytes = 0
+        self._draining = False
+        self._heard = False
+        self._pinged = False
+
+        self._start(self._agreed() + [b'Resumed: yes\r\n'])
+        self._drained()
+
+    def _ping(self, data):
+        """
+        Called on receipt of a PING. Hearing it has already told the
+        watchdog they're alive, so all that's left is to answer.
+        """
+        self._control('PONG')
+
+    def _pong(self, data):
+        """
+        Called on receipt of a PONG, which has already told the watchdog
+        they're alive.
+        """
+
+    def _control(self, verb):
+        """
+        Write a PING or PONG, which has no headers or body, straight to the
+        stream. It's small enough not to count against the buffers, and
+        mustn't wait behind a backlog.
+        """
+        if self.protocol == BINARY:
+            data = pack_frame(verb, 0, 0)
+        else:
+            data = text_header(verb, b'', 0)
+
+        try:
+            self.source_stream.write(data)
+        except StreamClosedError:
+            self._lost()
+
+    @bye_on_error
+    def timed_out(self):
+        """
+        Called by the watchdog once our deadline has passed. A connection
+        that hasn't finished its HELLO is closed. A participant who has gone
+        quiet is sent a PING, and if they still say nothing, their
+        connection is treated as dropped, so the conga stops sending
+        messages into it. A held participant who hasn't resumed in time
+        leaves, as though they'd said BYE.
+        """
+        if self.state == OPENING:
+            logging.error("Closing a connection that never joined a conga.")
+            self.state = CLOSING
+            self.source_stream.close()
+        elif self.state == UP:
+            if self._heard:
+                self._heard = False
+                self._pinged = False
+                watchdog.schedule(self, self.idle_timeout)
+            elif not self._pinged:
+                self._pinged = True
+                watchdog.schedule(self, self.ping_timeout)
+                self._control('PING')
+            else:
                 logging.error(
-                    "Failed to remove %s from conga %s because of %s" %
-                    (self.participant_id, self.conga_id, e)
+                    "Participant %s stopped answering PINGs.",
+                    self.participant_id
                 )
+                self._lost()
+        elif self.state == HELD:
+            logging.info("Participant %s didn't resume in time.",
+                         self.participant_id)
+            self._bye()
 
-            # Now remove ourselves from the DB. If it fails, just log, but keep
-            # going.
-            try:
-                self.db.execute("DELETE FROM conga_congamember WHERE id=%s",
-                                (self.participant_id,))
-            except Exception, e:
-                logging.error(
-                    "Failed to remove %s from conga %s because of %s" %
-                    (self.participant_id, self.conga_id, e)
+    @bye_on_error
+    def _repeat_data(self, header_data, headers, data):
+        """
+        Called with the body of a MSG, once it has been read. We wait for the
+        message body before sending the headers, just in case the message is
+        ill-formed. That way we don't confuse clients by sending headers with
+        no following body.
+        """
+        # Before we start, check whether there is a Message ID on this
+        # message. If there isn't, we've never seen it before.
+        # Check whether this is a message we've seen before.
+        conga = conga_from_id(self.conga_id)
+        stamps = []
+        sender_id = None
+
+        try:
+            msg_id = headers['Message-ID']
+        except KeyError:
+            if headers.get('Delivery', '').strip() == BROADCAST:
+                self._broadcast(
+                    extra_headers(headers), data,
+                    headers.get('Content-Encoding', '').strip() == DEFLATE
                 )
+                return
 
-            # Finally, close the connection here.
-            self.destination = None
+            # New message. Get a message ID for it, and then add it to the
+            # header data.
+            msg_id = conga.new_message(self.participant_id)
+            stamps.append(('Message-ID', msg_id))
+            sender_id = self.participant_id
 
-            if not self.source_stream.closed():
-                self.source_stream.close()
+            if conga.stateless_loops:
+                hops = len(conga.participants) - 1
+                headers['Origin-ID'] = str(self.participant_id)
+                headers['Hops-Remaining'] = str(hops)
+                stamps.append(('Origin-ID', self.participant_id))
 
-            self.state = CLOSING
+            conga.replay.record(
+                int(msg_id), sender_id, extra_headers(headers), data,
+                headers.get('Content-Encoding', '').strip() == DEFLATE
+            )
+
+        origin_id = None
+        hops = None
 
-        return callback
+        if conga.stateless_loops and 'Origin-ID' in headers:
+            # Each hop uses up one of the remaining hops. A message with
+            # garbled loop headers is treated as having none left.
+            try:
+                origin_id = int(headers['Origin-ID'])
+                hops = int(headers.get('Hops-Remaining', '0'))
+            except ValueError:
+                origin_id = self.participant_id
+                hops = 0
+
+            stamps.append(('Hops-Remaining', hops - 1))
+
+        compressed = headers.get('Content-Encoding', '').strip() == DEFLATE
+
+        if compressed and self.destination.compression != DEFLATE:
+            # The next participant can't read the body as it is.
+            data = self._inflate(data)
+            if data is None:
+                return
+
+            compressed = False
+            stamps.append(('Content-Encoding', None))
+            stamps.append(('Content-Length', len(data)))
+
+        delivery = self.destination.delivery
+
+        if delivery == EXPRESS or 'Delivery' in headers:
+            # Tell the next participant whether to pass this on.
+            stamps.append(
+                ('Delivery', EXPRESS if delivery == EXPRESS else None)
+            )
+
+        if self.destination.protocol == BINARY:
+            # Translate for a binary participant. The stamped values
+            # become fields; everything else goes as extra headers.
+            extra = extra_headers(headers)
+            header = pack_frame(
+                'MSG', len(extra), len(data), msg_id,
+                origin_id or sender_id,
+                None if hops is None else hops - 1, compressed, delivery
+            )
+            buffers = _coalesce(header + extra, data)
+        else:
+            buffers = _frame_message(header_data, stamps, data)
 
-    def _repeat_data(self, header_data, headers):
+        self._forward(buffers, msg_id, conga, origin_id, hops)
+
+    @bye_on_error
+    def _repeat_frame(self, frame, payload):
         """
-        Builds a closure for use as a data sending callback. We use a closure
-        here to ensure that we are able to wait for the message body before
-        sending the headers, just in case the message is ill-formed. That way
-        we don't confuse clients by sending headers with no following body.
+        The binary counterpart to _repeat_data. Called with the extra
+        headers and body of a MSG frame together, once they have been read.
         """
-        @bye_on_error_cb(self)
-        def callback(data):
-            # Before we start, check whether there is a Message ID on this
-            # message. If there isn't, we've never seen it before.
-            # Check whether this is a message we've seen before.
-            conga = conga_from_id(self.conga_id)
+        (_, extra_length, length, msg_id, origin_id, hops_left, deflated,
+         delivery) = frame
+        conga = conga_from_id(self.conga_id)
+
+        if msg_id is None and delivery == BROADCAST:
+            self._broadcast(payload[:extra_length],
+                            payload[extra_length:], deflated)
+            return
+
+        if msg_id is None:
+            # New message. Stamp it with an ID, and with who sent it.
+            msg_id = conga.new_message(self.participant_id)
+            origin_id = self.participant_id
+
+            if conga.stateless_loops:
+                hops_left = len(conga.participants) - 1
+
+            conga.replay.record(int(msg_id), origin_id,
+                                payload[:extra_length],
+                                payload[extra_length:], deflated)
+
+        loop_origin = None
+        loop_hops = None
+
+        if conga.stateless_loops and origin_id is not None:
+            # Each hop uses up one of the remaining hops.
+            loop_origin = origin_id
+            loop_hops = hops_left or 0
+            hops_left = loop_hops - 1
+
+        if deflated and self.destination.compression != DEFLATE:
+            # The next participant can't read the body as it is.
+            body = self._inflate(payload[extra_length:])
+            if body is None:
+                return
+
+            payload = payload[:extra_length] + body
+            length, deflated = len(body), False
+
+        onward = self.destination.delivery
+
+        if self.destination.protocol == BINARY:
+            # Binary to binary: only the fixed header changes.
+            header = pack_frame('MSG', extra_length, length, msg_id,
+                                origin_id, hops_left, deflated, onward)
+            buffers = _coalesce(header, payload)
+        else:
+            header = text_header(
+                'MSG', payload[:extra_length], length, msg_id,
+                origin_id, hops_left, deflated, onward
+            )
+            buffers = _coalesce(header, payload[extra_length:])
+
+        self._forward(buffers, msg_id, conga, loop_origin, loop_hops)
+
+    def _broadcast(self, extra, body, compressed):
+        """
+        Send a new message to everyone else in the conga in a single pass,
+        rather than round the ring, then tell the sender how many people it
+        went to. Everyone who reads the same format shares the same buffers.
+
+        The message is never outstanding, and in stateless mode has no hops
+        left, so stop_loop stops any copy a client sends back round anyway.
+        """
+        conga = conga_from_id(self.conga_id)
+        msg_id = conga.new_message(self.participant_id, broadcast=True)
+        conga.replay.record(int(msg_id), self.participant_id, extra, body,
+                            compressed)
+        hops = 0 if conga.stateless_loops else None
+
+        delivered = self._deliver_all(conga, extra, body, compressed, msg_id,
+                                      self.participant_id, hops)
+        if delivered is None:
+            return
+
+        self.deliver(_encode_message(
+            self.protocol, b'Delivered: %d\r\n' % delivered, b'', msg_id,
+            self.participant_id, hops, False, BROADCAST
+        ))
+
+    def _deliver_all(self, conga, extra, body, compressed, msg_id,
+                     sender_id, hops):
+        """
+        Deliver a broadcast message to everyone in the conga but us. Returns
+        how many people it went to, or None if the body wouldn't inflate
+        for those who can't read it compressed.
+        """
+        inflated = None
+        copies = {}
+        delivered = 0
+
+        for node in conga.participants:
+            person = node.participant
+            if person is self:
+                continue
+
+            deflated = compressed and person.compression == DEFLATE
+            key = (person.protocol, deflated)
 
             try:
-                msg_id = headers['Message-ID']
-                new_header_data = header_data
+                buffers = copies[key]
             except KeyError:
-                # New message. Get a message ID for it, and then add it to the
-                # header data.
-                msg_id = conga.new_message(self.participant_id)
-                new_header_data = header_data[:-2]
-                new_header_data += 'Message-ID: %s\r\n\r\n' % (msg_id)
+                data = body
+                if compressed and not deflated:
+                    # They can't read the body as it is.
+                    if inflated is None:
+                        inflated = self._inflate(body)
+                        if inflated is None:
+                            return None
+                    data = inflated
 
-            dest_id = 0
+                buffers = copies[key] = _encode_message(
+                    person.protocol, extra, data, msg_id, sender_id, hops,
+                    deflated, BROADCAST
+                )
 
-            try:
-                dest_id = self.destination.participant_id
-                self.destination.write(new_header_data + data, msg_id, conga)
-            except StreamClosedError:
-                if self.destination.state != CLOSING:
-                    # Unexpected closure. BYE logic has already been run by
-                    # the decorator on write, so log and move on with our
-                    # lives.
-                    logging.error(
-                        "Unexpected close by participant %d" % dest_id
-                    )
-
-        return callback
+            person.deliver(buffers)
+            delivered += 1
+
+        return delivered
+
+    @bye_on_error
+    def _replay(self, headers, data):
+        """
+        Called on receipt of a REPLAY. Sends every message kept since the
+        Message-ID or Since header from the conga's replay buffer, apart
+        from our own, then a REPLAY saying how many there were.
+        """
+        conga = conga_from_id(self.conga_id)
+
+        try:
+            if 'Message-ID' in headers:
+                messages, complete = conga.replay.since_id(
+                    int(headers['Message-ID'])
+                )
+            else:
+                messages, complete = conga.replay.since_time(
+                    float(headers.get('Since', '0'))
+                )
+        except ValueError, e:
+            logging.error(
+                "Bad REPLAY from participant %s: %s", self.participant_id, e
+            )
+            messages, complete = [], False
+
+        replayed = 0
+
+        for msg_id, _, sender_id, extra, body, compressed in messages:
+            if sender_id == self.participant_id:
+                continue
+
+            deflated = compressed and self.compression == DEFLATE
+            if compressed and not deflated:
+                body = self._inflate(body)
+                if body is None:
+                    continue
+
+            self.deliver(_encode_message(
+                self.protocol, extra, body, str(msg_id), sender_id, None,
+                deflated, BROADCAST
+            ))
+            replayed += 1
+
+        metrics.messages_replayed += replayed
+
+        answer = b'Replayed: %d\r\n' % replayed
+        if not complete:
+            answer += b'Truncated: yes\r\n'
+
+        if self.protocol == BINARY:
+            self.deliver([pack_frame('REPLAY', len(answer), 0) + answer])
+        else:
+            self.deliver([text_header('REPLAY', answer, 0)])
+
+    def _replay_frame(self, frame, payload):
+        """
+        The binary counterpart to _replay. Called with the extra headers of
+        a REPLAY frame, once they have been read.
+        """
+        _, headers = _split_headers(b'REPLAY\r\n' + payload[:frame[1]])
+        if frame[3] is not None:
+            headers['Message-ID'] = frame[3]
+
+        self._replay(headers, b'')
+
+    @bye_on_error
+    def _express(self, buffers):
+        """
+        Pass on a message we've been sent, exactly as if our client had sent
+        it back to us. Only used for participants with express delivery.
+        """
+        if self.state not in (UP, HELD) or self.destination is None:
+            return
+
+        if self.protocol == BINARY:
+            if len(buffers) == 2 and len(buffers[0]) == FRAME.size:
+                header, payload = buffers
+            else:
+                data = b''.join(buffers)
+                header, payload = data[:FRAME.size], data[FRAME.size:]
+
+            self._repeat_frame(unpack_frame(header), payload)
+        else:
+            if len(buffers) == 2:
+                header_data, body = buffers
+            else:
+                end = buffers[0].index(b'\r\n\r\n') + 4
+                header_data, body = buffers[0][:end], buffers[0][end:]
+
+            _, headers = _split_headers(header_data)
+            self._repeat_data(header_data, headers, body)
+
+    def _inflate(self, body):
+        """
+        Inflate a compressed body for a participant who can't read it.
+        Returns None, having logged why, if the body won't inflate.
+        """
+        try:
+            return inflate(body)
+        except (ValueError, zlib.error), e:
+            logging.error(
+                "Dropping message from participant %s because of %s",
+                self.participant_id, e
+            )
+            return None
+
+    def _forward(self, buffers, msg_id, conga, origin_id, hops):
+        """
+        Pass a message on to the next participant in the conga.
+        """
+        dest_id = 0
+
+        try:
+            dest_id = self.destination.participant_id
+            self.destination.write(buffers, msg_id, conga, origin_id, hops)
+        except StreamClosedError:
+            if self.destination.state != CLOSING:
+                # Unexpected closure. BYE logic has already been run by the
+                # decorator on write, so log and move on with our lives.
+                logging.error(
+                    "Unexpected close by participant %d", dest_id
+                )
+
+
+def _split_headers(header_data):
+    """
+    Turns a raw header block into the request URI and a dictionary of the
+    headers. The header data is left as raw bytes: we only need it decoded
+    to make sense of it, and we forward it byte-for-byte.
+    """
+    headers = {}
+
+    lines = header_data.split(b'\r\n')
+    request_uri = lines[0]
+
+    for line in lines[1:]:
+        if line:
+            key, val = line.split(':', 1)
+            headers[key] = val
+
+    return request_uri, headers
+
+
+def _frame_message(header_data, stamps, body):
+    """
+    Given the raw header block of a message, a list of (name, value) pairs
+    to set on it, and the raw body, returns the list of buffers to write to
+    send the message on.
+
+    Only the lines for the stamped headers are built afresh: the rest of the
+    header block is spliced around them, and the body is passed on as it was
+    read unless the whole message is small enough to send as one buffer.
+    """
+    if stamps:
+        header_data = b''.join(_splice_headers(header_data, stamps))
+
+    return _coalesce(header_data, body)
+
+
+def _encode_message(protocol, extra, body, message_id, sender_id, hops,
+                    compressed, delivery):
+    """
+    Returns the list of buffers to write to send a MSG built by the server
+    itself in the given format. extra is any headers that a binary frame
+    has no field for, as text lines.
+    """
+    if protocol == BINARY:
+        header = pack_frame('MSG', len(extra), len(body), message_id,
+                            sender_id, hops, compressed, delivery)
+        return _coalesce(header + extra, body)
+
+    header = text_header('MSG', extra, len(body), message_id, sender_id,
+                         hops, compressed, delivery)
+    return _coalesce(header, body)
+
+
+def _coalesce(header, body):
+    """
+    Returns the list of buffers to write to send a header and body: one
+    buffer if the message is short, otherwise the two as they are.
+    """
+    if len(header) + len(body) <= COALESCE_LIMIT:
+        return [header + body]
+
+    return [header, body]
+
+
+def _splice_headers(header_data, stamps):
+    """
+    Returns the raw header block as a list of segments with the stamped
+    headers set. A stamped header that is already present has just its line
+    replaced; the others are added at the end of the block. A header stamped
+    with None is removed.
+    """
+    cuts = []
+    additions = []
+
+    for name, value in stamps:
+        line = b'' if value is None else b'%s: %s\r\n' % (name, value)
+        start = header_data.find(b'\r\n%s:' % name)
+
+        if start == -1:
+            additions.append(line)
+        else:
+            start += 2
+            end = header_data.index(b'\r\n', start) + 2
+            cuts.append((start, end, line))
+
+    cuts.sort()
+    segments = []
+    position = 0
+
+    for start, end, line in cuts:
+        segments.append(header_data[position:start])
+        segments.append(line)
+        position = end
+
+    # Leave off the blank line that ends the block, then put it back after
+    # any new headers.
+    segments.append(header_data[position:-2])
+    segments.extend(additions)
+    segments.append(b'\r\n')
+
+    return segments
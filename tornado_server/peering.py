@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.peering
+~~~~~~~~~~~~~~~~~~~~~~
+
+Lets a conga span several servers. Each pair of servers keeps a single TCP
+connection, a link, open between them, which carries the traffic of every
+conga they share.
+
+Servers are numbered from 1, and each is told the address of every other.
+The lower numbered of each pair connects to the higher, and keeps trying
+until it gets through. Everything on a link is a binary frame, as described
+in framing.py, with the ID of the conga it's for in front of it:
+
+- HELLO, with the server's ID as the sender ID, which the other end answers
+  with a HELLO of its own.
+- JOIN when a server's first participant in a conga joins, and LEAVE when
+  its last leaves. Once a link is up, each end sends JOIN for every conga it
+  has participants in.
+- MSG for each message passed round a conga, or broadcast in it.
+
+In a conga with participants on other servers, one LinkParticipant stands
+in for all of them. It has participant ID 0, which puts it at the head of
+the ring. A message passed to it goes to the next server along with
+participants in the conga, in order of server ID, starting again from the
+lowest; a message arriving over a link is passed on from it. So a message
+goes through each server's participants in turn, and then back to the
+server it started on.
+
+Message IDs carry the ID of the server that gave them out in their top bits
+(see conga.py), so each server knows its own. Conga.stop_loop stops its own
+messages once they get back round to their senders, as usual. Messages from
+other servers are recorded as they arrive as though the LinkParticipant had
+sent them: they pass through every participant here, and are forgotten as
+they reach it again and are sent on to the next server.
+
+A broadcast goes over the link to every server with participants in the
+conga, each of which sends it to all of its own. The other servers count
+as a single delivery in what the sender is told.
+
+Loops are stopped with the outstanding message table, so links can't be
+used with stateless loops. Nor can they be used with several workers, or
+handed over to a new server process.
+"""
+import functools
+import logging
+import struct
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+
+from compression import DEFLATE
+from conga import conga_from_id, message_node
+from framing import BINARY, BROADCAST, FRAME, pack_frame, unpack_frame
+from metrics import metrics
+from participant import Participant, UP, CLOSING
+
+#: The participant ID of the LinkParticipant in each conga. No real
+#: participant has it, and it puts the LinkParticipant at the head of the
+#: ring.
+LINK_ID = 0
+
+#: What comes before each frame on a link: the ID of the conga it's for.
+CONGA_HEADER = struct.Struct('!Q')
+
+
+def parse_peers(spec):
+    """
+    Parses peers given like "2=10.0.0.2:9000,3=10.0.0.3:9000" into a
+    dictionary of (host, port) by server ID.
+    """
+    peers = {}
+
+    for item in spec.split(','):
+        if item.strip():
+            node_id, _, address = item.partition('=')
+            host, _, port = address.strip().rpartition(':')
+            peers[int(node_id)] = (host, int(port))
+
+    return peers
+
+
+class Peering(TCPServer):
+    """
+    This server's links to its peers, and which congas each of them has
+    participants in. Listens for links from peers with lower IDs, and makes
+    links to those with higher.
+    """
+    #: The seconds between attempts to connect to a peer that isn't linked.
+    retry_interval = 1.0
+
+    def __init__(self, node_id, peers):
+        TCPServer.__init__(self)
+
+        #: This server's ID.
+        self.node_id = node_id
+
+        #: The address of each peer, by server ID.
+        self.peers = peers
+
+        #: The link to each peer that is up, by server ID.
+        self.links = {}
+
+        #: The IDs of the other servers with participants in each conga, by
+        #: conga ID. Only servers we have a link to are counted.
+        self.presence = {}
+
+        # The LinkParticipant in each conga that has one.
+        self._stand_ins = {}
+
+        # The congas we've told our peers we have participants in.
+        self._announced = set()
+
+        # The peers we're waiting to connect to.
+        self._connecting = set()
+
+        self._retry = PeriodicCallback(self._connect_all,
+                                       self.retry_interval * 1000)
+
+    def connect(self):
+        """
+        Start making links to the peers with higher IDs than ours, and keep
+        making them whenever they go down.
+        """
+        self._connect_all()
+        self._retry.start()
+
+    def _connect_all(self):
+        for node_id, (host, port) in self.peers.items():
+            if node_id > self.node_id and node_id not in self.links and \
+                    node_id not in self._connecting:
+                self._connecting.add(node_id)
+                IOLoop.current().add_future(
+                    TCPClient().connect(host, port),
+                    functools.partial(self._connected, node_id)
+                )
+
+    def _connected(self, node_id, connecting):
+        self._connecting.discard(node_id)
+
+        try:
+            stream = connecting.result()
+        except (IOError, StreamClosedError), e:
+            logging.debug("Couldn't link to server %d: %s", node_id, e)
+            return
+
+        link = Link(stream, self, node_id)
+        link.send_verb('HELLO', sender_id=self.node_id)
+        link.read()
+
+    def handle_stream(self, stream, address):
+        """
+        Called with each link a peer makes to us. It isn't up until they say
+        HELLO.
+        """
+        Link(stream, self).read()
+
+    def received(self, link, conga_id, frame_data, frame, payload):
+        """
+        Handle a frame that has come in over a link.
+        """
+        verb = frame[0]
+
+        if not link.up:
+            self._hello(link, frame)
+        elif verb == 'MSG':
+            self._message(conga_id, frame_data, frame, payload)
+        elif verb == 'JOIN':
+            self.presence.setdefault(conga_id, set()).add(link.node_id)
+            self._update(conga_id)
+        elif verb == 'LEAVE':
+            self.presence.get(conga_id, set()).discard(link.node_id)
+            self._update(conga_id)
+        else:
+            logging.error("Unexpected verb %s from server %d.", verb,
+                          link.node_id)
+            link.close()
+
+    def _hello(self, link, frame):
+        """
+        Bring a link up once the other end has said HELLO. We expect a
+        HELLO in answer to our own from a peer we linked to, and a HELLO
+        from a peer with a lower ID than ours that linked to us, which we
+        answer.
+        """
+        verb, node_id = frame[0], frame[4]
+
+        if verb == 'HELLO' and link.node_id is None and \
+                node_id in self.peers and node_id < self.node_id:
+            link.node_id = node_id
+            link.send_verb('HELLO', sender_id=self.node_id)
+        elif verb != 'HELLO' or node_id != link.node_id:
+            logging.error("Bad HELLO %s from server %s.", verb, node_id)
+            link.close()
+            return
+
+        old = self.links.get(node_id)
+        if old is not None:
+            # The peer has linked again without our noticing the old link
+            # go down.
+            old.close()
+
+        link.up = True
+        self.links[node_id] = link
+        logging.info("Linked to server %d.", node_id)
+
+        for conga_id in self._announced:
+            link.send_verb('JOIN', conga_id)
+
+    def link_down(self, link):
+        """
+        Called when a link closes. The peer's participants are no longer in
+        any conga here.
+        """
+        if not link.up or self.links.get(link.node_id) is not link:
+            return
+
+        del self.links[link.node_id]
+        logging.error("Link to server %d went down.", link.node_id)
+
+        for conga_id, nodes in self.presence.items():
+            if link.node_id in nodes:
+                nodes.discard(link.node_id)
+                self._update(conga_id)
+
+    def changed(self, conga, participant_id):
+        """
+        Called by a conga whenever a participant joins or leaves it. Tells
+        our peers when the first participant here joins the conga, or the
+        last leaves.
+        """
+        if participant_id == LINK_ID:
+            return
+
+        conga_id = conga.conga_id
+        local = len(conga.participants) - (LINK_ID in conga.participants)
+
+        if local and conga_id not in self._announced:
+            self._announced.add(conga_id)
+            verb = 'JOIN'
+        elif not local and conga_id in self._announced:
+            self._announced.discard(conga_id)
+            verb = 'LEAVE'
+        else:
+            return
+
+        for link in self.links.values():
+            link.send_verb(verb, conga_id)
+
+        self._update(conga_id)
+
+    def _update(self, conga_id):
+        """
+        Put a LinkParticipant in a conga if it has participants both here
+        and on other servers, and take it out if not.
+        """
+        stand_in = self._stand_ins.get(conga_id)
+        wanted = conga_id in self._announced and self.presence.get(conga_id)
+
+        if wanted and stand_in is None:
+            stand_in = LinkParticipant(self, conga_id)
+            self._stand_ins[conga_id] = stand_in
+            conga_from_id(conga_id).join(stand_in, LINK_ID)
+        elif not wanted and stand_in is not None:
+            del self._stand_ins[conga_id]
+            stand_in.state = CLOSING
+            conga_from_id(conga_id).leave(stand_in, LINK_ID)
+
+        if conga_id in self.presence and not self.presence[conga_id]:
+            del self.presence[conga_id]
+
+    def _message(self, conga_id, frame_data, frame, payload):
+        """
+        Pass on a message that has come in over a link.
+        """
+        msg_id, delivery = frame[3], frame[7]
+
+        if msg_id is None:
+            logging.error("Dropping a message with no ID for conga %d.",
+                          conga_id)
+            return
+
+        mine = message_node(msg_id) == self.node_id
+        stand_in = self._stand_ins.get(conga_id)
+
+        if stand_in is None:
+            # Nobody here is in the conga any more. Let the message carry on
+            # to the next server, unless it started here.
+            if not mine and delivery != BROADCAST:
+                self.send_on(conga_id, [frame_data, payload])
+            return
+
+        if delivery == BROADCAST:
+            stand_in.broadcast(frame, payload)
+            return
+
+        if not mine:
+            conga_from_id(conga_id).track_message(msg_id, LINK_ID)
+
+        stand_in._repeat_frame(frame, payload)
+
+    def next_node(self, conga_id):
+        """
+        Returns the ID of the next server after this one with participants
+        in a conga, or None if there are none.
+        """
+        nodes = self.presence.get(conga_id)
+        if not nodes:
+            return None
+
+        later = [node_id for node_id in nodes if node_id > self.node_id]
+        return min(later or nodes)
+
+    def send_on(self, conga_id, buffers):
+        """
+        Send a message to the next server with participants in a conga.
+        """
+        node_id = self.next_node(conga_id)
+        if node_id is not None:
+            self.links[node_id].send(conga_id, buffers)
+
+    def send_all(self, conga_id, buffers):
+        """
+        Send a message to every other server with participants in a conga.
+        """
+        for node_id in self.presence.get(conga_id, ()):
+            self.links[node_id].send(conga_id, buffers)
+
+
+class Link(object):
+    """
+    One end of the connection between this server and a peer.
+    """
+    def __init__(self, stream, peering, node_id=None):
+        #: The IOStream to the peer.
+        self.stream = stream
+
+        #: The Peering this link belongs to.
+        self.peering = peering
+
+        #: The peer's server ID, once we know it.
+        self.node_id = node_id
+
+        #: Whether both ends have said HELLO.
+        self.up = False
+
+        stream.set_nodelay(True)
+        stream.set_close_callback(self._closed)
+
+    def send(self, conga_id, buffers):
+        """
+        Write a frame for a conga to the link. Servers keep up with one
+        another, so nothing is held back or dropped here.
+        """
+        try:
+            self.stream.write(CONGA_HEADER.pack(conga_id))
+            for data in buffers:
+                self.stream.write(data)
+        except StreamClosedError:
+            # We'll hear about it from the close callback.
+            pass
+
+    def send_verb(self, verb, conga_id=0, sender_id=None):
+        """
+        Write a frame with nothing but a verb, for a conga or for the link.
+        """
+        self.send(conga_id, [pack_frame(verb, 0, 0, sender_id=sender_id)])
+
+    def read(self):
+        """
+        Read the next frame from the peer.
+        """
+        try:
+            self.stream.read_bytes(CONGA_HEADER.size + FRAME.size,
+                                   self._parse_frame)
+        except StreamClosedError:
+            pass
+
+    def _parse_frame(self, data):
+        conga_id, = CONGA_HEADER.unpack_from(data)
+        frame_data = data[CONGA_HEADER.size:]
+        frame = unpack_frame(frame_data)
+
+        self.stream.read_bytes(frame[1] + frame[2], functools.partial(
+            self._handle, conga_id, frame_data, frame
+        ))
+
+    def _handle(self, conga_id, frame_data, frame, payload):
+        # A message that can't be handled is lost, but the link carries
+        # every other conga too, so it stays up.
+        try:
+            self.peering.received(self, conga_id, frame_data, frame, payload)
+        except Exception:
+            logging.exception("Dropping a frame from server %s.",
+                              self.node_id)
+
+        if not self.stream.closed():
+            self.read()
+
+    def close(self):
+        self.stream.close()
+
+    def _closed(self):
+        self.peering.link_down(self)
+
+
+class LinkParticipant(Participant):
+    """
+    Stands in, in one conga, for every participant in it on other servers.
+    Messages written to it go over a link rather than to a stream of its
+    own. It speaks binary frames, and takes bodies compressed, so that
+    messages cross links as they are.
+    """
+    __slots__ = ('peering',)
+
+    def __init__(self, peering, conga_id):
+        super(LinkParticipant, self).__init__(None, None)
+        self.state = UP
+        self.participant_id = LINK_ID
+        self.conga_id = conga_id
+        self.protocol = BINARY
+        self.compression = DEFLATE
+
+        #: The Peering whose links we send over.
+        self.peering = peering
+
+    def _opened(self):
+        """
+        There's no connection of our own to count, nor a HELLO to wait for.
+        """
+
+    def write(self, buffers, message_id, conga, origin_id=None,
+              hops_remaining=None):
+        """
+        Send a message on to the next server. A message from this server is
+        stopped if its sender has gone. One from another server is always
+        sent on, and forgotten here.
+        """
+        stopped = conga.stop_loop(message_id, LINK_ID)
+        if stopped and message_node(message_id) == self.peering.node_id:
+            return
+
+        self.deliver(buffers)
+
+    def deliver(self, buffers):
+        """
+        Send a message over the link to the next server, or to every server
+        if it's a broadcast.
+        """
+        size = 0
+        for data in buffers:
+            size += len(data)
+
+        metrics.messages_forwarded += 1
+        metrics.bytes_forwarded += size
+
+        if unpack_frame(buffers[0][:FRAME.size])[7] == BROADCAST:
+            self.peering.send_all(self.conga_id, buffers)
+        else:
+            self.peering.send_on(self.conga_id, buffers)
+
+    def broadcast(self, frame, payload):
+        """
+        Deliver a broadcast from another server to everyone here.
+        """
+        extra_length = frame[1]
+        self._deliver_all(
+            conga_from_id(self.conga_id), payload[:extra_length],
+            payload[extra_length:], frame[6], frame[3], frame[4], None
+        )
+
+    def _bye(self, data=b''):
+        """
+        There's no connection of our own to close. We leave the conga only
+        when nobody is left in it here, or on any other server.
+        """
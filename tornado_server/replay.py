@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.replay
+~~~~~~~~~~~~~~~~~~~~~
+
+Keeps the most recent messages sent in each conga, so that a participant
+who drops out and rejoins can catch up on what went round without them.
+
+Once it has rejoined, the participant sends a REPLAY, with a Message-ID
+header to ask for every message after that one, or a Since header to ask
+for every message since that Unix time. The server sends each from memory,
+marked for broadcast delivery so that nobody passes it on, and then answers
+with a REPLAY of its own saying how many it sent in a Replayed header. If
+the buffer no longer reaches back that far, the answer also has a
+"Truncated: yes" header.
+"""
+import time
+from collections import deque
+
+
+class ReplayBuffer(object):
+    """
+    The newest messages sent in one conga, oldest first: no more than
+    max_messages of them, and no more than max_bytes of headers and bodies
+    between them. Older messages are dropped to make room.
+
+    Each message is kept as it was first sent, with the headers that a
+    binary frame has no field for as text lines, so it can be sent in
+    either format.
+    """
+    def __init__(self, max_messages=100, max_bytes=64 * 1024):
+        #: The most messages to keep.
+        self.max_messages = max_messages
+
+        #: The most bytes of headers and bodies to keep.
+        self.max_bytes = max_bytes
+
+        #: The bytes of headers and bodies kept.
+        self.bytes = 0
+
+        # The messages kept: tuples of (message ID, time sent, sender ID,
+        # extra headers, body, whether the body is compressed).
+        self._messages = deque()
+
+        # The ID and time sent of the newest message dropped, so we can tell
+        # whether a request reaches back past what we have.
+        self._dropped_id = 0
+        self._dropped_time = 0.0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def record(self, message_id, sender_id, extra, body, compressed,
+               now=None):
+        """
+        Keep a new message. Message IDs must be numbers, in the order the
+        messages were sent.
+        """
+        if now is None:
+            now = time.time()
+
+        size = len(extra) + len(body)
+
+        if size > self.max_bytes or not self.max_messages:
+            # We can't keep this one at all.
+            self.lost(message_id, now)
+            return
+
+        self._messages.append(
+            (message_id, now, sender_id, extra, body, compressed)
+        )
+        self.bytes += size
+
+        while len(self._messages) > self.max_messages or \
+                self.bytes > self.max_bytes:
+            dropped = self._messages.popleft()
+            self.bytes -= len(dropped[3]) + len(dropped[4])
+            self.lost(*dropped[:2])
+
+    def since_id(self, message_id):
+        """
+        Returns the messages kept that were sent after the one with the given
+        ID, oldest first, and whether they are all there were.
+        """
+        return (self._newest(lambda message: message[0] > message_id),
+                message_id >= self._dropped_id)
+
+    def since_time(self, when):
+        """
+        Returns the messages kept that were sent at or after the given Unix
+        time, oldest first, and whether they are all there were.
+        """
+        return (self._newest(lambda message: message[1] >= when),
+                when > self._dropped_time)
+
+    def _newest(self, wanted):
+        """
+        Returns the newest messages for which wanted is true, stopping at the
+        first for which it isn't. Catching up usually only goes back a
+        little way, so this starts from the newest.
+        """
+        found = []
+
+        for message in reversed(self._messages):
+            if not wanted(message):
+                break
+            found.append(message)
+
+        found.reverse()
+        return found
+
+    def clear(self):
+        """
+        Forget every message, as if they had all been dropped.
+        """
+        if self._messages:
+            self.lost(*self._messages[-1][:2])
+
+        self._messages.clear()
+        self.bytes = 0
+
+    def lost(self, message_id, now=None):
+        """
+        Note that messages up to the one with the given ID, sent up to now,
+        went round without being kept here, as when taking over from
+        another server process.
+        """
+        self._dropped_id = max(self._dropped_id, message_id)
+        self._dropped_time = max(self._dropped_time,
+                                 time.time() if now is None else now)
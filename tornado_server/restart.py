@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.restart
+~~~~~~~~~~~~~~~~~~~~~~
+
+Lets a new server process take over from a running one without dropping a
+single connection, so that a deploy doesn't send every client back through
+the DB to rejoin.
+
+The running server listens on a Unix socket. A new server started with the
+same path connects to it, and the old one then:
+
+- stops accepting connections;
+- lets every participant finish reading the message they're part way
+  through, but not start another;
+- writes a snapshot of every conga to a file: the ring order, the
+  outstanding message table and the counters, with each participant's
+  negotiated settings;
+- passes the new process its listening sockets, and then every
+  participant's connection, along with anything read from it but not yet
+  handled and anything written to it but not yet sent;
+- and exits.
+
+The new process reads the snapshot, puts every participant back in its
+conga, and carries on from exactly where the old one stopped. Connections
+still saying HELLO are closed instead: they haven't joined anything yet, and
+their clients just connect again. So are the places of participants held
+for resuming (see resume.py): their clients' tokens are no good to the new
+process, so they join again as usual.
+"""
+import errno
+import json
+import logging
+import os
+import socket
+import struct
+import zlib
+
+from _multiprocessing import sendfd, recvfd
+from tornado.ioloop import IOLoop, PeriodicCallback
+from conga import congas, conga_from_id
+from metrics import metrics
+from participant import Participant, UP, HELD
+from sharding import (check_tornado, detach_stream, attach_stream,
+                      unsent_data, _recv_exactly)
+from timers import monotonic
+
+#: The version of the snapshot format.
+SNAPSHOT_VERSION = 1
+
+#: The header of a handover: the number of listening sockets, then the
+#: number of connections.
+_HANDOVER = struct.Struct('!II')
+
+#: Sent after each listening socket: its address family.
+_LISTENER = struct.Struct('!B')
+
+#: The header on each connection: the participant ID, the socket's address
+#: family, then the lengths of the data read and not handled and of the data
+#: not yet sent.
+_CONNECTION = struct.Struct('!QBII')
+
+
+def save_snapshot(path):
+    """
+    Write a snapshot of every conga with participants to path, compressed.
+    The file is replaced in one go, so a reader never sees half of it.
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'congas': [conga.snapshot() for conga in congas()
+                   if conga.participants],
+    }
+
+    data = zlib.compress(json.dumps(snapshot, separators=(',', ':')))
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.rename(temporary, path)
+
+    return snapshot
+
+
+def load_snapshot(path):
+    """
+    Read a snapshot written by save_snapshot.
+    """
+    with open(path, 'rb') as f:
+        snapshot = json.loads(zlib.decompress(f.read()))
+
+    if snapshot['version'] != SNAPSHOT_VERSION:
+        raise ValueError("Unknown snapshot version %s." % snapshot['version'])
+
+    return snapshot
+
+
+class Handover(object):
+    """
+    Waits on a Unix socket for a new server process, then hands it
+    everything. Only for a server running as a single worker.
+
+    A connection is only handed over between messages. Once the new process
+    connects, participants stop reading new messages, and the handover
+    waits for them to finish the ones they're part way through.
+    """
+    #: The most seconds to wait for participants to finish the messages
+    #: they're reading. Anyone still part way through one is then dropped
+    #: rather than handed over, and their client joins again.
+    drain_timeout = 2.0
+
+    def __init__(self, path, snapshot_path, proxy, metrics_server=None):
+        #: The path of the Unix socket.
+        self.path = path
+
+        #: Where to write the snapshot for the new process.
+        self.snapshot_path = snapshot_path
+
+        #: The TCPProxy whose listening sockets are handed over.
+        self.proxy = proxy
+
+        #: The HTTPServer serving metrics, if any, which is stopped to free
+        #: its port for the new process.
+        self.metrics_server = metrics_server
+
+        self._sock = None
+        self._conn = None
+        self._listeners = None
+        self._deadline = None
+        self._poller = None
+
+    def listen(self):
+        """
+        Start waiting for a new server process. Must be called once the
+        IOLoop exists.
+        """
+        check_tornado()
+
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(1)
+        IOLoop.current().add_handler(self._sock.fileno(), self._accept,
+                                     IOLoop.READ)
+
+    def _accept(self, fd, events):
+        conn, _ = self._sock.accept()
+        conn.setblocking(True)
+
+        IOLoop.current().remove_handler(self._sock.fileno())
+        self._sock.close()
+
+        # Stop accepting, keeping copies of the listening sockets to send,
+        # and stop reading new messages.
+        self._conn = conn
+        self._listeners = [(os.dup(sock.fileno()), sock.family)
+                           for sock in self.proxy._sockets.values()]
+        self.proxy.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        Participant.paused = True
+
+        self._deadline = monotonic() + self.drain_timeout
+        self._poller = PeriodicCallback(self._drained, 10)
+        self._poller.start()
+        self._drained()
+
+    def _drained(self):
+        """
+        Hand over once nobody is part way through reading a message, or the
+        drain timeout is up.
+        """
+        if self._poller is None:
+            return
+
+        reading = any(participant.mid_message
+                      for participant in metrics.participants)
+        if reading and monotonic() < self._deadline:
+            return
+
+        self._poller.stop()
+        self._poller = None
+
+        try:
+            self.hand_over(self._conn, self._listeners)
+        finally:
+            self._conn.close()
+            IOLoop.current().stop()
+
+    def hand_over(self, conn, listeners):
+        """
+        Hand every connection to the new process on the other end of conn,
+        along with the given listening sockets, as (descriptor, family)
+        pairs. Everything happens in this one call, so no message can arrive
+        part way through.
+        """
+        start = monotonic()
+
+        # Nobody who hasn't joined a conga is handed over, nor anyone still
+        # part way through a message, whose connection the new process
+        # couldn't make sense of.
+        for participant in list(metrics.participants):
+            if participant.participant_id is None:
+                participant.source_stream.close()
+            elif participant.mid_message and participant.state == UP:
+                logging.error(
+                    "Participant %s is part way through a message. Dropping "
+                    "them rather than handing them over.",
+                    participant.participant_id
+                )
+                participant.source_stream.close()
+
+        snapshot = save_snapshot(self.snapshot_path)
+
+        connections = []
+        for conga in congas():
+            for node in conga.participants:
+                if node.participant.state == HELD or \
+                        node.participant.source_stream.closed():
+                    continue
+
+                stream = node.participant.source_stream
+                unsent = unsent_data(stream)
+                unsent += b''.join(
+                    b''.join(buffers) for (buffers, _) in
+                    node.participant.backlog
+                )
+                fd, family, buffered = detach_stream(stream)
+                connections.append(
+                    (node.participant_id, fd, family, buffered, unsent)
+                )
+
+        try:
+            conn.sendall(_HANDOVER.pack(len(listeners), len(connections)))
+            for fd, family in listeners:
+                sendfd(conn.fileno(), fd)
+                conn.sendall(_LISTENER.pack(family))
+
+            for participant_id, fd, family, buffered, unsent in connections:
+                sendfd(conn.fileno(), fd)
+                conn.sendall(
+                    _CONNECTION.pack(participant_id, family, len(buffered),
+                                     len(unsent)) + buffered + unsent
+                )
+        finally:
+            for fd, _ in listeners:
+                os.close(fd)
+            for _, fd, _, _, _ in connections:
+                os.close(fd)
+
+        logging.info(
+            "Handed %d connections in %d congas to a new process in %.1fms.",
+            len(connections), len(snapshot['congas']),
+            (monotonic() - start) * 1e3
+        )
+
+
+def take_over(path, snapshot_path, proxy):
+    """
+    Take over from the server process waiting on the Unix socket at path,
+    if there is one. Its listening sockets are added to the proxy, and its
+    participants resumed in their congas. Returns whether there was a
+    process to take over from.
+    """
+    check_tornado()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            sock.close()
+            return False
+        raise
+
+    start = monotonic()
+
+    try:
+        listener_count, connection_count = _HANDOVER.unpack(
+            _recv_exactly(sock, _HANDOVER.size)
+        )
+
+        listeners = []
+        for _ in xrange(listener_count):
+            fd = recvfd(sock.fileno())
+            family, = _LISTENER.unpack(_recv_exactly(sock, _LISTENER.size))
+            listeners.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+            os.close(fd)
+
+        connections = {}
+        for _ in xrange(connection_count):
+            fd = recvfd(sock.fileno())
+            participant_id, family, buffered_len, unsent_len = \
+                _CONNECTION.unpack(_recv_exactly(sock, _CONNECTION.size))
+            connections[participant_id] = (
+                fd, family, _recv_exactly(sock, buffered_len),
+                _recv_exactly(sock, unsent_len)
+            )
+    finally:
+        sock.close()
+
+    for listener in listeners:
+        listener.setblocking(False)
+    proxy.add_sockets(listeners)
+
+    # The snapshot only goes with these connections, so never use it again.
+    snapshot = load_snapshot(snapshot_path)
+    os.unlink(snapshot_path)
+    resumed = 0
+
+    for state in snapshot['congas']:
+        conga_from_id(state['conga_id']).restore(state)
+
+        for participant in state['participants']:
+            try:
+                fd, family, buffered, unsent = connections.pop(
+                    participant['participant_id']
+                )
+            except KeyError:
+                continue
+
+            proxy.resume_stream(attach_stream(fd, family, buffered),
+                                participant, state['conga_id'], unsent)
+            resumed += 1
+
+    # Anything not in the snapshot has nowhere to go.
+    for fd, _, _, _ in connections.values():
+        os.close(fd)
+
+    logging.info(
+        "Took over %d connections in %d congas in %.1fms.",
+        resumed, len(snapshot['congas']), (monotonic() - start) * 1e3
+    )
+    return True
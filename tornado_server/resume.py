@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.resume
+~~~~~~~~~~~~~~~~~~~~~
+
+Lets a participant whose connection drops take their place in the conga
+back on a new connection, without leaving and joining again.
+
+A client that sends "Resume: yes" on HELLO is given a token in a
+Resume-Token header on the server's answering HELLO. If its connection then
+closes without a BYE, the participant stays in the conga, held, for a grace
+period, and messages sent to them wait in their backlog. A HELLO on a new
+connection with the same User-ID and the token picks up the held
+participant, without going to the database: the server answers with a
+HELLO saying "Resumed: yes", then sends everything that was waiting. Once
+the grace period is up, or after a BYE, the token is no good.
+
+The participant keeps what it agreed to on its first HELLO, whatever the
+HELLO it resumes with asks for, and keeps its token for the next time.
+"""
+import binascii
+import os
+
+#: The participant each token was given to.
+_tokens = {}
+
+
+def issue(participant):
+    """
+    Returns a new token for a participant.
+    """
+    token = binascii.hexlify(os.urandom(16))
+    _tokens[token] = participant
+    return token
+
+
+def register(token, participant):
+    """
+    Honour a token given out by another server process.
+    """
+    _tokens[token] = participant
+
+
+def claim(token, participant_id):
+    """
+    Returns the participant a token was given to, if they have the given
+    participant ID, or None.
+    """
+    participant = _tokens.get(token)
+
+    if participant is None or participant.participant_id != participant_id:
+        return None
+
+    return participant
+
+
+def revoke(token):
+    """
+    Stop honouring a token.
+    """
+    _tokens.pop(token, None)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.ring
+~~~~~~~~~~~~~~~~~~~
+
+Provides the ordered ring structure that holds the participants of a single
+Conga. The ring is kept sorted by participant ID using a skip list, so that
+finding the place for a new participant costs O(log n). Every entry is also
+doubly linked to its neighbours in ring order, and indexed by participant ID,
+so that neighbour lookup and membership checks are O(1).
+"""
+import random
+
+
+#: The maximum height of the skip list. Good for far more participants than
+#: any conga will ever have.
+MAX_LEVEL = 32
+
+#: The probability of a node being promoted to the next level up.
+PROMOTE_PROBABILITY = 0.25
+
+
+class RingNode(object):
+    """
+    A single entry in the ring. Holds the participant and its ID, along with
+    links to the previous and next entries in ring order. The ring wraps, so
+    the last participant's ``next`` is the first participant, and a lone
+    participant is its own neighbour.
+    """
+    __slots__ = ('participant_id', 'participant', 'prev', 'next', 'forward')
+
+    def __init__(self, participant_id, participant, level):
+        #: The ID used to order this participant in the ring.
+        self.participant_id = participant_id
+
+        #: The participant object itself.
+        self.participant = participant
+
+        #: The neighbouring entries in ring order.
+        self.prev = None
+        self.next = None
+
+        #: The skip list forward pointers, one per level. These do not wrap:
+        #: the last entry on each level points at None.
+        self.forward = [None] * level
+
+
+class Ring(object):
+    """
+    An ordered ring of participants, keyed by participant ID. Supports
+    insertion and removal in O(log n), and lookup by ID in O(1).
+    """
+    def __init__(self):
+        #: The sentinel head of the skip list. It holds no participant.
+        self._head = RingNode(None, None, MAX_LEVEL)
+
+        #: The number of levels currently in use.
+        self._level = 1
+
+        #: A map of participant ID to ring entry.
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, participant_id):
+        return participant_id in self._nodes
+
+    def __iter__(self):
+        """
+        Iterates over the ring entries in ring order, starting with the entry
+        that has the lowest participant ID.
+        """
+        node = self._head.forward[0]
+
+        while node is not None:
+            yield node
+            node = node.forward[0]
+
+    def get(self, participant_id):
+        """
+        Returns the ring entry for a given participant ID, or None if that
+        participant is not in the ring.
+        """
+        return self._nodes.get(participant_id)
+
+    def insert(self, participant_id, participant):
+        """
+        Add a participant to the ring in participant ID order. Returns the new
+        ring entry, whose ``prev`` and ``next`` are its new neighbours. Raises
+        KeyError if the participant ID is already in the ring.
+        """
+        if participant_id in self._nodes:
+            raise KeyError(participant_id)
+
+        update = self._predecessors(participant_id)
+        level = self._random_level()
+
+        if level > self._level:
+            for i in range(self._level, level):
+                update[i] = self._head
+            self._level = level
+
+        node = RingNode(participant_id, participant, level)
+
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+
+        # Now thread the new entry into the circular neighbour links.
+        if not self._nodes:
+            node.prev = node
+            node.next = node
+        else:
+            successor = node.forward[0] or self._head.forward[0]
+            node.prev = successor.prev
+            node.next = successor
+            successor.prev.next = node
+            successor.prev = node
+
+        self._nodes[participant_id] = node
+        return node
+
+    def remove(self, participant_id):
+        """
+        Remove a participant from the ring. Returns the removed ring entry,
+        which still points at its old neighbours. Raises KeyError if the
+        participant ID is not in the ring.
+        """
+        node = self._nodes.pop(participant_id)
+        update = self._predecessors(participant_id)
+
+        for i in range(len(node.forward)):
+            if update[i].forward[i] is node:
+                update[i].forward[i] = node.forward[i]
+
+        while self._level > 1 and self._head.forward[self._level - 1] is None:
+            self._level -= 1
+
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+        return node
+
+    def _predecessors(self, participant_id):
+        """
+        Walk the skip list looking for participant_id. Returns a list holding,
+        for each level, the last entry whose ID is lower than participant_id.
+        """
+        update = [self._head] * MAX_LEVEL
+        node = self._head
+
+        for i in range(self._level - 1, -1, -1):
+            while (node.forward[i] is not None and
+                   node.forward[i].participant_id < participant_id):
+                node = node.forward[i]
+            update[i] = node
+
+        return update
+
+    def _random_level(self):
+        """
+        Pick a height for a new skip list entry.
+        """
+        level = 1
+
+        while level < MAX_LEVEL and random.random() < PROMOTE_PROBABILITY:
+            level += 1
+
+        return level
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.sharding
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Lets the Tornado server run as several worker processes sharing a single
+listening socket. Every conga is owned by exactly one worker, so that ring
+forwarding never has to cross between processes. A connection that lands on
+the wrong worker is handed to the owning worker after its HELLO, by passing
+the socket's file descriptor over a Unix socket along with everything read
+from it so far.
+
+Nothing in Tornado's public API can hand over a connection along with what
+its IOStream has buffered, so detach_stream, attach_stream and unsent_data
+reach into IOStream's private buffers. check_tornado checks they are laid
+out as expected, so that a Tornado release that changes them fails loudly
+at startup rather than corrupting connections.
+"""
+import collections
+import errno
+import functools
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import zlib
+
+import tornado
+from _multiprocessing import sendfd, recvfd
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+
+#: The header on each handoff record: the conga ID, the socket's address
+#: family, then the lengths of the HELLO header block and of the data read
+#: after it.
+_RECORD = struct.Struct('!QBII')
+
+
+def check_tornado():
+    """
+    Raise RuntimeError unless IOStream keeps its buffers the way
+    detach_stream, attach_stream and unsent_data expect: as deques of chunks
+    before Tornado 4.5, and as bytearrays with a start position and size
+    from then on. The IOStream it checks uses the current IOLoop, so don't
+    call this before forking.
+    """
+    ends = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    stream = IOStream(ends[0])
+
+    try:
+        for name in ('_read_buffer', '_write_buffer'):
+            buf = getattr(stream, name, None)
+
+            if isinstance(buf, collections.deque):
+                continue
+
+            if not isinstance(buf, bytearray) or not all(
+                    isinstance(getattr(stream, name + suffix, None), int)
+                    for suffix in ('_pos', '_size')):
+                raise RuntimeError(
+                    "Can't pass connections between processes with Tornado "
+                    "%s: IOStream.%s isn't laid out as expected." %
+                    (tornado.version, name)
+                )
+    finally:
+        stream.close()
+        ends[1].close()
+
+
+def detach_stream(stream):
+    """
+    Take the socket out from under an IOStream. Returns a duplicate of the
+    socket's file descriptor, the socket's address family, and any bytes
+    the stream had read but not yet handed out. The stream itself is
+    closed.
+    """
+    fd = os.dup(stream.socket.fileno())
+    family = stream.socket.family
+    buffered = _read_buffer(stream)
+
+    # The connection lives on, so nobody should hear that it closed.
+    stream.set_close_callback(None)
+    stream.close()
+    return fd, family, buffered
+
+
+def attach_stream(fd, family, buffered=b''):
+    """
+    Wrap a file descriptor for a socket of the given address family,
+    received from another process, in a new IOStream, as though the given
+    bytes had already been read from it. The stream takes ownership of the
+    descriptor.
+    """
+    sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+    os.close(fd)
+
+    stream = IOStream(sock)
+
+    if buffered:
+        # IOStream has no public way to put data back, so prime the read
+        # buffer directly. Tornado before 4.5 keeps it as a deque of chunks.
+        if isinstance(stream._read_buffer, collections.deque):
+            stream._read_buffer.append(buffered)
+        else:
+            stream._read_buffer += buffered
+        stream._read_buffer_size += len(buffered)
+
+    return stream
+
+
+def _read_buffer(stream):
+    """
+    Returns a copy of the data waiting in an IOStream's read buffer.
+    """
+    buf = stream._read_buffer
+
+    if isinstance(buf, collections.deque):
+        return b''.join(buf)
+
+    start = getattr(stream, '_read_buffer_pos', 0)
+    return bytes(buf[start:start + stream._read_buffer_size])
+
+
+def unsent_data(stream):
+    """
+    Returns a copy of the data written to an IOStream that it hasn't yet
+    managed to send.
+    """
+    buf = stream._write_buffer
+
+    if isinstance(buf, collections.deque):
+        return b''.join(buf)
+
+    start = stream._write_buffer_pos
+    return bytes(buf[start:start + stream._write_buffer_size])
+
+
+def fork_workers(count):
+    """
+    Fork count worker processes. Returns the worker ID, from 0 to count - 1,
+    in each worker. The parent process never returns: it passes SIGINT and
+    SIGTERM on to the workers, and exits once they all have.
+    """
+    children = set()
+
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            return worker_id
+        children.add(pid)
+
+    def forward_signal(sig, frame):
+        for pid in children:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        children.discard(pid)
+        logging.info("Worker %d exited with status %d.", pid, status)
+
+    sys.exit(0)
+
+
+class ShardRouter(object):
+    """
+    Routes connections to the worker that owns their conga. Create one in
+    the parent process before forking, then have each worker call bind with
+    its worker ID.
+
+    Each worker has its own Unix socket to each other worker, so records
+    from different workers can't interleave, and nobody needs a lock to
+    send. Both ends are non-blocking: records waiting to go out are queued,
+    and sent whenever the IOLoop says there's room, while records coming in
+    are put back together as their pieces arrive. No worker ever waits on
+    another, so two workers handing connections to each other can't
+    deadlock however full their sockets get.
+    """
+    def __init__(self, workers):
+        #: The number of worker processes.
+        self.workers = workers
+
+        #: The ID of the worker this process is, once bound.
+        self.worker_id = None
+
+        #: A Unix socket pair from each worker to each other worker, indexed
+        #: by sender then owner. The sender writes to the first socket in a
+        #: pair, and the owner reads from the second.
+        self._channels = [
+            [socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+             if sender != owner else None
+             for owner in range(workers)]
+            for sender in range(workers)
+        ]
+
+        #: Records waiting to go to each owner, as [file descriptor, data]
+        #: pairs. The descriptor is None once it has been sent.
+        self._outgoing = [collections.deque() for _ in range(workers)]
+
+        #: The incoming records being put back together, by the file
+        #: descriptor of the socket they arrive on.
+        self._incoming = {}
+
+        #: Called with (stream, hello_data, conga_id) for each connection
+        #: handed to this worker.
+        self._on_adopt = None
+
+    def owner(self, conga_id):
+        """
+        Returns the ID of the worker that owns a conga.
+        """
+        return (zlib.crc32(str(conga_id)) & 0xffffffff) % self.workers
+
+    def owns(self, conga_id):
+        """
+        Whether this worker owns a conga.
+        """
+        return self.owner(conga_id) == self.worker_id
+
+    def bind(self, worker_id, on_adopt):
+        """
+        Start receiving handed-off connections for this worker. Must be
+        called from the worker process after forking, and after the IOLoop
+        exists.
+        """
+        check_tornado()
+
+        self.worker_id = worker_id
+        self._on_adopt = on_adopt
+
+        for sender in range(self.workers):
+            if sender == worker_id:
+                continue
+
+            self._channels[worker_id][sender][0].setblocking(False)
+
+            inbox = self._channels[sender][worker_id][1]
+            inbox.setblocking(False)
+            self._incoming[inbox.fileno()] = _Incoming(inbox)
+            IOLoop.instance().add_handler(inbox.fileno(), self._receive,
+                                          IOLoop.READ)
+
+    def hand_off(self, stream, hello_data, conga_id):
+        """
+        Pass a connection to the worker that owns its conga. hello_data is
+        the raw header block of the connection's HELLO, so that the owner
+        can complete the registration. The connection is queued, and sent
+        as soon as the owner has room for it.
+        """
+        owner = self.owner(conga_id)
+        fd, family, buffered = detach_stream(stream)
+
+        record = _RECORD.pack(conga_id, family, len(hello_data),
+                              len(buffered))
+        queue = self._outgoing[owner]
+        queue.append([fd, record + hello_data + buffered])
+
+        # If earlier records are still waiting, the IOLoop will send this
+        # one after them.
+        if len(queue) == 1:
+            self._send(owner)
+
+        logging.info(
+            "Handed connection for conga %s to worker %d.", conga_id, owner
+        )
+
+    def _send(self, owner, fd=None, events=None):
+        """
+        Send as much as an owner's socket will take of the records queued
+        for it, and have the IOLoop call again when it can take the rest.
+        """
+        queue = self._outgoing[owner]
+        outbox = self._channels[self.worker_id][owner][0]
+
+        try:
+            while queue:
+                record = queue[0]
+
+                # The descriptor goes first, so the owner knows a new record
+                # has started.
+                if record[0] is not None:
+                    sendfd(outbox.fileno(), record[0])
+                    os.close(record[0])
+                    record[0] = None
+
+                sent = outbox.send(record[1])
+                record[1] = record[1][sent:]
+
+                if not record[1]:
+                    queue.popleft()
+        except (OSError, socket.error), e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                               errno.EINTR):
+                raise
+
+        if fd is None and queue:
+            IOLoop.instance().add_handler(
+                outbox.fileno(), functools.partial(self._send, owner),
+                IOLoop.WRITE
+            )
+        elif fd is not None and not queue:
+            IOLoop.instance().remove_handler(outbox.fileno())
+
+    def _receive(self, fd, events):
+        """
+        Called by the IOLoop when a connection is arriving in one of our
+        inboxes.
+        """
+        incoming = self._incoming[fd]
+
+        while True:
+            record = incoming.read()
+            if record is None:
+                return
+
+            conn_fd, conga_id, family, hello_data, buffered = record
+            stream = attach_stream(conn_fd, family, buffered)
+            self._on_adopt(stream, hello_data, conga_id)
+
+
+class _Incoming(object):
+    """
+    Puts handoff records back together from a non-blocking socket, as their
+    pieces arrive: first the connection's file descriptor, then the record
+    header, then the data it says follows.
+    """
+    def __init__(self, sock):
+        #: The socket records arrive on.
+        self.sock = sock
+
+        #: The current record's file descriptor, once received.
+        self.fd = None
+
+        #: The current record's unpacked header, once received.
+        self.header = None
+
+        #: What has arrived so far of the current piece.
+        self.chunks = []
+
+        #: How much more of the current piece is due.
+        self.wanted = 0
+
+    def read(self):
+        """
+        Returns the next complete record, as (file descriptor, conga ID,
+        address family, HELLO data, buffered data), or None if it hasn't
+        all arrived yet.
+        """
+        try:
+            if self.fd is None:
+                self.fd = recvfd(self.sock.fileno())
+                self.wanted = _RECORD.size
+
+            while self.wanted:
+                # Never read past the current record: the next one's
+                # descriptor would be lost.
+                chunk = self.sock.recv(self.wanted)
+                if not chunk:
+                    raise EOFError("Handoff socket closed.")
+                self.chunks.append(chunk)
+                self.wanted -= len(chunk)
+
+                if not self.wanted and self.header is None:
+                    self.header = _RECORD.unpack(b''.join(self.chunks))
+                    self.chunks = []
+                    self.wanted = self.header[2] + self.header[3]
+        except (OSError, socket.error), e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+        conga_id, family, hello_len, _ = self.header
+        data = b''.join(self.chunks)
+        record = (self.fd, conga_id, family, data[:hello_len],
+                  data[hello_len:])
+
+        self.fd = None
+        self.header = None
+        self.chunks = []
+        return record
+
+
+def _recv_exactly(sock, length):
+    """
+    Read exactly length bytes from a blocking socket.
+    """
+    chunks = []
+
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise EOFError("Handoff socket closed.")
+        chunks.append(chunk)
+        length -= len(chunk)
+
+    return b''.join(chunks)
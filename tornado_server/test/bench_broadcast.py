@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_broadcast.py
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Benchmarks getting one message to everyone in a conga, round the ring and by
+broadcast, at various conga sizes. Participants are real Participants on
+fake streams. Round the ring, each one's client is played by feeding what
+the server wrote to it straight back in, so the time is the server's own
+work for every hop, with none of the round trips to clients that make ring
+delivery slower still in practice. By broadcast, the time is the one pass
+the server makes over the conga.
+
+For end to end latency, with real clients, run loadgen.py against a
+running server with and without --broadcast.
+"""
+import logging
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from bench_forwarding import FakeStream
+from conga import conga_from_id
+from participant import Participant, UP
+
+CONGA_SIZES = (10, 100, 1000)
+BODY_SIZES = (64, 16 * 1024)
+
+# The messages to time at each size, spread over about as many hops.
+HOPS = 20000
+
+
+def build_conga(conga_id, size):
+    """
+    Builds a conga of size participants on fake streams, in ring order.
+    """
+    conga = conga_from_id(conga_id)
+    people = []
+
+    for pid in xrange(1, size + 1):
+        person = Participant(FakeStream(), None)
+        person.participant_id = pid
+        person.conga_id = conga_id
+        person.state = UP
+        conga.join(person, pid)
+        people.append(person)
+
+    return conga, people
+
+
+def send(person, header_data, body):
+    person.source_stream.body = body
+    person._parse_headers(header_data)
+
+
+def returned(person):
+    """
+    Takes the message the server wrote to a participant, and returns its
+    header block and body, as their client would send it back.
+    """
+    data = b''.join(person.source_stream.written)
+    del person.source_stream.written[:]
+    end = data.index(b'\r\n\r\n') + 4
+    return data[:end], data[end:]
+
+
+def ring(people, body, messages):
+    header_data = b'MSG\r\nContent-Length: %d\r\nFrom: bench\r\n\r\n' % (
+        len(body)
+    )
+
+    start = time.time()
+    for _ in xrange(messages):
+        send(people[0], header_data, body)
+        for person in people[1:]:
+            send(person, *returned(person))
+    return time.time() - start
+
+
+def broadcast(people, body, messages):
+    header_data = (b'MSG\r\nContent-Length: %d\r\nFrom: bench\r\n'
+                   b'Delivery: broadcast\r\n\r\n' % len(body))
+
+    start = time.time()
+    for _ in xrange(messages):
+        send(people[0], header_data, body)
+        for person in people:
+            del person.source_stream.written[:]
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    # The conga logs every hop.
+    logging.disable(logging.INFO)
+
+    print "%8s %9s %14s %14s %9s" % (
+        "members", "body", "ring us/msg", "bcast us/msg", "speedup"
+    )
+
+    for size in CONGA_SIZES:
+        conga, people = build_conga(('bench', 'broadcast', size), size)
+        messages = max(10, HOPS // size)
+
+        for body_size in BODY_SIZES:
+            body = b'x' * body_size
+            ring_time = ring(people, body, messages)
+            broadcast_time = broadcast(people, body, messages)
+            print "%8d %9d %14.1f %14.1f %8.1fx" % (
+                size, body_size, ring_time * 1e6 / messages,
+                broadcast_time * 1e6 / messages, ring_time / broadcast_time
+            )
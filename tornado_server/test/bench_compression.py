@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_compression.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the bytes on the wire for a sample of conga messages in each format,
+with and without compression, and against plain zlib with no dictionary to
+show what the dictionary buys. Then times what compression costs: the client
+compressing and inflating a message, and the server inflating one for a
+participant who can't read it. The saved column compares binary frames with
+compressed bodies against the original text format.
+"""
+import os
+import sys
+import timeit
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+import compression
+import tornado_sendrcv
+
+RUNS = 20000
+
+HEADERS = {'From': 'alice', 'Message-ID': '12345', 'Origin-ID': '31',
+           'Hops-Remaining': '7'}
+
+SAMPLES = [
+    "Hi",
+    "Hello everyone!",
+    "Good morning, how are you all today?",
+    "Thanks, that was a great class. See you all tomorrow.",
+    "Has anyone got the python code from the teacher? I can't find it on "
+    "the school website and I want to try it on my raspberry pi tonight.",
+    "Okay, so the conga works like this: each message goes from one "
+    "person to the next until it has been all the way round, then the "
+    "server stops it. If you leave, the people either side of you get "
+    "joined up, and the message carries on without you. " * 3,
+]
+
+
+def wire_size(body, encode, compress):
+    return len(encode('MSG', HEADERS, body, compress))
+
+
+def time_per_call(fn):
+    best = min(timeit.repeat(fn, number=RUNS, repeat=3))
+    return best / RUNS * 1e9
+
+
+if __name__ == '__main__':
+    print "%6s %6s %8s %8s %8s %8s %8s" % (
+        "body", "zlib", "text", "+deflate", "binary", "+deflate", "saved"
+    )
+
+    totals = [0] * 5
+
+    for body in SAMPLES:
+        sizes = [
+            len(zlib.compress(body, 9)),
+            wire_size(body, tornado_sendrcv.encode_text_msg, False),
+            wire_size(body, tornado_sendrcv.encode_text_msg, True),
+            wire_size(body, tornado_sendrcv.encode_binary_msg, False),
+            wire_size(body, tornado_sendrcv.encode_binary_msg, True),
+        ]
+        totals = [total + size for (total, size) in zip(totals, sizes)]
+
+        print "%6d %6d %8d %8d %8d %8d %7.0f%%" % (
+            (len(body),) + tuple(sizes) +
+            (100.0 * (1 - float(sizes[4]) / sizes[1]),)
+        )
+
+    print "%6s %6d %8d %8d %8d %8d %7.0f%%" % (
+        ("total",) + tuple(totals) +
+        (100.0 * (1 - float(totals[4]) / totals[1]),)
+    )
+
+    print
+    print "%6s %-24s %10s" % ("body", "operation", "ns")
+
+    for body in (SAMPLES[2], SAMPLES[-1]):
+        deflated = tornado_sendrcv.deflate(body)
+        rows = [
+            ("client deflate", lambda: tornado_sendrcv.deflate(body)),
+            ("client inflate", lambda: tornado_sendrcv.inflate(deflated)),
+            ("server inflate", lambda: compression.inflate(deflated)),
+        ]
+
+        for name, fn in rows:
+            print "%6d %-24s %10.0f" % (len(body), name, time_per_call(fn))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_framing.py
+~~~~~~~~~~~~~~~~~~~~~
+
+Compares the cost of the text and binary message formats. On the server,
+times what each hop costs: reading a message's headers and building the
+message to send on. On the client, times encoding a message and parsing one
+as received.
+"""
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+import framing
+import participant
+import tornado_sendrcv
+
+RUNS = 100000
+BODY_SIZES = (16, 1024)
+
+HEADERS = {'From': 'alice', 'Message-ID': '12345', 'Origin-ID': '31',
+           'Hops-Remaining': '7'}
+
+
+def server_text(raw_header, body):
+    def hop():
+        _, headers = participant._split_headers(raw_header)
+        hops = int(headers['Hops-Remaining'])
+        participant._frame_message(
+            raw_header, [('Hops-Remaining', hops - 1)], body
+        )
+    return hop
+
+
+def server_binary(raw_header, payload):
+    def hop():
+        _, extra_length, body_length, msg_id, sender_id, hops, _, _ = \
+            framing.unpack_frame(raw_header)
+        header = framing.pack_frame('MSG', extra_length, body_length, msg_id,
+                                    sender_id, hops - 1)
+        participant._coalesce(header, payload)
+    return hop
+
+
+def time_per_call(fn):
+    best = min(timeit.repeat(fn, number=RUNS, repeat=3))
+    return best / RUNS * 1e9
+
+
+if __name__ == '__main__':
+    sr = tornado_sendrcv.TornadoSendRcv('localhost', 0)
+
+    print "%6s %-24s %10s %12s %8s" % (
+        "body", "operation", "text (ns)", "binary (ns)", "ratio"
+    )
+
+    for size in BODY_SIZES:
+        body = 'x' * size
+        text = tornado_sendrcv.encode_text_msg('MSG', HEADERS, body)
+        binary = tornado_sendrcv.encode_binary_msg('MSG', HEADERS, body)
+
+        text_header = text[:text.index('\r\n\r\n') + 4]
+        binary_header = binary[:framing.FRAME.size]
+
+        rows = [
+            ("server hop",
+             server_text(text_header, body),
+             server_binary(binary_header, binary[framing.FRAME.size:])),
+            ("client encode",
+             lambda: tornado_sendrcv.encode_text_msg('MSG', HEADERS, body),
+             lambda: tornado_sendrcv.encode_binary_msg('MSG', HEADERS, body)),
+            ("client decode",
+             lambda: sr._parse_conga_msg(text),
+             lambda: sr._parse_binary_msg(binary)),
+        ]
+
+        for name, text_fn, binary_fn in rows:
+            text_ns = time_per_call(text_fn)
+            binary_ns = time_per_call(binary_fn)
+            print "%6d %-24s %10.0f %12.0f %8.2f" % (
+                size, name, text_ns, binary_ns, text_ns / binary_ns
+            )
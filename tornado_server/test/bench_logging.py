@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_logging.py
+~~~~~~~~~~~~~~~~~~~~~
+
+Benchmarks what logging costs each hop of a message, with every hop logging
+at INFO as the conga does. Hops are pushed through a two-participant conga
+as in bench_forwarding, logging to a file:
+
+- straight to a FileHandler, as the server did before eventlog;
+- through eventlog's AsyncHandler;
+- straight to the FileHandler, keeping one in every 100 of each event, as
+  the server does by default with sampling turned on;
+- the same through the AsyncHandler, and then written as JSON lines.
+
+For each, the time the hops took is given, then the time including waiting
+for the log to be written. Finally, formatting a kilobyte of data into a
+message with % before logging it is compared with passing logging the
+arguments, for a record that isn't written.
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import eventlog
+from bench_forwarding import make_pair
+
+HOPS = 20000
+
+
+def run(name, path, **kwargs):
+    """
+    Times HOPS hops logged to a file at path, with eventlog installed with
+    kwargs, or not at all if there are none.
+    """
+    root = logging.getLogger()
+    switches = logging.logThreads, logging.logProcesses
+    handler = logging.FileHandler(path, mode='w')
+    handler.setFormatter(logging.Formatter(
+        "[%(levelname)1.1s %(asctime)s %(module)s:%(lineno)d] %(message)s"
+    ))
+    root.addHandler(handler)
+
+    handlers = [handler]
+    if kwargs:
+        handlers = eventlog.install(root, **kwargs)
+
+    sender, _, conga = make_pair(('logging', name))
+    header_data = b'MSG\r\nContent-Length: 0\r\nFrom: bench\r\n'
+    header_data += b'Message-ID: 1\r\n\r\n'
+    conga.outstanding_messages['1'] = sender.participant_id
+
+    start = time.time()
+    for _ in xrange(HOPS):
+        sender._parse_headers(header_data)
+    hops = time.time() - start
+
+    for handler in handlers:
+        handler.flush()
+    total = time.time() - start
+
+    for handler in handlers:
+        root.removeHandler(handler)
+        handler.close()
+    logging.logThreads, logging.logProcesses = switches
+
+    lines = sum(1 for _ in open(path))
+    return hops, total, lines
+
+
+def formatting(eager):
+    """
+    Times logging a record below the logger's level.
+    """
+    values = (67890, b'x' * 1024)
+    start = time.time()
+
+    if eager:
+        for _ in xrange(HOPS):
+            logging.debug("Participant %s sent %r" % values)
+    else:
+        for _ in xrange(HOPS):
+            logging.debug("Participant %s sent %r", *values)
+
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    path = tempfile.mktemp(suffix='.log')
+
+    print "%d hops" % HOPS
+    print "%-28s %10s %14s %8s" % ("", "us/hop", "us/hop written",
+                                   "lines")
+    try:
+        for name, kwargs in (
+                ("FileHandler", {}),
+                ("AsyncHandler", {'background': True}),
+                ("FileHandler, sampled", {'rates': {'stop_loop': 100}}),
+                ("AsyncHandler, sampled", {'rates': {'stop_loop': 100},
+                                           'background': True}),
+                ("AsyncHandler, sampled, JSON", {'rates': {'stop_loop': 100},
+                                                 'background': True,
+                                                 'json_lines': True})):
+            hops, total, lines = run(name, path, **kwargs)
+            print "%-28s %10.2f %14.2f %8d" % (
+                name, hops * 1e6 / HOPS, total * 1e6 / HOPS, lines
+            )
+    finally:
+        os.unlink(path)
+
+    print
+    print "A DEBUG record that isn't written:"
+    print "%-28s %10.2f" % ("formatted with %",
+                            formatting(True) * 1e6 / HOPS)
+    print "%-28s %10.2f" % ("arguments passed",
+                            formatting(False) * 1e6 / HOPS)
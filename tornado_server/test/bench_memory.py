@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_memory.py
+~~~~~~~~~~~~~~~~~~~~
+
+Measures what an idle connection costs the server in memory. Starts a server
+against a scratch copy of the database seeded with enough members, opens
+100,000 connections to it (or the number given on the command line), and
+reads the server's resident set size from /proc: before any connections,
+once every connection is open, and once every connection has said HELLO and
+joined a conga of 10. Nobody sends anything else, so every participant is
+as idle as they come.
+
+Each process needs a file descriptor per connection, so run this where the
+hard limit on open files allows it. Connections come from several loopback
+addresses, so that the ephemeral ports don't run out.
+
+Run from anywhere: the script finds the server and the database itself.
+"""
+import os
+import resource
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, '..', 'tornado_main.py')
+DATABASE = os.path.join(HERE, '..', '..', 'server', 'piconga.db')
+
+PORT = 8898
+CONNECTIONS = 100000
+MEMBERS = 10
+
+# The most connections to open from each loopback address.
+PER_ADDRESS = 20000
+
+hello = 'HELLO\r\nContent-Length: 0\r\nUser-ID: %s\r\n\r\n'
+
+
+def seed(db_path, connections):
+    """
+    Fill the scratch database with congas of MEMBERS members, enough for
+    every connection. Member i is in conga i // MEMBERS + 1.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM conga_congamember')
+    cursor.executemany(
+        'INSERT INTO conga_congamember VALUES (?, ?, ?, ?)',
+        ((i // MEMBERS + 1, i % MEMBERS + 1, i + 1, i + 1)
+         for i in xrange(connections))
+    )
+    conn.commit()
+    conn.close()
+
+
+def resident(pid):
+    """
+    Returns the resident set size of a process, in bytes.
+    """
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def settled(pid):
+    """
+    Waits for the resident set size of a process to stop changing, and
+    returns it.
+    """
+    last = resident(pid)
+
+    while True:
+        time.sleep(1)
+        now = resident(pid)
+        if now == last:
+            return now
+        last = now
+
+
+def wait_for_port():
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', PORT)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start.")
+
+
+def connect(connections):
+    """
+    Opens the connections, spread over the loopback addresses.
+    """
+    sockets = []
+
+    for i in xrange(connections):
+        source = '127.0.0.%d' % (i // PER_ADDRESS + 2)
+        sockets.append(socket.create_connection(('127.0.0.1', PORT),
+                                                source_address=(source, 0)))
+
+    return sockets
+
+
+if __name__ == '__main__':
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else CONNECTIONS
+
+    # The server inherits our limit on open files.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 100
+    if hard < wanted:
+        sys.exit("Needs %d open files, but the hard limit is %d." %
+                 (wanted, hard))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    scratch = tempfile.mkdtemp()
+    db_path = os.path.join(scratch, 'piconga.db')
+    shutil.copy(DATABASE, db_path)
+    seed(db_path, connections)
+
+    server = subprocess.Popen(
+        [sys.executable, SERVER, '--port=%d' % PORT,
+         '--sqlite_path=%s' % db_path, '--logging=error',
+         '--handshake_timeout=0', '--membership_cache_size=%d' % connections]
+    )
+
+    try:
+        wait_for_port()
+        empty = settled(server.pid)
+
+        sockets = connect(connections)
+        opened = settled(server.pid)
+
+        for i, sck in enumerate(sockets):
+            sck.sendall(hello % (i + 1))
+        joined = settled(server.pid)
+
+        for sck in sockets:
+            sck.close()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(scratch)
+
+    print "%d idle connections, in congas of %d." % (connections, MEMBERS)
+    print "%-28s %12s %16s" % ("", "resident MB", "bytes/connection")
+    print "%-28s %12.1f" % ("no connections", empty / 1e6)
+    print "%-28s %12.1f %16.0f" % (
+        "connected", opened / 1e6, float(opened - empty) / connections
+    )
+    print "%-28s %12.1f %16.0f" % (
+        "joined a conga", joined / 1e6, float(joined - empty) / connections
+    )
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_ring.py
+~~~~~~~~~~~~~~~~~~
+
+Benchmarks conga membership churn. Builds congas of increasing size, then
+runs 100,000 joins and 100,000 leaves at random ring positions against each,
+checking that the ring is still correctly linked at the end.
+"""
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from conga import Conga
+
+CHURN = 100000
+RING_SIZES = (10, 1000, 10000, 100000)
+
+
+class FakeParticipant(object):
+    """
+    Stands in for a Participant: all the conga needs is add_destination.
+    """
+    __slots__ = ('destination',)
+
+    def __init__(self):
+        self.destination = None
+
+    def add_destination(self, destination):
+        self.destination = destination
+
+
+def check_ring(conga):
+    """
+    Confirm every participant points at the next one in participant ID order.
+    """
+    ids = [node.participant_id for node in conga.participants]
+    assert ids == sorted(ids)
+
+    for node in conga.participants:
+        assert node.participant.destination is node.next.participant
+
+
+def churn(ring_size):
+    conga = Conga(1)
+    pool = random.sample(xrange(1, ring_size * 10 + CHURN * 2),
+                         ring_size + CHURN)
+    members = [(pid, FakeParticipant()) for pid in pool[:ring_size]]
+    spare = pool[ring_size:]
+
+    for pid, person in members:
+        conga.join(person, pid)
+
+    start = time.time()
+
+    for pid in spare:
+        # Join a new participant, then have a random existing one leave.
+        person = FakeParticipant()
+        conga.join(person, pid)
+        members.append((pid, person))
+
+        index = random.randrange(len(members))
+        members[index], members[-1] = members[-1], members[index]
+        leaving, person = members.pop()
+        conga.leave(person, leaving)
+
+    elapsed = time.time() - start
+    check_ring(conga)
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    random.seed(1)
+
+    print "%10s %12s %14s" % ("ring size", "seconds", "ops/second")
+    for size in RING_SIZES:
+        elapsed = churn(size)
+        print "%10d %12.3f %14.0f" % (size, elapsed, (CHURN * 2) / elapsed)
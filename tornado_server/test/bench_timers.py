@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_timers.py
+~~~~~~~~~~~~~~~~~~~~
+
+Benchmarks the cost of keeping a handshake or idle deadline for every
+connection, at 50,000 connections: on the shared watchdog's TimingWheel, and
+as one IOLoop timeout per connection. For each, times setting every
+deadline, moving every deadline (as happens when each connection is heard
+from), an IOLoop iteration or wheel tick with none of them due, and firing
+them all.
+"""
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from tornado.ioloop import IOLoop
+from timers import monotonic
+from watchdog import Watchdog
+
+CONNECTIONS = 50000
+TIMEOUT = 30.0
+
+
+class Connection(object):
+    """
+    Stands in for a Participant, counting the times its deadline passes.
+    """
+    fired = 0
+
+    def timed_out(self):
+        Connection.fired += 1
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def bench_watchdog(connections):
+    watchdog = Watchdog()
+    now = monotonic()
+
+    def schedule():
+        for connection in connections:
+            watchdog.wheel.schedule(connection, TIMEOUT, now)
+
+    def move():
+        for connection in connections:
+            watchdog.wheel.schedule(connection, TIMEOUT, now + 1)
+
+    def tick():
+        watchdog.tick(now + 2)
+
+    def fire():
+        watchdog.tick(now + 2 + TIMEOUT)
+
+    Connection.fired = 0
+    results = [timed(schedule), timed(move), timed(tick), timed(fire)]
+    assert Connection.fired == len(connections)
+    return results
+
+
+def bench_ioloop(connections):
+    loop = IOLoop()
+    now = loop.time()
+    handles = {}
+
+    def schedule():
+        for connection in connections:
+            handles[connection] = loop.call_at(now + TIMEOUT,
+                                               connection.timed_out)
+
+    def move():
+        for connection in connections:
+            loop.remove_timeout(handles[connection])
+            handles[connection] = loop.call_at(now + TIMEOUT + 1,
+                                               connection.timed_out)
+
+    def iteration():
+        loop.add_callback(loop.stop)
+        loop.start()
+
+    def fire():
+        # Bring every deadline forward to now, then run the loop until
+        # they've all gone off.
+        for connection in connections:
+            loop.remove_timeout(handles[connection])
+            loop.call_at(now, connection.timed_out)
+        loop.add_callback(loop.stop)
+        while Connection.fired < len(connections):
+            loop.start()
+            loop.add_callback(loop.stop)
+
+    Connection.fired = 0
+    results = [timed(schedule), timed(move), timed(iteration)]
+    heap = len(loop._timeouts)
+    results.append(timed(fire))
+    assert Connection.fired == len(connections)
+    loop.close()
+    return results, heap
+
+
+if __name__ == '__main__':
+    connections = [Connection() for _ in xrange(CONNECTIONS)]
+
+    wheel = bench_watchdog(connections)
+    ioloop, heap = bench_ioloop(connections)
+
+    print "%d connections" % CONNECTIONS
+    print "%-32s %14s %14s" % ("", "watchdog ms", "ioloop ms")
+    for name, ours, theirs in zip(
+            ("set every deadline", "move every deadline",
+             "idle tick / next loop iteration", "fire every deadline"),
+            wheel, ioloop):
+        print "%-32s %14.2f %14.2f" % (name, ours * 1e3, theirs * 1e3)
+
+    print
+    print "IOLoop timeout heap after moving every deadline: %d entries" % heap
+    print "The next loop iteration includes clearing out the timeouts that"
+    print "moving cancelled. Firing every deadline includes bringing them"
+    print "forward for the IOLoop."
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+test/bench_workers.py
+~~~~~~~~~~~~~~~~~~~~~
+
+Measures how the Tornado server scales with its number of worker processes.
+For each worker count from 1 up to the number of CPUs (or the count given on
+the command line), starts a server against a scratch copy of the database,
+drives many congas at once from several client processes, and reports how
+many times a second messages make it all the way round a conga.
+
+Run from anywhere: the script finds the server and the database itself.
+"""
+import multiprocessing
+import os
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, '..', 'tornado_main.py')
+DATABASE = os.path.join(HERE, '..', '..', 'server', 'piconga.db')
+
+PORT = 8899
+CONGAS = 64
+MEMBERS = 8
+DURATION = 10.0
+BODY = b'x' * 64
+
+hello = 'HELLO\r\nContent-Length: 0\r\nUser-ID: %s\r\n\r\n'
+bye = 'BYE\r\nContent-Length: 0\r\n\r\n'
+first_msg = 'MSG\r\nContent-Length: %d\r\n\r\n%s'
+
+
+def seed(db_path):
+    """
+    Fill the scratch database with CONGAS congas of MEMBERS members each.
+    Conga c's members have IDs c * 1000 + 1 onwards.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM conga_congamember')
+
+    for conga in range(1, CONGAS + 1):
+        for member in range(1, MEMBERS + 1):
+            pid = conga * 1000 + member
+            cursor.execute(
+                'INSERT INTO conga_congamember VALUES (?, ?, ?, ?)',
+                (conga, member, pid, pid)
+            )
+
+    conn.commit()
+    conn.close()
+
+
+class Reader(object):
+    """
+    Splits the bytes arriving on a socket into whole conga messages.
+    """
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end == -1:
+                break
+
+            header = self.buffer[:end + 4]
+            length = 0
+            for line in header.split(b'\r\n')[1:]:
+                if line.startswith(b'Content-Length:'):
+                    length = int(line.split(b':', 1)[1])
+
+            if len(self.buffer) < end + 4 + length:
+                break
+
+            messages.append(self.buffer[:end + 4 + length])
+            self.buffer = self.buffer[end + 4 + length:]
+
+        return messages
+
+
+def drive(congas):
+    """
+    Run one client process: join every member of the given congas, then keep
+    one message looping round each conga for DURATION seconds. Returns the
+    number of completed loops.
+    """
+    sockets = {}
+
+    for conga in congas:
+        for member in range(1, MEMBERS + 1):
+            sck = socket.create_connection(('127.0.0.1', PORT))
+            sck.sendall(hello % (conga * 1000 + member))
+            sockets[sck] = (conga, member, Reader())
+
+    # Give the server a moment to place everyone.
+    time.sleep(2)
+
+    firsts = dict(
+        (conga, sck) for sck, (conga, member, _) in sockets.items()
+        if member == 1
+    )
+    for sck in firsts.values():
+        sck.sendall(first_msg % (len(BODY), BODY))
+
+    loops = 0
+    deadline = time.time() + DURATION
+
+    while time.time() < deadline:
+        readable, _, _ = select.select(list(sockets), [], [], 0.5)
+
+        for sck in readable:
+            conga, member, reader = sockets[sck]
+
+            for msg in reader.feed(sck.recv(65536)):
+                if member == MEMBERS:
+                    # Made it round: start the next one.
+                    loops += 1
+                    firsts[conga].sendall(first_msg % (len(BODY), BODY))
+                else:
+                    sck.sendall(msg)
+
+    for sck in sockets:
+        sck.sendall(bye)
+        sck.close()
+
+    return loops
+
+
+def wait_for_port():
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', PORT)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start.")
+
+
+def run(workers, db_path, clients):
+    # Leaving a conga removes the member from the database, so start each
+    # run afresh.
+    seed(db_path)
+
+    server = subprocess.Popen(
+        [sys.executable, SERVER, '--workers=%d' % workers, '--port=%d' % PORT,
+         '--sqlite_path=%s' % db_path, '--logging=error'],
+    )
+
+    try:
+        wait_for_port()
+
+        congas = range(1, CONGAS + 1)
+        shares = [congas[i::clients] for i in range(clients)]
+        pool = multiprocessing.Pool(clients)
+        loops = sum(pool.map(drive, shares))
+        pool.close()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    return loops / DURATION
+
+
+if __name__ == '__main__':
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else \
+        multiprocessing.cpu_count()
+    clients = max(2, max_workers)
+
+    scratch = tempfile.mkdtemp()
+    db_path = os.path.join(scratch, 'piconga.db')
+    shutil.copy(DATABASE, db_path)
+
+    try:
+        print "%d congas of %d members, %d client processes, %d CPUs." % (
+            CONGAS, MEMBERS, clients, multiprocessing.cpu_count()
+        )
+        print "%8s %12s %16s %10s" % (
+            "workers", "loops/s", "forwards/s", "speedup"
+        )
+
+        base = None
+        for workers in range(1, max_workers + 1):
+            rate = run(workers, db_path, clients)
+            base = base or rate
+            print "%8d %12.1f %16.1f %10.2f" % (
+                workers, rate, rate * (MEMBERS - 1), rate / base
+            )
+    finally:
+        shutil.rmtree(scratch)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+test/broadcast_test.py
+~~~~~~~~~~~~~~~~~~~~~~
+
+Checks broadcast delivery. Joins four members, one of them in binary frames
+and one compressing, and has the first send a message marked for broadcast.
+Everyone else should get it straight from the server, marked broadcast, and
+the sender should be told how many people it went to. A copy sent back round
+anyway by a client that doesn't know better should go nowhere.
+
+Like passive_test.py, run this from the test directory against a server that
+is already running, in either loop mode.
+"""
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+
+
+class Member(object):
+    """
+    One member of the conga.
+    """
+    def __init__(self, member_id, protocol, compression=None):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, target_port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        if compression:
+            headers['Compression'] = compression
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if len(headers) > 1:
+            verb, headers, _ = self.recv()
+            assert verb == 'HELLO'
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body='', compress=False):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body, compress))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body, compress))
+
+    def expect_nothing(self):
+        self.sck.settimeout(0.3)
+        try:
+            data = self.sck.recv(4096)
+            assert False, "Unexpected data: %r" % data
+        except socket.timeout:
+            pass
+        self.sck.settimeout(2)
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=128')
+for i in (61, 62, 63, 64):
+    cursor.execute('INSERT INTO conga_congamember VALUES (128, ?, ?, ?)',
+                   (i, i, i))
+conn.commit()
+
+alice = Member(61, 'text')
+bob = Member(62, 'binary')
+carol = Member(63, 'text', 'deflate')
+dave = Member(64, 'text')
+time.sleep(0.5)
+
+# A body long enough to be worth compressing, from a compressing sender, so
+# that the server has to inflate it for everyone else.
+announcement = 'Everybody conga! ' * 20
+carol.send('MSG', {'From': 'carol', 'Delivery': 'broadcast'}, announcement,
+           compress=True)
+
+for member in (dave, alice, bob):
+    verb, headers, body = member.recv()
+    assert (verb, headers['From'], body) == ('MSG', 'carol', announcement)
+    assert headers['Delivery'] == 'broadcast'
+
+# Carol hears how many people it went to.
+verb, headers, body = carol.recv()
+assert (verb, headers['Delivered'], body) == ('MSG', '3', '')
+assert headers['Delivery'] == 'broadcast'
+
+# A client that passes it on anyway gets nowhere.
+dave.send('MSG', dict((name, headers.get(name)) for name in (
+    'From', 'Message-ID', 'Origin-ID', 'Hops-Remaining'
+)), body)
+for member in (alice, bob, carol):
+    member.expect_nothing()
+
+# Broadcast from a binary sender, to make sure the flag gets through.
+bob.send('MSG', {'From': 'bob', 'Delivery': 'broadcast'}, 'Hello all.')
+for member in (carol, dave, alice):
+    verb, headers, body = member.recv()
+    assert (headers['From'], body) == ('bob', 'Hello all.')
+    assert headers['Delivery'] == 'broadcast'
+
+verb, headers, body = bob.recv()
+assert headers['Delivered'] == '3'
+
+# Now say bye!
+for member in (alice, bob, carol, dave):
+    member.send('BYE', {})
+
+print "Passed."
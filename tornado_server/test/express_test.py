@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+test/express_test.py
+~~~~~~~~~~~~~~~~~~~~
+
+Checks express delivery. Joins four members: the first, second and fourth
+ask for express delivery (the second in binary frames), and the third
+passes messages on itself. A message sent by the first should reach each
+of the others in ring order, marked express for those who asked, with only
+the third sending anything back, and stop before it gets back to its
+sender.
+
+Like passive_test.py, run this from the test directory against a server that
+is already running, in either loop mode.
+"""
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+
+
+class Member(object):
+    """
+    One member of the conga.
+    """
+    def __init__(self, member_id, protocol, delivery):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, target_port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        if delivery == 'express':
+            headers['Delivery'] = 'express'
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if len(headers) > 1:
+            verb, headers, _ = self.recv()
+            assert verb == 'HELLO' and headers.get('Delivery') == delivery
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def expect_nothing(self):
+        self.sck.settimeout(0.3)
+        try:
+            data = self.sck.recv(4096)
+            assert False, "Unexpected data: %r" % data
+        except socket.timeout:
+            pass
+        self.sck.settimeout(2)
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=127')
+for i in (51, 52, 53, 54):
+    cursor.execute('INSERT INTO conga_congamember VALUES (127, ?, ?, ?)',
+                   (i, i, i))
+conn.commit()
+
+alice = Member(51, 'text', 'express')
+bob = Member(52, 'binary', 'express')
+carol = Member(53, 'text', 'ring')
+dave = Member(54, 'text', 'express')
+time.sleep(0.5)
+
+alice.send('MSG', {'From': 'alice'}, 'Express.')
+
+# Bob gets it marked express, and doesn't send it on.
+verb, headers, body = bob.recv()
+assert (verb, headers['From'], body) == ('MSG', 'alice', 'Express.')
+assert headers['Delivery'] == 'express'
+msg_id = headers['Message-ID']
+
+# Carol didn't ask for express delivery, so has to send it on herself.
+verb, headers, body = carol.recv()
+assert (headers['Message-ID'], body) == (msg_id, 'Express.')
+assert 'Delivery' not in headers
+dave.expect_nothing()
+
+carol.send('MSG', dict((name, headers.get(name)) for name in (
+    'From', 'Message-ID', 'Origin-ID', 'Hops-Remaining'
+)), body)
+
+# Dave gets it express, and the server stops it before it reaches Alice.
+verb, headers, body = dave.recv()
+assert (headers['Message-ID'], body) == (msg_id, 'Express.')
+assert headers['Delivery'] == 'express'
+alice.expect_nothing()
+
+# Now say bye!
+for member in (alice, bob, carol, dave):
+    member.send('BYE', {})
+
+print "Passed."
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+test/handoff_test.py
+~~~~~~~~~~~~~~~~~~~~
+
+Checks that a new server process can take over from a running one without
+anyone noticing. Joins three members, starts a message on its way round,
+then starts a second server that takes over from the first part way
+through, while one member is part way through sending the message on. The
+message should finish its loop through the new server, which
+should also carry on numbering messages where the old one left off, and
+accept new connections on the same port.
+
+Run this from the test directory against a server started from the
+repository root with a handoff path:
+
+    python tornado_server/tornado_main.py \\
+        --handoff_path=/tmp/piconga-handoff.sock
+
+The test starts the new server the same way, and stops it at the end.
+"""
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+handoff_path = '/tmp/piconga-handoff.sock'
+
+
+class Member(object):
+    """
+    One member of the conga.
+    """
+    def __init__(self, member_id, protocol, delivery='ring'):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, target_port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        if delivery == 'express':
+            headers['Delivery'] = 'express'
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if len(headers) > 1:
+            verb, headers, _ = self.recv()
+            assert verb == 'HELLO'
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def forward(self, headers, body, hold_body=False):
+        """
+        Send a message back. With hold_body, send only its header, and
+        return the rest to send later.
+        """
+        headers = dict((name, headers.get(name)) for name in (
+            'From', 'Message-ID', 'Origin-ID', 'Hops-Remaining'
+        ))
+
+        if self.protocol == 'binary':
+            data = encode_binary_msg('MSG', headers, body)
+        else:
+            data = encode_text_msg('MSG', headers, body)
+
+        split = len(data) - len(body) if hold_body else len(data)
+        self.sck.sendall(data[:split])
+        return data[split:]
+
+    def expect_nothing(self):
+        self.sck.settimeout(0.3)
+        try:
+            data = self.sck.recv(4096)
+            assert False, "Unexpected data: %r" % data
+        except socket.timeout:
+            pass
+        self.sck.settimeout(2)
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=130')
+for i in (81, 82, 83, 84):
+    cursor.execute('INSERT INTO conga_congamember VALUES (130, ?, ?, ?)',
+                   (i, i, i))
+conn.commit()
+
+alice = Member(81, 'text')
+bob = Member(82, 'binary')
+carol = Member(83, 'text', 'express')
+time.sleep(0.5)
+
+# Start a message round, and leave it with Bob.
+alice.send('MSG', {'From': 'alice'}, 'Before.')
+verb, headers, body = bob.recv()
+assert (verb, headers['From'], body) == ('MSG', 'alice', 'Before.')
+before_id = headers['Message-ID']
+
+# He starts to pass it on, but only the header gets through at first.
+held = bob.forward(headers, body, hold_body=True)
+time.sleep(0.2)
+
+# Now start a new server, which takes over from the old one. The old one
+# waits for the rest of Bob's message before handing over.
+successor = subprocess.Popen(
+    [sys.executable, 'tornado_server/tornado_main.py',
+     '--handoff_path=%s' % handoff_path],
+    cwd=os.path.join(HERE, '..', '..')
+)
+
+try:
+    time.sleep(1)
+    bob.sck.sendall(held)
+    time.sleep(1)
+    assert successor.poll() is None, "The new server exited."
+
+    # The message carries on round, and stops before it gets back to Alice.
+    verb, headers, body = carol.recv()
+    assert (headers['Message-ID'], body) == (before_id, 'Before.')
+    alice.expect_nothing()
+
+    # Message IDs carry on from where they were.
+    carol.send('MSG', {'From': 'carol'}, 'After.')
+    verb, headers, body = alice.recv()
+    assert (headers['From'], body) == ('carol', 'After.')
+    assert int(headers['Message-ID']) > int(before_id)
+
+    # New connections are accepted too.
+    dave = Member(84, 'binary')
+    time.sleep(0.5)
+    alice.send('MSG', {'From': 'alice'}, 'Welcome.')
+    verb, headers, body = bob.recv()
+    bob.forward(headers, body)
+    verb, headers, body = dave.recv()
+    assert (headers['From'], body) == ('alice', 'Welcome.')
+
+    # Now say bye!
+    for member in (alice, bob, carol, dave):
+        member.send('BYE', {})
+    time.sleep(0.5)
+finally:
+    successor.send_signal(signal.SIGTERM)
+    successor.wait()
+
+print "Passed."
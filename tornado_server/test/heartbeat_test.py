@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+test/heartbeat_test.py
+~~~~~~~~~~~~~~~~~~~~~~
+
+Checks the handshake timeout and heartbeats. A connection that never sends
+HELLO should be closed. Of three members, the first (in binary frames) and
+second ask for heartbeats, and the third doesn't. The first answers every
+PING, the second never does, as if its Pi had lost power, and the third is
+never sent any. The second should be taken out of the conga, after which
+the first's messages go straight to the third.
+
+Run this from the test directory against a server started with short
+timeouts:
+
+    python tornado_main.py --handshake_timeout=1 --idle_timeout=1 \\
+        --ping_timeout=1
+"""
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+
+# Long enough for the server to notice a dead peer, with the timeouts above.
+REAP_TIME = 6
+
+
+class Member(object):
+    """
+    One member of the conga.
+    """
+    def __init__(self, member_id, protocol, heartbeat):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, target_port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        if heartbeat:
+            headers['Heartbeat'] = 'ping'
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if len(headers) > 1:
+            verb, headers, _ = self.recv()
+            assert verb == 'HELLO'
+            assert headers.get('Heartbeat') == ('ping' if heartbeat else None)
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def closed(self):
+        """
+        Whether the server has closed the connection, reading and throwing
+        away anything it sent first.
+        """
+        try:
+            while True:
+                chunk = self.sck.recv(4096)
+                if not chunk:
+                    return True
+        except socket.timeout:
+            return False
+
+
+# A connection that never says HELLO gets closed.
+silent = socket.create_connection((target, target_port))
+silent.settimeout(5)
+assert silent.recv(4096) == '', "Silent connection wasn't closed."
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=129')
+for i in (71, 72, 73):
+    cursor.execute('INSERT INTO conga_congamember VALUES (129, ?, ?, ?)',
+                   (i, i, i))
+conn.commit()
+
+alice = Member(71, 'binary', heartbeat=True)
+bob = Member(72, 'text', heartbeat=True)
+carol = Member(73, 'text', heartbeat=False)
+time.sleep(0.5)
+
+# Either side can PING.
+alice.send('PING', {})
+verb, _, _ = alice.recv()
+assert verb == 'PONG'
+
+# Alice answers the server's PINGs while we wait, and Bob doesn't.
+pings = 0
+deadline = time.time() + REAP_TIME
+alice.sck.settimeout(0.2)
+while time.time() < deadline:
+    try:
+        verb, _, _ = alice.recv()
+    except socket.timeout:
+        continue
+    assert verb == 'PING'
+    alice.send('PONG', {})
+    pings += 1
+alice.sck.settimeout(2)
+
+assert pings, "Alice was never sent a PING."
+assert bob.closed(), "Bob wasn't taken out of the conga."
+
+# Carol never asked for heartbeats, so she's still here, and now follows
+# Alice directly.
+carol.sck.settimeout(0.2)
+assert not carol.closed(), "Carol was disconnected."
+carol.sck.settimeout(2)
+
+alice.send('MSG', {'From': 'alice'}, 'Still here?')
+verb, headers, body = carol.recv()
+assert (verb, headers['From'], body) == ('MSG', 'alice', 'Still here?')
+
+# Now say bye!
+for member in (alice, carol):
+    member.send('BYE', {})
+
+print "Passed."
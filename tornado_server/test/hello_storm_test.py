@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+test/hello_storm_test.py
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Checks that a storm of HELLOs doesn't hold up messages in other congas,
+even when the database is slow. Keeps a message bouncing between two
+participants of one conga, first on a quiet server, then while hundreds of
+members of another conga join at once. Meanwhile the test holds a lock on
+the database for a second, so that every HELLO's query waits on it.
+Compares how long each message took to arrive: a server that waited on the
+database itself would hold some message up for the whole second.
+
+Like passive_test.py, run this from the test directory against a server that
+is already running.
+"""
+import socket
+import threading
+import time
+import sqlite3
+
+target = '127.0.0.1'
+target_port = 8888
+hello = "HELLO\r\nContent-Length: 0\r\nUser-ID: %s\r\n\r\n"
+bye = "BYE\r\nContent-Length: 0\r\n\r\n"
+first_msg = "MSG\r\nContent-Length: 13\r\n\r\nTest message."
+storm_size = 500
+quiet_time = 1.0
+lock_time = 1.0
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def ping_latencies(duration):
+    latencies = []
+    end = time.time() + duration
+
+    while time.time() < end:
+        start = time.time()
+        sck1.send(first_msg)
+
+        resp = ''
+        while not resp.endswith('Test message.'):
+            resp += sck2.recv(4096)
+
+        latencies.append(time.time() - start)
+
+    return latencies
+
+
+def storm():
+    # Lock the database against readers, so the HELLOs' queries wait.
+    locker = sqlite3.connect('../../server/piconga.db')
+    locker.execute('BEGIN EXCLUSIVE')
+    locked = time.time()
+
+    for i in xrange(storm_size):
+        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sck.connect((target, target_port))
+        sck.send(hello % (1000 + i))
+        storm_sockets.append(sck)
+
+    time.sleep(max(0, locked + lock_time - time.time()))
+    locker.rollback()
+    locker.close()
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+
+# Clear the database, just in case.
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id IN (123, 124)')
+conn.commit()
+
+for i in xrange(1, 3):
+    cursor.execute('INSERT INTO conga_congamember VALUES (123, ?, ?, ?)',
+                   (i, i, i))
+
+for i in xrange(1000, 1000 + storm_size):
+    cursor.execute('INSERT INTO conga_congamember VALUES (124, ?, ?, ?)',
+                   (i, i, i))
+
+conn.commit()
+
+sck1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+sck1.connect((target, target_port))
+sck2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+sck2.connect((target, target_port))
+# A message held up for good should fail the test, not hang it.
+sck2.settimeout(lock_time * 5)
+sck1.send(hello % 1)
+sck2.send(hello % 2)
+time.sleep(0.5)
+
+# Measure a quiet server, then one in the middle of a HELLO storm.
+quiet = ping_latencies(quiet_time)
+
+storm_sockets = []
+stormer = threading.Thread(target=storm)
+stormer.start()
+busy = ping_latencies(lock_time + 0.5)
+stormer.join()
+
+for name, samples in (('quiet', quiet), ('storm', busy)):
+    print "%s: %d messages, p50 %.2fms, p99 %.2fms, max %.2fms" % (
+        name, len(samples), percentile(samples, 0.5) * 1000,
+        percentile(samples, 0.99) * 1000, max(samples) * 1000
+    )
+
+# Forwarding may slow a little while the server accepts connections, but no
+# message may wait anything like as long as the database did.
+assert max(busy) - max(quiet) < lock_time / 2
+
+# Now say bye!
+sck1.send(bye)
+sck2.send(bye)
+for sck in storm_sockets:
+    sck.send(bye)
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+test/loadgen.py
+~~~~~~~~~~~~~~~
+
+Puts a running server under load. Seeds the Sqlite database with a number of
+congas of simulated participants, connects them all on non-blocking sockets,
+and has them send messages at a steady rate. Every participant forwards the
+messages it receives the way client/client.py does, echoing the From,
+Message-ID, Origin-ID and Hops-Remaining headers, using the client's own
+encoding and parsing.
+
+Each message carries the time it was sent. The participant just before its
+sender in the ring is the last to see it, and records how long it took to
+get there. With --broadcast, messages are sent to everyone at once instead,
+and the latency is recorded by whichever participant is the last to see
+each one. At the end, the tool reports throughput and loop latency
+percentiles, says bye, and takes its members back out of the database.
+
+Run it from anywhere against a server that is already running, e.g.:
+
+    python tornado_server/tornado_main.py &
+    python tornado_server/test/loadgen.py --congas 10 --participants 20
+"""
+import argparse
+import os
+import random
+import resource
+import socket
+import sqlite3
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, StreamClosedError
+from histogram import Histogram
+from timers import monotonic
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+# How often to send the messages that have fallen due, in seconds.
+TICK = 0.01
+
+
+class Participant(object):
+    """
+    One simulated participant: a connection to the server that sends
+    messages when told to, and forwards the messages it receives.
+    """
+    def __init__(self, load, member_id, next_id):
+        self.load = load
+        self.member_id = member_id
+
+        # The member after us in the ring. When this is the sender of a
+        # message we've received, we're the last to see it.
+        self.next_id = next_id
+
+        self.stream = None
+        self.up = False
+
+        # The client's own parsing, fed from our stream.
+        self.parser = TornadoSendRcv(load.args.host, load.args.port)
+
+    def connect(self):
+        self.stream = IOStream(socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM))
+        self.stream.set_close_callback(self.closed)
+        self.stream.connect((self.load.args.host, self.load.args.port),
+                            self.connected)
+
+    def connected(self):
+        self.stream.set_nodelay(True)
+
+        headers = {'User-ID': self.member_id}
+        if self.load.args.protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        if self.load.args.compression:
+            headers['Compression'] = self.load.args.compression
+        if self.load.args.delivery == 'express':
+            headers['Delivery'] = 'express'
+        if len(headers) > 1:
+            # Have the parser pick up the server's answer.
+            self.parser._held = []
+
+        self.stream.write(encode_text_msg('HELLO', headers))
+        self.up = True
+        self.stream.read_bytes(65536, self.received, partial=True)
+
+    def closed(self):
+        if self.up:
+            self.load.disconnects += 1
+        self.up = False
+
+    def received(self, data):
+        self.parser._recv_buffer += data
+
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is None:
+                break
+            self.handle(*msg)
+
+        try:
+            self.stream.read_bytes(65536, self.received, partial=True)
+        except StreamClosedError:
+            pass
+
+    def handle(self, verb, headers, body):
+        if verb != 'MSG':
+            return
+
+        load = self.load
+        load.received += 1
+        load.received_bytes += len(body)
+
+        if 'Delivered' in headers:
+            # The server has finished broadcasting one of ours.
+            load.completions += 1
+            return
+
+        sender = int(headers['From'])
+        if sender == self.member_id:
+            return
+
+        if headers.get('Delivery') == 'broadcast':
+            # Everyone gets it at once: the last to do so records it.
+            stamp = body[:body.index(' ')]
+            key = (sender, stamp)
+            waiting = load.waiting.pop(key, load.args.participants - 1) - 1
+            if waiting:
+                load.waiting[key] = waiting
+            else:
+                load.latency.record((monotonic() - float(stamp)) * 1e6)
+                load.loops += 1
+            return
+
+        if sender == self.next_id:
+            # We're the last before the sender: the message has been round.
+            sent = float(body[:body.index(' ')])
+            load.latency.record((monotonic() - sent) * 1e6)
+            load.loops += 1
+
+        if headers.get('Delivery') == 'express':
+            # The server has passed it on for us.
+            return
+
+        self.send({'From': headers['From'],
+                   'Message-ID': headers['Message-ID'],
+                   'Origin-ID': headers.get('Origin-ID'),
+                   'Hops-Remaining': headers.get('Hops-Remaining')}, body)
+
+    def send(self, headers, body):
+        if not self.up:
+            return
+
+        compress = self.parser._compression == 'deflate'
+        if self.parser._protocol == 'binary':
+            data = encode_binary_msg('MSG', headers, body, compress)
+        else:
+            data = encode_text_msg('MSG', headers, body, compress)
+
+        try:
+            self.stream.write(data)
+        except StreamClosedError:
+            return
+
+        self.load.sent += 1
+
+    def originate(self):
+        """
+        Send a new message, stamped with the time it was sent.
+        """
+        stamp = '%.6f ' % monotonic()
+        body = stamp + 'x' * max(0, self.load.args.size - len(stamp))
+        headers = {'From': str(self.member_id)}
+        if self.load.args.broadcast:
+            headers['Delivery'] = 'broadcast'
+        self.send(headers, body)
+        self.load.originated += 1
+
+    def bye(self):
+        if self.up:
+            self.stream.write(encode_text_msg('BYE', {}))
+            self.up = False
+            self.stream.close()
+
+
+class Load(object):
+    """
+    The whole of the load: every conga's participants, and the counts of
+    what they've seen.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.congas = []
+
+        for conga in xrange(args.congas):
+            first = args.first_member + conga * args.participants
+            ids = range(first, first + args.participants)
+            self.congas.append([
+                Participant(self, member_id, ids[(i + 1) % len(ids)])
+                for (i, member_id) in enumerate(ids)
+            ])
+
+        self.originated = 0
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.loops = 0
+        self.completions = 0
+        self.disconnects = 0
+        self.latency = Histogram()
+
+        # The participants yet to see each broadcast message, by sender and
+        # the time it was sent.
+        self.waiting = {}
+
+        # Messages owed to each conga, which build up at the send rate.
+        self._owed = [0.0] * args.congas
+        self._last_tick = None
+
+    def participants(self):
+        for conga in self.congas:
+            for participant in conga:
+                yield participant
+
+    def seed(self):
+        """
+        Make our participants members of their congas in the database.
+        """
+        conn = sqlite3.connect(self.args.db)
+        cursor = conn.cursor()
+        self._unseed(cursor)
+
+        for index, conga in enumerate(self.congas):
+            conga_id = self.args.first_conga + index
+            cursor.executemany(
+                'INSERT INTO conga_congamember VALUES (?, ?, ?, ?)',
+                [(conga_id, p.member_id, p.member_id, p.member_id)
+                 for p in conga]
+            )
+
+        conn.commit()
+        conn.close()
+
+    def unseed(self):
+        conn = sqlite3.connect(self.args.db)
+        self._unseed(conn.cursor())
+        conn.commit()
+        conn.close()
+
+    def _unseed(self, cursor):
+        cursor.execute(
+            'DELETE FROM conga_congamember WHERE conga_id >= ? AND '
+            'conga_id < ?',
+            (self.args.first_conga, self.args.first_conga + self.args.congas)
+        )
+
+    def tick(self):
+        """
+        Send whatever messages have fallen due since the last tick.
+        """
+        now = monotonic()
+        elapsed = now - self._last_tick
+        self._last_tick = now
+
+        for index, conga in enumerate(self.congas):
+            self._owed[index] += self.args.rate * elapsed
+            while self._owed[index] >= 1:
+                self._owed[index] -= 1
+                random.choice(conga).originate()
+
+    def start_sending(self):
+        self._last_tick = monotonic()
+        self._ticker = PeriodicCallback(self.tick, TICK * 1000)
+        self._ticker.start()
+
+    def stop_sending(self):
+        self._ticker.stop()
+
+    def report(self, elapsed, cpu):
+        def rate(count):
+            return count / elapsed
+
+        summary = self.latency.summary((50, 99, 99.9))
+
+        print "congas %d x participants %d, %d byte messages, %s, %s " \
+              "delivery" % (
+                  self.args.congas, self.args.participants, self.args.size,
+                  self.args.protocol + (
+                      ' + %s' % self.args.compression
+                      if self.args.compression else ''
+                  ),
+                  'broadcast' if self.args.broadcast else self.args.delivery
+              )
+        print "originated  %10d  %10.0f/s" % (self.originated,
+                                             rate(self.originated))
+        print "sent        %10d  %10.0f/s" % (self.sent, rate(self.sent))
+        print "received    %10d  %10.0f/s  %10.0f bytes/s" % (
+            self.received, rate(self.received), rate(self.received_bytes)
+        )
+        print "loops       %10d  %10.0f/s" % (self.loops, rate(self.loops))
+        if self.args.broadcast:
+            print "completions %10d  %10.0f/s" % (self.completions,
+                                                 rate(self.completions))
+        print "disconnects %10d" % self.disconnects
+        print "load generator cpu: %.0f%% of a core%s" % (
+            100 * cpu / elapsed,
+            " (saturated: these numbers are its limit, not the server's)"
+            if cpu / elapsed > 0.9 else ""
+        )
+
+        if summary['count']:
+            print "loop latency: p50 %.2fms, p99 %.2fms, p999 %.2fms, " \
+                  "max %.2fms" % (
+                      summary['p50'] / 1e3, summary['p99'] / 1e3,
+                      summary['p99.9'] / 1e3, summary['max'] / 1e3
+                  )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--congas', type=int, default=10,
+                        help="The number of congas.")
+    parser.add_argument('--participants', type=int, default=10,
+                        help="The number of participants in each conga.")
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help="New messages per second in each conga.")
+    parser.add_argument('--size', type=int, default=64,
+                        help="The size of each message body in bytes.")
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="Seconds to send messages for.")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="Seconds to wait after connecting, and after "
+                             "sending, for the congas to settle.")
+    parser.add_argument('--protocol', choices=('text', 'binary'),
+                        default='text')
+    parser.add_argument('--compression', choices=('deflate',))
+    parser.add_argument('--delivery', choices=('ring', 'express'),
+                        default='ring',
+                        help="Whether participants pass messages on "
+                             "themselves, or have the server do it.")
+    parser.add_argument('--broadcast', action='store_true',
+                        help="Have the server send each message to everyone "
+                             "in the conga at once.")
+    parser.add_argument('--first-conga', type=int, default=10000,
+                        help="The ID of the first conga to seed.")
+    parser.add_argument('--first-member', type=int, default=1000000,
+                        help="The ID of the first member to seed.")
+    parser.add_argument('--db', default=os.path.join(
+        HERE, '..', '..', 'server', 'piconga.db'
+    ), help="The Sqlite database the server is using.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Every participant needs a socket.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.congas * args.participants + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    load = Load(args)
+    load.seed()
+
+    loop = IOLoop.current()
+    timings = {}
+
+    def cpu():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def start():
+        load.start_sending()
+        timings['start'] = monotonic()
+        timings['start_cpu'] = cpu()
+        loop.call_later(args.duration, stop)
+
+    def stop():
+        load.stop_sending()
+        loop.call_later(args.settle, finish)
+
+    def finish():
+        timings['finish'] = monotonic()
+        timings['finish_cpu'] = cpu()
+        for participant in load.participants():
+            participant.bye()
+        loop.call_later(0.5, loop.stop)
+
+    for participant in load.participants():
+        participant.connect()
+    loop.call_later(args.settle, start)
+
+    try:
+        loop.start()
+    finally:
+        load.unseed()
+
+    load.report(timings['finish'] - timings['start'],
+                timings['finish_cpu'] - timings['start_cpu'])
+
+
+if __name__ == '__main__':
+    main()
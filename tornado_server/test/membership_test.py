@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+test/membership_test.py
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Checks that a member who says BYE while their conga's roster is being
+fetched isn't put back in the membership cache by the fetch, whose answer
+may still have them in it, nor by one made before their removal from the
+database is committed. The database is faked, so that the test decides
+when each query is answered.
+
+Run from anywhere: no server is needed.
+"""
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from membership import MembershipCache
+
+
+class FakeDatabase(object):
+    """
+    Answers each query only when told to.
+    """
+    def __init__(self):
+        self.queries = []
+
+    def get_async(self, query, args):
+        future = Future()
+        self.queries.append(future)
+        return future
+
+
+def settle():
+    """
+    Run the callbacks for any queries just answered.
+    """
+    loop = IOLoop.current()
+    loop.add_callback(loop.stop)
+    loop.start()
+
+
+db = FakeDatabase()
+cache = MembershipCache(db)
+
+# Alice's HELLO fetches the roster of her conga, with Bob in it. Before the
+# answer arrives, Bob says BYE.
+alice = cache.lookup(1)
+cache.invalidate(2)
+db.queries[0].set_result([(1, 10), (2, 10), (3, 10)])
+settle()
+
+assert alice.result() == 10
+assert 1 in cache._entries and 3 in cache._entries
+assert 2 not in cache._entries
+
+# With nothing in flight, nothing is remembered about Bob, and a fresh
+# fetch caches him again.
+assert not cache._invalidated
+cache.invalidate(1)
+bob = cache.lookup(2)
+db.queries[1].set_result([(1, 10), (2, 10), (3, 10)])
+settle()
+
+assert bob.result() == 10
+assert 1 in cache._entries and 2 in cache._entries
+
+# Bob leaves again, but the delete isn't committed yet, so a roster fetched
+# meanwhile, for Dave, still has him in it. Once the delete is, he's gone.
+deleted = Future()
+cache.remove(2, deleted)
+dave = cache.lookup(4)
+db.queries[2].set_result([(2, 10), (4, 10)])
+settle()
+
+assert dave.result() == 10
+deleted.set_result(None)
+settle()
+
+assert 2 not in cache._entries
+
+print "Passed."
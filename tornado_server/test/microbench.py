@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+test/microbench.py
+~~~~~~~~~~~~~~~~~~
+
+Microbenchmarks for the server's hot paths and the client's message
+handling, run in-process against fake streams and participants:
+
+- Conga.join, Conga.leave and Conga.stop_loop across ring sizes;
+- Conga.new_message with an empty and a full outstanding message table;
+- Participant._parse_headers forwarding a MSG, across body sizes;
+- the client's create_conga_msg and encoding, _parse_conga_msg and
+  _parse_binary_msg, across body sizes.
+
+Results are in nanoseconds per operation, best of several runs, and can be
+saved as a JSON baseline. Comparing against a baseline flags anything that
+has got slower by more than a threshold, and exits non-zero if anything has:
+
+    python microbench.py run --output baselines/microbench.json
+    python microbench.py compare baselines/microbench.json
+
+Baselines only mean anything on the machine they were taken on.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from bench_forwarding import make_pair
+from bench_ring import FakeParticipant
+from conga import Conga
+import tornado_sendrcv
+
+RING_SIZES = (10, 1000, 100000)
+BODY_SIZES = (16, 1024, 65536)
+
+#: The most operations to time in each run, the seconds a run should take
+#: if it has fewer, and the runs to take the best of.
+OPERATIONS = 20000
+RUN_TIME = 0.2
+REPEATS = 5
+
+#: The percentage slowdown that counts as a regression.
+THRESHOLD = 15.0
+
+#: Every benchmark, as (name, function). Each function is called with a
+#: number of operations, does any setup it needs, and returns the seconds
+#: the operations took.
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+
+# Numbers the congas built for each run, so each run gets a new one.
+_runs = itertools.count()
+
+# Congas already built by build_conga. The benchmarks leave them as they
+# found them, so they can be shared between runs.
+_congas = {}
+
+
+def build_conga(size, stateless=False):
+    """
+    Builds a conga of size fake participants, with IDs 0, 2, 4 and so on,
+    so that odd IDs are free to join.
+    """
+    try:
+        return _congas[size, stateless]
+    except KeyError:
+        pass
+
+    conga = Conga(('bench', size, stateless))
+    conga.stateless_loops = stateless
+    for pid in xrange(0, size * 2, 2):
+        conga.join(FakeParticipant(), pid)
+
+    _congas[size, stateless] = conga
+    return conga
+
+
+def ring_benchmarks(size):
+    @benchmark('conga.join/ring=%d' % size)
+    def join(count):
+        conga = build_conga(size)
+        pids = random.sample(xrange(1, size * 2, 2), min(count, size))
+        pids = (pids * (count // len(pids) + 1))[:count]
+        people = [FakeParticipant() for _ in pids]
+
+        elapsed = 0.0
+        for start in xrange(0, count, size):
+            batch = zip(pids[start:start + size], people[start:start + size])
+            began = time.time()
+            for pid, person in batch:
+                conga.join(person, pid)
+            elapsed += time.time() - began
+            for pid, person in batch:
+                conga.leave(person, pid)
+        return elapsed
+
+    @benchmark('conga.leave/ring=%d' % size)
+    def leave(count):
+        conga = build_conga(size)
+        pids = random.sample(xrange(1, size * 2, 2), min(count, size))
+        pids = (pids * (count // len(pids) + 1))[:count]
+        people = [FakeParticipant() for _ in pids]
+
+        elapsed = 0.0
+        for start in xrange(0, count, size):
+            batch = zip(pids[start:start + size], people[start:start + size])
+            for pid, person in batch:
+                conga.join(person, pid)
+            began = time.time()
+            for pid, person in batch:
+                conga.leave(person, pid)
+            elapsed += time.time() - began
+        return elapsed
+
+    @benchmark('conga.stop_loop/ring=%d' % size)
+    def stop_loop(count):
+        # A message still on its way round, being checked at each hop.
+        conga = build_conga(size)
+        msg_id = conga.new_message(0)
+        pids = [random.randrange(2, size * 2, 2) for _ in xrange(count)]
+
+        began = time.time()
+        for pid in pids:
+            conga.stop_loop(msg_id, pid)
+        return time.time() - began
+
+    @benchmark('conga.stop_loop_stateless/ring=%d' % size)
+    def stop_loop_stateless(count):
+        conga = build_conga(size, stateless=True)
+        pids = [random.randrange(2, size * 2, 2) for _ in xrange(count)]
+
+        began = time.time()
+        for pid in pids:
+            conga.stop_loop('1', pid, 0, size)
+        return time.time() - began
+
+
+for ring_size in RING_SIZES:
+    ring_benchmarks(ring_size)
+
+
+def new_message_benchmarks(full):
+    @benchmark('conga.new_message/table=%s' % ('full' if full else 'empty'))
+    def new_message(count):
+        conga = Conga(('bench', 'new_message'))
+        if full:
+            for _ in xrange(conga.max_outstanding):
+                conga.new_message(0)
+        else:
+            conga.max_outstanding = count + 1
+
+        began = time.time()
+        for _ in xrange(count):
+            conga.new_message(0)
+        return time.time() - began
+
+
+for table_full in (False, True):
+    new_message_benchmarks(table_full)
+
+
+def body_benchmarks(size):
+    body = 'x' * size
+    headers = {'From': 'bench', 'Message-ID': '12345', 'Origin-ID': '31',
+               'Hops-Remaining': '7'}
+    text = tornado_sendrcv.encode_text_msg('MSG', headers, body)
+    binary = tornado_sendrcv.encode_binary_msg('MSG', headers, body)
+    client = tornado_sendrcv.TornadoSendRcv('localhost', 0)
+
+    @benchmark('participant._parse_headers/body=%d' % size)
+    def parse_headers(count):
+        # One hop of a message already on its way round a two person conga.
+        sender, recipient, conga = make_pair(('bench', 'hop', next(_runs)))
+        msg_id = conga.new_message(sender.participant_id)
+        header_data = (b'MSG\r\nContent-Length: %d\r\nFrom: bench\r\n'
+                       b'Message-ID: %s\r\n\r\n' % (size, msg_id))
+        sender.source_stream.body = body
+        written = recipient.source_stream.written
+
+        began = time.time()
+        for _ in xrange(count):
+            del written[:]
+            sender._parse_headers(header_data)
+        return time.time() - began
+
+    @benchmark('client.create_conga_msg/body=%d' % size)
+    def create_conga_msg(count):
+        began = time.time()
+        for _ in xrange(count):
+            msg = tornado_sendrcv.create_conga_msg('MSG', headers, body)
+            tornado_sendrcv.encode_text_msg(*msg.data)
+        return time.time() - began
+
+    @benchmark('client._parse_conga_msg/body=%d' % size)
+    def parse_conga_msg(count):
+        began = time.time()
+        for _ in xrange(count):
+            client._parse_conga_msg(text)
+        return time.time() - began
+
+    @benchmark('client._parse_binary_msg/body=%d' % size)
+    def parse_binary_msg(count):
+        began = time.time()
+        for _ in xrange(count):
+            client._parse_binary_msg(binary)
+        return time.time() - began
+
+
+for body_size in BODY_SIZES:
+    body_benchmarks(body_size)
+
+
+def run(names=None, operations=OPERATIONS, repeats=REPEATS):
+    """
+    Runs the benchmarks, or those whose names contain one of names. Returns
+    a dictionary of name to nanoseconds per operation.
+    """
+    results = {}
+
+    for name, fn in BENCHMARKS:
+        if names and not any(wanted in name for wanted in names):
+            continue
+
+        # Slow operations are run fewer times, so that every benchmark
+        # takes about as long.
+        trial = fn(100) / 100
+        count = int(max(100, min(operations, RUN_TIME / max(trial, 1e-9))))
+
+        best = min(fn(count) for _ in xrange(repeats))
+        results[name] = best / count * 1e9
+        print "%-44s %12.0f ns" % (name, results[name])
+
+    return results
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """
+    Prints how each benchmark has changed since the baseline. Returns the
+    names of those that have got slower by more than threshold percent.
+    """
+    regressions = []
+
+    print "%-44s %12s %12s %8s" % ("benchmark", "baseline", "current",
+                                   "change")
+    for name in sorted(current):
+        if name not in baseline:
+            print "%-44s %12s %12.0f %8s" % (name, "-", current[name], "new")
+            continue
+
+        change = (current[name] / baseline[name] - 1) * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+
+        print "%-44s %12.0f %12.0f %+7.1f%%%s" % (
+            name, baseline[name], current[name], change, flag
+        )
+
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'taken': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': dict((name, int(round(ns))) for (name, ns) in
+                            results.items()),
+        }, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks for the server's hot paths."
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help="Run the benchmarks.")
+    run_parser.add_argument('--output', help="Save the results here.")
+
+    compare_parser = commands.add_parser(
+        'compare', help="Compare against a baseline."
+    )
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument(
+        'current', nargs='?',
+        help="Results saved by an earlier run. Runs the benchmarks if not "
+             "given."
+    )
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                                help="The percentage slowdown to flag.")
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--filter', action='append',
+                         help="Only run benchmarks whose names contain "
+                              "this. May be given more than once.")
+        sub.add_argument('--operations', type=int, default=OPERATIONS)
+        sub.add_argument('--repeats', type=int, default=REPEATS)
+
+    args = parser.parse_args()
+
+    # The conga logs every join, leave and message.
+    logging.disable(logging.INFO)
+
+    if args.command == 'run':
+        results = run(args.filter, args.operations, args.repeats)
+        if args.output:
+            save(args.output, results)
+        return 0
+
+    baseline = load(args.baseline)
+    if args.current:
+        current = load(args.current)
+    else:
+        current = run(args.filter, args.operations, args.repeats)
+        print
+
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print
+        print "%d benchmarks regressed by more than %.0f%%." % (
+            len(regressions), args.threshold
+        )
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+test/mixed_protocol_test.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Checks that text and binary participants can share a conga. Joins three
+members, the middle one asking for binary frames, and sends a message round
+from a text member and from the binary member, checking what each member
+sees on the way. Then does the same with large messages whose bodies
+arrive some time after their headers. Messages are encoded and decoded with
+the client's own functions.
+
+Like passive_test.py, run this from the test directory against a server that
+is already running, in either loop mode.
+"""
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, FRAME, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+ack = 'HELLO\r\nProtocol: binary\r\nContent-Length: 0\r\n\r\n'
+
+
+class Member(object):
+    """
+    One member of the conga, speaking either format.
+    """
+    def __init__(self, member_id, protocol):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+
+        # The client's parsing, fed from our socket.
+        self.parser = TornadoSendRcv(target, target_port)
+        self.parser._protocol = 'text'
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if protocol == 'binary':
+            assert self.recv_raw(len(ack)) == ack
+            self.parser._protocol = 'binary'
+
+    def recv_raw(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.sck.recv(length - len(data))
+            assert chunk, "Connection closed."
+            data += chunk
+        return data
+
+    def recv(self):
+        """
+        Returns the next message as (raw bytes, verb, headers, body).
+        """
+        while True:
+            raw = self.parser._recv_buffer
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return (raw,) + msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def send_split(self, verb, headers, body):
+        """
+        Send a message in two parts, its body arriving after its header.
+        """
+        if self.protocol == 'binary':
+            data = encode_binary_msg(verb, headers, body)
+        else:
+            data = encode_text_msg(verb, headers, body)
+
+        split = len(data) - len(body)
+        self.sck.sendall(data[:split])
+        time.sleep(0.2)
+        self.sck.sendall(data[split:])
+
+    def echo(self, headers, body):
+        """
+        Forward a message the way the client does.
+        """
+        self.send('MSG', dict((name, headers.get(name)) for name in (
+            'From', 'Message-ID', 'Origin-ID', 'Hops-Remaining'
+        )), body)
+
+    def expect_nothing(self):
+        self.sck.settimeout(0.3)
+        try:
+            data = self.sck.recv(4096)
+            assert False, "Unexpected data: %r" % data
+        except socket.timeout:
+            pass
+        self.sck.settimeout(2)
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=125')
+for i in (31, 32, 33):
+    cursor.execute('INSERT INTO conga_congamember VALUES (125, ?, ?, ?)',
+                   (i, i, i))
+conn.commit()
+
+# The conga runs 31 -> 32 -> 33 -> 31, and only 32 speaks binary.
+alice = Member(31, 'text')
+bob = Member(32, 'binary')
+carol = Member(33, 'text')
+time.sleep(0.5)
+
+# A text message crosses into binary and back.
+alice.send('MSG', {'From': 'alice'}, 'Hello binary.')
+raw, verb, headers, body = bob.recv()
+assert not raw.startswith('MSG\r\n') and len(raw) > FRAME.size
+assert (verb, headers['From'], body) == ('MSG', 'alice', 'Hello binary.')
+msg_id = headers['Message-ID']
+
+bob.echo(headers, body)
+raw, verb, headers, body = carol.recv()
+assert raw.startswith('MSG\r\n')
+assert (verb, headers['From'], body) == ('MSG', 'alice', 'Hello binary.')
+assert headers['Message-ID'] == msg_id
+
+carol.echo(headers, body)
+alice.expect_nothing()
+
+# A binary message crosses into text, and stops before it gets back.
+bob.send('MSG', {'From': 'bob'}, 'Hello text.')
+_, verb, headers, body = carol.recv()
+assert (verb, headers['From'], body) == ('MSG', 'bob', 'Hello text.')
+msg_id = headers['Message-ID']
+
+carol.echo(headers, body)
+_, verb, headers, body = alice.recv()
+assert (headers['Message-ID'], body) == (msg_id, 'Hello text.')
+
+alice.echo(headers, body)
+bob.expect_nothing()
+
+# Large messages whose bodies come after their headers go round too, from
+# either format.
+big = 'x' * 100000
+
+for sender, others in ((bob, (carol, alice)), (alice, (bob, carol))):
+    sender.send_split('MSG', {'From': 'split'}, big)
+    for member in others:
+        _, verb, headers, body = member.recv()
+        assert (verb, headers['From'], body) == ('MSG', 'split', big)
+        member.echo(headers, body)
+    sender.expect_nothing()
+
+# Now say bye!
+for member in (alice, bob, carol):
+    member.send('BYE', {})
+
+print "Passed."
@@ -59,7 +59,7 @@ for i, sck in enumerate(sockets):
 
     # The first time around, grab the message ID.
     if not msg_id:
-        msg_id = resp[37:47]
+        msg_id = resp.split('Message-ID: ', 1)[1].split('\r\n', 1)[0]
 
     print msg_id
     print (msg % msg_id)
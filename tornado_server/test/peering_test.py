@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+test/peering_test.py
+~~~~~~~~~~~~~~~~~~~~
+
+Checks that a conga can span several linked servers. Starts three servers
+on localhost against a scratch copy of the database, each linked to the
+other two, and spreads one conga across them: two members on the first
+server, one speaking binary frames on the second, and one on the third.
+Messages from the first and third servers must go through every member in
+turn and stop at their senders, and a broadcast must reach everyone. Once
+the third server's member leaves, messages must go round the rest.
+
+Run from anywhere: the script finds the server and the database itself.
+"""
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, '..', 'tornado_main.py')
+DATABASE = os.path.join(HERE, '..', '..', 'server', 'piconga.db')
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+ports = [8901, 8902, 8903]
+peer_ports = [9901, 9902, 9903]
+
+
+class Member(object):
+    """
+    One member of the conga, connected to one of the servers.
+    """
+    def __init__(self, member_id, port, protocol='text'):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if len(headers) > 1:
+            verb, headers, _ = self.recv()
+            assert verb == 'HELLO'
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def forward(self, expected):
+        """
+        Receive a message, check its body, and send it back to go on round.
+        Returns its headers.
+        """
+        verb, headers, body = self.recv()
+        assert verb == 'MSG', verb
+        assert body == expected, body
+
+        self.send('MSG', dict((name, headers.get(name)) for name in (
+            'From', 'Message-ID', 'Origin-ID'
+        )), body)
+        return headers
+
+    def quiet(self):
+        """
+        Check that nothing else arrives.
+        """
+        self.sck.settimeout(0.5)
+        try:
+            self.sck.recv(4096)
+        except socket.timeout:
+            pass
+        else:
+            raise AssertionError("Unexpected message.")
+        finally:
+            self.sck.settimeout(2)
+
+
+def seed(db_path):
+    """
+    Put members 11 to 14 in conga 1 in the scratch database.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM conga_congamember')
+    for i in (11, 12, 13, 14):
+        cursor.execute('INSERT INTO conga_congamember VALUES (1, ?, ?, ?)',
+                       (i, i, i))
+    conn.commit()
+    conn.close()
+
+
+def start(node, db_path):
+    peers = ','.join(
+        '%d=%s:%d' % (other + 1, target, peer_ports[other])
+        for other in range(len(ports)) if other != node
+    )
+
+    return subprocess.Popen(
+        [sys.executable, SERVER, '--port=%d' % ports[node],
+         '--sqlite_path=%s' % db_path, '--logging=error',
+         '--node_id=%d' % (node + 1), '--peers=%s' % peers,
+         '--peer_port=%d' % peer_ports[node]]
+    )
+
+
+def wait_for_port(port):
+    for _ in range(50):
+        try:
+            socket.create_connection((target, port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start.")
+
+
+def node_of(headers):
+    return int(headers['Message-ID']) >> 48
+
+
+scratch = tempfile.mkdtemp()
+db_path = os.path.join(scratch, 'piconga.db')
+shutil.copy(DATABASE, db_path)
+seed(db_path)
+
+servers = [start(node, db_path) for node in range(len(ports))]
+
+try:
+    for port in ports:
+        wait_for_port(port)
+
+    # The conga runs through each server's members in turn.
+    alice = Member(11, ports[0])
+    carol = Member(13, ports[0])
+    bob = Member(12, ports[1], 'binary')
+    dave = Member(14, ports[2])
+    time.sleep(2)
+
+    alice.send('MSG', {'From': 'alice'}, 'From the first.')
+    headers = carol.forward('From the first.')
+    assert node_of(headers) == 1
+    bob.forward('From the first.')
+    dave.forward('From the first.')
+    alice.quiet()
+
+    dave.send('MSG', {'From': 'dave'}, 'From the third.')
+    headers = alice.forward('From the third.')
+    assert node_of(headers) == 3
+    carol.forward('From the third.')
+    bob.forward('From the third.')
+    dave.quiet()
+
+    # The other servers count as a single delivery of a broadcast.
+    bob.send('MSG', {'From': 'bob', 'Delivery': 'broadcast'}, 'To all.')
+    for member in (alice, carol, dave):
+        verb, headers, body = member.recv()
+        assert body == 'To all.', body
+        assert headers['Delivery'] == 'broadcast'
+    verb, headers, body = bob.recv()
+    assert headers['Delivered'] == '1', headers
+
+    # Without anyone on the third server, messages skip it.
+    dave.send('BYE', {})
+    dave.sck.close()
+    time.sleep(0.5)
+
+    bob.send('MSG', {'From': 'bob'}, 'From the second.')
+    alice.forward('From the second.')
+    carol.forward('From the second.')
+    bob.quiet()
+
+    for member in (alice, bob, carol):
+        member.send('BYE', {})
+finally:
+    for server in servers:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    shutil.rmtree(scratch)
+
+print "Passed."
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+test/postgres_pool_test.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Checks the pooled PostgreSQL database: that it keeps to its minimum and
+maximum number of connections, runs the HELLO and BYE queries as prepared
+statements, and replaces connections that have died.
+
+By default this runs against a fake DB-API module, so it needs no Postgres.
+Give it a database name to run the parts that make sense against a real
+server:
+
+    python postgres_pool_test.py [db_name [user [password [host]]]]
+"""
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from db import PostgresDatabase
+from db.queries import MEMBER_ROSTER, REMOVE_MEMBER
+
+
+class FakeDriver(object):
+    """
+    Just enough of psycopg2 for the database: connect, and the exceptions.
+    """
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class InterfaceError(Error):
+        pass
+
+    class ProgrammingError(Error):
+        pass
+
+    def __init__(self):
+        #: Every connection ever opened.
+        self.connections = []
+
+        #: The rows every query returns.
+        self.rows = [(1, 123), (2, 123)]
+
+        #: How long every query takes.
+        self.delay = 0
+
+    def connect(self, **kwargs):
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+
+class FakeConnection(object):
+    def __init__(self, driver):
+        self.driver = driver
+        self.alive = True
+        self.closed = False
+        self.prepared = set()
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self._check()
+        self.commits += 1
+
+    def rollback(self):
+        self._check()
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+    def _check(self):
+        if not self.alive:
+            raise FakeDriver.OperationalError("server closed the connection")
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, parameters=None):
+        self.conn._check()
+        self.conn.statements.append((sql, parameters))
+        verb, name = sql.split()[:2]
+
+        if verb == 'PREPARE':
+            self.conn.prepared.add(name)
+        elif verb == 'EXECUTE':
+            assert name in self.conn.prepared, name
+        elif verb == 'BROKEN':
+            raise FakeDriver.ProgrammingError("syntax error")
+
+        time.sleep(self.conn.driver.delay)
+
+    def fetchall(self):
+        return self.conn.driver.rows
+
+
+def fake_database(min_connections=1, max_connections=4, check_interval=30.0):
+    driver = FakeDriver()
+    db = PostgresDatabase()
+    db.driver = driver
+    db.min_connections = min_connections
+    db.max_connections = max_connections
+    db.check_interval = check_interval
+    db.connect('piconga')
+    return db, driver
+
+
+def test_minimum_connections_prepared():
+    db, driver = fake_database(min_connections=2)
+
+    assert len(driver.connections) == 2
+    for conn in driver.connections:
+        assert conn.prepared == set(['member_roster', 'remove_member'])
+        assert conn.commits == 1
+
+
+def test_hello_and_bye_use_prepared_statements():
+    db, driver = fake_database()
+    conn = driver.connections[0]
+
+    assert db.get(MEMBER_ROSTER, (5,)) == driver.rows
+    db.execute(REMOVE_MEMBER, (5,))
+
+    assert conn.statements[-2:] == [
+        ("EXECUTE member_roster (%s)", (5,)),
+        ("EXECUTE remove_member (%s)", (5,)),
+    ]
+
+
+def test_other_queries_pass_through():
+    db, driver = fake_database()
+    db.execute("UPDATE conga_conga SET name=%s", ('x',))
+
+    assert driver.connections[0].statements[-1] == (
+        "UPDATE conga_conga SET name=%s", ('x',)
+    )
+
+
+def test_never_exceeds_maximum():
+    db, driver = fake_database(max_connections=3)
+    driver.delay = 0.05
+
+    threads = [
+        threading.Thread(target=db.get, args=(MEMBER_ROSTER, (i,)))
+        for i in range(12)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(driver.connections) == 3, len(driver.connections)
+    assert len(db.connections) == 3
+
+
+def test_dead_connection_replaced_by_health_check():
+    db, driver = fake_database(check_interval=0)
+    driver.connections[0].alive = False
+
+    assert db.get(MEMBER_ROSTER, (5,)) == driver.rows
+    assert db.connections.reconnects == 1
+    assert driver.connections[0].closed
+    assert len(driver.connections) == 2
+
+
+def test_read_retried_when_connection_dies():
+    db, driver = fake_database()
+
+    # Passes its health check, then dies before the query.
+    original = FakeConnection.cursor
+    dying = driver.connections[0]
+
+    def cursor(self):
+        if self is dying:
+            self.alive = False
+        return original(self)
+
+    FakeConnection.cursor = cursor
+    try:
+        assert db.get(MEMBER_ROSTER, (5,)) == driver.rows
+    finally:
+        FakeConnection.cursor = original
+
+    assert dying.closed
+    assert len(db.connections) == 1
+
+
+def test_write_not_retried_when_connection_dies():
+    db, driver = fake_database()
+    driver.connections[0].alive = False
+
+    try:
+        db.execute(REMOVE_MEMBER, (5,))
+    except FakeDriver.OperationalError:
+        pass
+    else:
+        raise AssertionError("A write to a dead connection succeeded.")
+
+    # The next write gets a fresh connection.
+    db.execute(REMOVE_MEMBER, (5,))
+    assert len(driver.connections) == 2
+
+
+def test_failed_write_rolled_back():
+    db, driver = fake_database()
+    conn = driver.connections[0]
+
+    try:
+        db.execute_batch([(REMOVE_MEMBER, (5,)), ("BROKEN query", ())])
+    except FakeDriver.ProgrammingError:
+        pass
+
+    assert conn.rollbacks == 1
+    assert not conn.closed
+
+    # The connection went back in the pool.
+    db.execute(REMOVE_MEMBER, (6,))
+    assert len(driver.connections) == 1
+
+
+def run_fake():
+    tests = [(name, fn) for (name, fn) in sorted(globals().items())
+             if name.startswith('test_')]
+
+    for name, fn in tests:
+        fn()
+        print "%s passed." % name
+
+
+def run_real(args):
+    kwargs = dict(zip(('user', 'password', 'host'), args[1:]))
+    db = PostgresDatabase()
+    db.min_connections = 2
+    db.max_connections = 2
+    db.connect(args[0], **kwargs)
+
+    # Nobody has a negative ID, so these touch nothing.
+    assert db.get(MEMBER_ROSTER, (-1,)) == []
+    db.execute(REMOVE_MEMBER, (-1,))
+    db.execute_batch([(REMOVE_MEMBER, (-1,)), (REMOVE_MEMBER, (-2,))])
+    assert len(db.connections) == 2
+
+    db.close()
+    print "Real database passed."
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_real(sys.argv[1:])
+    else:
+        run_fake()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+test/replay_test.py
+~~~~~~~~~~~~~~~~~~~
+
+Checks that a participant who leaves a conga and rejoins can catch up on
+what they missed. Of three members, the second (in binary frames) leaves
+after seeing one message, and misses two more. On rejoining, they ask
+for everything after the message they saw, and then for everything since
+before it. The first member then asks for everything, and should be sent
+only the message they didn't send themselves.
+
+Run this from the test directory against a running server.
+"""
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+
+
+class Member(object):
+    """
+    One member of the conga.
+    """
+    def __init__(self, member_id, protocol):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, target_port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        if len(headers) > 1:
+            verb, headers, _ = self.recv()
+            assert verb == 'HELLO'
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def forward(self, headers, body):
+        self.send('MSG', dict((name, headers.get(name)) for name in (
+            'From', 'Message-ID', 'Origin-ID', 'Hops-Remaining'
+        )), body)
+
+    def replay(self, headers):
+        """
+        Ask to catch up, and return the bodies of the messages sent, along
+        with the headers of the REPLAY that follows them.
+        """
+        self.send('REPLAY', headers)
+        bodies = []
+
+        while True:
+            verb, headers, body = self.recv()
+            if verb == 'REPLAY':
+                return bodies, headers
+
+            assert verb == 'MSG'
+            assert headers['Delivery'] == 'broadcast'
+            bodies.append(body)
+
+
+def join(member_id):
+    cursor.execute('INSERT INTO conga_congamember VALUES (131, ?, ?, ?)',
+                   (member_id, member_id, member_id))
+    conn.commit()
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=131')
+for i in (91, 92, 93):
+    join(i)
+
+alice = Member(91, 'text')
+bob = Member(92, 'binary')
+carol = Member(93, 'text')
+time.sleep(0.5)
+start = time.time()
+
+# Everyone sees the first message.
+alice.send('MSG', {'From': 'alice'}, 'First.')
+verb, headers, body = bob.recv()
+assert body == 'First.'
+first_id = headers['Message-ID']
+bob.forward(headers, body)
+verb, headers, body = carol.recv()
+carol.forward(headers, body)
+
+# Bob leaves, which takes him out of the database too, and misses the next
+# two.
+bob.send('BYE', {})
+bob.sck.close()
+time.sleep(0.5)
+
+alice.send('MSG', {'From': 'alice'}, 'Second.')
+verb, headers, body = carol.recv()
+assert body == 'Second.'
+carol.forward(headers, body)
+
+carol.send('MSG', {'From': 'carol'}, 'Third.')
+verb, headers, body = alice.recv()
+assert body == 'Third.'
+alice.forward(headers, body)
+
+# Bob comes back, and catches up from the message he saw.
+join(92)
+bob = Member(92, 'binary')
+time.sleep(0.5)
+
+bodies, headers = bob.replay({'Message-ID': first_id})
+assert bodies == ['Second.', 'Third.'], bodies
+assert headers['Replayed'] == '2'
+assert 'Truncated' not in headers
+
+# Or from a time before it.
+bodies, headers = bob.replay({'Since': '%.6f' % start})
+assert bodies == ['First.', 'Second.', 'Third.'], bodies
+assert headers['Replayed'] == '3'
+
+# Nobody is sent their own messages.
+bodies, headers = alice.replay({'Since': '0'})
+assert bodies == ['Third.'], bodies
+
+# Now say bye!
+for member in (alice, bob, carol):
+    member.send('BYE', {})
+
+print "Passed."
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+test/resume_test.py
+~~~~~~~~~~~~~~~~~~~
+
+Checks that a participant whose connection drops can pick up their place
+with a resume token. Of three members, the first and second (in binary
+frames) ask for tokens, and the third doesn't. The second drops without a
+BYE, misses a message, and resumes on a new connection, to be sent the
+message they missed and pass it on. They drop again and come back without
+their token, which gives them a new place. The third connects again while
+still connected, and their new connection replaces the old one. Finally
+the first drops and doesn't come back, and is taken out of the conga once
+the grace period is up.
+
+Run this from the test directory against a server started with a short
+grace period:
+
+    python tornado_main.py --resume_grace=1
+"""
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'client'))
+
+from tornado_sendrcv import (TornadoSendRcv, encode_text_msg,
+                             encode_binary_msg)
+
+target = '127.0.0.1'
+target_port = 8888
+
+
+class Member(object):
+    """
+    One member of the conga.
+    """
+    def __init__(self, member_id, protocol, resume=False, token=None):
+        self.protocol = protocol
+        self.sck = socket.create_connection((target, target_port))
+        self.sck.settimeout(2)
+        self.parser = TornadoSendRcv(target, target_port)
+
+        headers = {'User-ID': member_id}
+        if protocol == 'binary':
+            headers['Protocol'] = 'binary'
+        if resume:
+            headers['Resume'] = 'yes'
+        if token:
+            headers['Resume-Token'] = token
+        self.sck.sendall(encode_text_msg('HELLO', headers))
+
+        self.hello = {}
+        if len(headers) > 1:
+            verb, self.hello, _ = self.recv()
+            assert verb == 'HELLO'
+            self.parser._protocol = protocol
+
+    def recv(self):
+        while True:
+            msg = self.parser._next_conga_msg()
+            if msg is not None:
+                return msg
+
+            chunk = self.sck.recv(4096)
+            assert chunk, "Connection closed."
+            self.parser._recv_buffer += chunk
+
+    def send(self, verb, headers, body=''):
+        if self.protocol == 'binary':
+            self.sck.sendall(encode_binary_msg(verb, headers, body))
+        else:
+            self.sck.sendall(encode_text_msg(verb, headers, body))
+
+    def forward(self, expected):
+        verb, headers, body = self.recv()
+        assert verb == 'MSG', verb
+        assert body == expected, body
+
+        self.send('MSG', dict((name, headers.get(name)) for name in (
+            'From', 'Message-ID', 'Origin-ID', 'Hops-Remaining'
+        )), body)
+
+
+def join(member_id):
+    cursor.execute('INSERT INTO conga_congamember VALUES (132, ?, ?, ?)',
+                   (member_id, member_id, member_id))
+    conn.commit()
+
+
+def members():
+    cursor.execute('SELECT COUNT(*) FROM conga_congamember '
+                   'WHERE conga_id=132')
+    return cursor.fetchone()[0]
+
+
+# First, add ourselves to the database.
+conn = sqlite3.connect('../../server/piconga.db')
+cursor = conn.cursor()
+cursor.execute('DELETE FROM conga_congamember WHERE conga_id=132')
+for i in (94, 95, 96):
+    join(i)
+
+alice = Member(94, 'text', resume=True)
+bob = Member(95, 'binary', resume=True)
+carol = Member(96, 'text')
+time.sleep(0.5)
+
+token = bob.hello['Resume-Token']
+assert token and token != alice.hello['Resume-Token']
+
+# Bob's connection drops, but he stays in the conga and the database.
+bob.sck.close()
+time.sleep(0.2)
+
+alice.send('MSG', {'From': 'alice'}, 'While you were out.')
+time.sleep(0.2)
+assert members() == 3
+
+# He comes back, and is sent what he missed.
+bob = Member(95, 'binary', token=token)
+assert bob.hello['Resumed'] == 'yes'
+assert bob.hello['Protocol'] == 'binary'
+assert bob.hello['Resume-Token'] == token
+
+bob.forward('While you were out.')
+carol.forward('While you were out.')
+
+# Without his token, he gets a new place.
+bob.sck.close()
+time.sleep(0.2)
+bob = Member(95, 'binary')
+assert 'Resumed' not in bob.hello
+time.sleep(0.2)
+
+carol.send('MSG', {'From': 'carol'}, 'Welcome back.')
+alice.forward('Welcome back.')
+bob.forward('Welcome back.')
+
+# Carol connects again while her old connection is still up, as a client
+# does when its connection died without the server hearing. The new
+# connection takes her place, and she stays in the database.
+old_carol = carol
+carol = Member(96, 'text')
+assert old_carol.sck.recv(4096) == ''
+assert members() == 3
+
+alice.send('MSG', {'From': 'alice'}, 'Still there?')
+bob.forward('Still there?')
+carol.forward('Still there?')
+
+# Alice drops and never comes back. Once the grace period is up, she's out
+# of the conga and the database. The watchdog takes a tick or two to
+# notice.
+alice.sck.close()
+time.sleep(0.5)
+assert members() == 3
+
+deadline = time.time() + 5
+while members() == 3 and time.time() < deadline:
+    time.sleep(0.2)
+assert members() == 2
+
+bob.send('MSG', {'From': 'bob'}, 'Just us.')
+carol.forward('Just us.')
+
+# Nor is her token any good now. She isn't a member any more, so she's
+# turned away.
+sck = socket.create_connection((target, target_port))
+sck.settimeout(2)
+sck.sendall(encode_text_msg('HELLO', {
+    'User-ID': 94, 'Resume-Token': alice.hello['Resume-Token']
+}))
+assert sck.recv(4096) == ''
+
+# Now say bye!
+for member in (bob, carol):
+    member.send('BYE', {})
+
+print "Passed."
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+test/sharding_test.py
+~~~~~~~~~~~~~~~~~~~~~
+
+Checks that connections survive being passed between processes with the
+installed Tornado, whose IOStream internals sharding relies on. Over IPv4
+and, where the machine has it, IPv6:
+
+- a stream that has read more than it handed out is detached and attached
+  again, and must hand out the rest, then read on from the socket;
+- a stream writing to a peer that doesn't read must report exactly what it
+  hasn't yet sent.
+
+Then two worker processes hand each other more connections at once than
+their sockets can hold, which must neither deadlock nor lose any data.
+
+Run from anywhere: no server is needed.
+"""
+import os
+import signal
+import socket
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream
+
+from sharding import (ShardRouter, attach_stream, check_tornado,
+                      detach_stream, unsent_data)
+
+
+def connect(family, address, receive_buffer=None):
+    """
+    Returns the two ends of a TCP connection over the given family, the
+    client's with the given receive buffer size.
+    """
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.bind((address, 0))
+    listener.listen(1)
+
+    client = socket.socket(family, socket.SOCK_STREAM)
+    if receive_buffer is not None:
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                          receive_buffer)
+    client.connect(listener.getsockname()[:2])
+    server, _ = listener.accept()
+    listener.close()
+    return server, client
+
+
+def wait(stream, method, *args):
+    """
+    Call a stream's read method, and run the IOLoop until it has answered.
+    """
+    results = []
+
+    def done(data):
+        results.append(data)
+        IOLoop.current().stop()
+
+    getattr(stream, method)(*args, callback=done)
+    if not results:
+        IOLoop.current().start()
+    return results[0]
+
+
+def round_trip(family, address):
+    server, client = connect(family, address)
+    client.sendall(b'HELLO\r\n\r\nleft over')
+
+    stream = IOStream(server)
+    assert wait(stream, 'read_until', b'\r\n\r\n') == b'HELLO\r\n\r\n'
+
+    fd, passed_family, buffered = detach_stream(stream)
+    assert passed_family == family
+    assert buffered == b'left over', buffered
+
+    stream = attach_stream(fd, passed_family, buffered)
+    assert stream.socket.family == family
+    assert wait(stream, 'read_bytes', 9) == b'left over'
+
+    client.sendall(b'more')
+    assert wait(stream, 'read_bytes', 4) == b'more'
+
+    stream.close()
+    client.close()
+
+
+def unsent(family, address):
+    server, client = connect(family, address, 4096)
+    data = os.urandom(4 * 1024 * 1024)
+
+    stream = IOStream(server)
+    stream.write(data)
+
+    loop = IOLoop.current()
+    loop.call_later(0.2, loop.stop)
+    loop.start()
+
+    left = unsent_data(stream)
+    assert 0 < len(left) < len(data)
+
+    # Whatever the kernel took, the peer can read, and the rest is what's
+    # left.
+    stream.close()
+    received = []
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        received.append(chunk)
+    client.close()
+
+    assert b''.join(received) + left == data
+
+
+def cross_hand_off(count=20, size=1024 * 1024):
+    """
+    Fork a second worker, and have each worker hand the other count
+    connections, each with size bytes buffered. Returns in the parent only.
+    """
+    router = ShardRouter(2)
+    worker_id = 0 if os.fork() else 1
+    other = 1 - worker_id
+
+    # A conga the other worker owns.
+    conga_id = next(c for c in xrange(1, 100) if router.owner(c) == other)
+
+    received = []
+
+    def adopt(stream, hello_data, conga):
+        assert hello_data == b'HELLO from %d' % other, hello_data
+        assert router.owns(conga)
+
+        def read(data):
+            received.append(data == str(other) * size)
+            stream.close()
+
+        stream.read_bytes(size, read)
+
+    def check():
+        if len(received) == count and not router._outgoing[other]:
+            loop.stop()
+
+    router.bind(worker_id, adopt)
+    loop = IOLoop.current()
+
+    # Blocking on a full socket would hang either worker for good.
+    signal.alarm(20)
+
+    for _ in xrange(count):
+        ends = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        stream = attach_stream(os.dup(ends[0].fileno()), socket.AF_UNIX,
+                               str(worker_id) * size)
+        router.hand_off(stream, b'HELLO from %d' % worker_id, conga_id)
+        ends[0].close()
+        ends[1].close()
+
+    PeriodicCallback(check, 10).start()
+    loop.start()
+    signal.alarm(0)
+
+    assert received == [True] * count, received
+    if worker_id == 1:
+        os._exit(0)
+
+    _, status = os.wait()
+    assert status == 0, status
+
+
+# Fork before anything else creates the IOLoop.
+cross_hand_off()
+
+check_tornado()
+
+families = [(socket.AF_INET, '127.0.0.1')]
+if socket.has_ipv6:
+    try:
+        connect(socket.AF_INET6, '::1')
+        families.append((socket.AF_INET6, '::1'))
+    except socket.error:
+        print "No IPv6 here: only checking IPv4."
+
+for family, address in families:
+    round_trip(family, address)
+    unsent(family, address)
+
+print "Passed."
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+test/slow_consumer_test.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Checks that a participant who stops reading can't make the server buffer
+without bound. For each slow consumer policy, starts a server against a
+scratch copy of the database, joins a conga of two, and has one member blast
+messages at the other, who never reads. Reports how much the server grew,
+and checks each policy did what it says. Then checks that under each
+policy a single message bigger than the high water mark still reaches a
+participant with nothing waiting.
+
+Run from anywhere: the script finds the server and the database itself.
+"""
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, '..', 'tornado_main.py')
+DATABASE = os.path.join(HERE, '..', '..', 'server', 'piconga.db')
+
+PORT = 8897
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+MESSAGES = 4000
+BODY = b'x' * (16 * 1024)
+
+hello = 'HELLO\r\nContent-Length: 0\r\nUser-ID: %s\r\n\r\n'
+bye = 'BYE\r\nContent-Length: 0\r\n\r\n'
+msg = 'MSG\r\nContent-Length: %d\r\n\r\n%s' % (len(BODY), BODY)
+
+
+def seed(db_path):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM conga_congamember')
+    cursor.execute('INSERT INTO conga_congamember VALUES (900, 1, 1, 1)')
+    cursor.execute('INSERT INTO conga_congamember VALUES (900, 2, 2, 2)')
+    conn.commit()
+    conn.close()
+
+
+def rss(pid):
+    """
+    The resident set size of a process, in bytes.
+    """
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def wait_for_port():
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', PORT)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start.")
+
+
+def drain(sck, timeout):
+    """
+    Read from a socket until it closes or goes quiet. Returns the number of
+    bytes read, and whether it closed.
+    """
+    sck.settimeout(timeout)
+    received = 0
+
+    try:
+        while True:
+            data = sck.recv(65536)
+            if not data:
+                return received, True
+            received += len(data)
+    except socket.timeout:
+        return received, False
+
+
+def start(policy, high_water, db_path):
+    seed(db_path)
+
+    server = subprocess.Popen(
+        [sys.executable, SERVER, '--port=%d' % PORT,
+         '--sqlite_path=%s' % db_path, '--logging=error',
+         '--outbound_high_water=%d' % high_water,
+         '--outbound_low_water=%d' % LOW_WATER,
+         '--slow_consumer=%s' % policy],
+    )
+    wait_for_port()
+    return server
+
+
+def run(policy, high_water, db_path):
+    server = start(policy, high_water, db_path)
+
+    try:
+
+        sender = socket.create_connection(('127.0.0.1', PORT))
+        sender.sendall(hello % 1)
+
+        # The slow consumer has as small a receive buffer as we can get, so
+        # that the kernel doesn't soak up the backlog for the server.
+        slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.connect(('127.0.0.1', PORT))
+        slow.sendall(hello % 2)
+        time.sleep(0.5)
+
+        before = rss(server.pid)
+        for _ in xrange(MESSAGES):
+            sender.sendall(msg)
+        time.sleep(1)
+        growth = rss(server.pid) - before
+
+        received, closed = drain(slow, 1)
+
+        # The sender must still be welcome, whatever happened to the slow
+        # consumer.
+        sender.sendall(bye)
+        _, sender_closed = drain(sender, 1)
+        assert sender_closed
+
+        return growth, received, closed
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def oversized(policy, db_path):
+    """
+    Send one message bigger than the high water mark to a participant with
+    nothing waiting. Returns the bytes they received, and whether they were
+    disconnected.
+    """
+    server = start(policy, HIGH_WATER, db_path)
+
+    try:
+        sender = socket.create_connection(('127.0.0.1', PORT))
+        sender.sendall(hello % 1)
+        receiver = socket.create_connection(('127.0.0.1', PORT))
+        receiver.sendall(hello % 2)
+        time.sleep(0.5)
+
+        body = b'x' * (HIGH_WATER + 1)
+        sender.sendall('MSG\r\nContent-Length: %d\r\n\r\n%s' % (
+            len(body), body
+        ))
+        received, closed = drain(receiver, 1)
+
+        sender.sendall(bye)
+        return received, closed
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+if __name__ == '__main__':
+    scratch = tempfile.mkdtemp()
+    db_path = os.path.join(scratch, 'piconga.db')
+    shutil.copy(DATABASE, db_path)
+    sent = MESSAGES * len(msg)
+
+    try:
+        print "Sending %.1fMB to a participant who doesn't read." % (
+            sent / 1048576.0
+        )
+        print "%12s %14s %14s %8s" % (
+            "policy", "growth (MB)", "received (MB)", "closed"
+        )
+
+        results = {}
+        for policy, high_water in (('unbounded', sent * 2),
+                                   ('drop_oldest', HIGH_WATER),
+                                   ('drop_new', HIGH_WATER),
+                                   ('disconnect', HIGH_WATER)):
+            name = policy
+            if policy == 'unbounded':
+                policy = 'drop_new'
+
+            growth, received, closed = run(policy, high_water, db_path)
+            results[name] = (growth, received, closed)
+            print "%12s %14.1f %14.1f %8s" % (
+                name, growth / 1048576.0, received / 1048576.0, closed
+            )
+
+        big = {}
+        for policy in ('drop_oldest', 'drop_new', 'disconnect'):
+            big[policy] = oversized(policy, db_path)
+    finally:
+        shutil.rmtree(scratch)
+
+    # With no limit, the server holds on to everything.
+    assert results['unbounded'][0] > sent / 2
+
+    for policy in ('drop_oldest', 'drop_new', 'disconnect'):
+        growth, received, closed = results[policy]
+        assert growth < sent / 4, policy
+
+        if policy == 'disconnect':
+            assert closed
+        else:
+            # Still connected, and got some but not all of the messages.
+            assert not closed
+            assert 0 < received < sent, policy
+
+    # However big a message is, someone keeping up gets it.
+    for policy, (received, closed) in big.items():
+        assert received > HIGH_WATER, policy
+        assert not closed, policy
+
+    print "Passed."
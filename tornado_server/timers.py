@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.timers
+~~~~~~~~~~~~~~~~~~~~~
+
+Provides cheap timekeeping for the Tornado server. The TimingWheel here lets
+us track very large numbers of deadlines with constant-time scheduling and
+cancellation, at the cost of only firing to the nearest tick.
+"""
+import ctypes
+import ctypes.util
+import math
+import os
+import time
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _build_monotonic():
+    """
+    Python 2 has no monotonic clock in the standard library, so go and get
+    clock_gettime ourselves if we can. If we can't, fall back to wall time.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+
+#: Returns the current time in seconds from a clock that never goes
+#: backwards. Only differences between readings are meaningful.
+monotonic = _build_monotonic()
+
+
+class TimingWheel(object):
+    """
+    A hashed timing wheel. Each key is scheduled to expire at some tick in
+    the future, and is stored in the slot for that tick. Advancing the wheel
+    visits only the slots for the ticks that have passed, so the cost of
+    keeping time does not depend on how many keys are scheduled.
+
+    Deadlines further away than one turn of the wheel are fine: they stay in
+    their slot until the wheel comes round to them on the right turn.
+    """
+    def __init__(self, resolution=1.0, slots=64, now=None):
+        #: The length of a single tick, in seconds.
+        self.resolution = float(resolution)
+
+        #: The slots of the wheel. Each is a dict of key to expiry tick.
+        self._slots = [{} for _ in range(slots)]
+
+        #: A map of every scheduled key to its expiry tick.
+        self._deadlines = {}
+
+        #: The last tick the wheel was advanced to.
+        self._tick = self._tick_for(monotonic() if now is None else now)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, delay, now=None):
+        """
+        Schedule key to expire after delay seconds. If the key is already
+        scheduled it is moved to the new deadline.
+        """
+        if now is None:
+            now = monotonic()
+
+        self.cancel(key)
+
+        # Round up, so that keys never expire early.
+        tick = int(math.ceil((now + delay) / self.resolution))
+        tick = max(tick, self._tick + 1)
+        self._slots[tick % len(self._slots)][key] = tick
+        self._deadlines[key] = tick
+
+    def remaining(self, key, now=None):
+        """
+        Returns the seconds until key expires, to the nearest tick, or None
+        if it isn't scheduled.
+        """
+        tick = self._deadlines.get(key)
+        if tick is None:
+            return None
+
+        if now is None:
+            now = monotonic()
+        return max(0.0, tick * self.resolution - now)
+
+    def cancel(self, key):
+        """
+        Stop tracking key. Does nothing if the key was not scheduled.
+        """
+        tick = self._deadlines.pop(key, None)
+
+        if tick is not None:
+            del self._slots[tick % len(self._slots)][key]
+
+    def advance(self, now=None):
+        """
+        Move the wheel forward to the current time. Returns a list of every
+        key whose deadline has passed, which are no longer tracked.
+        """
+        if now is None:
+            now = monotonic()
+
+        target = self._tick_for(now)
+        if target <= self._tick:
+            return []
+
+        expired = []
+        slot_count = len(self._slots)
+        steps = min(target - self._tick, slot_count)
+
+        for step in range(1, steps + 1):
+            slot = self._slots[(self._tick + step) % slot_count]
+
+            for key, tick in slot.items():
+                if tick <= target:
+                    expired.append(key)
+                    del slot[key]
+                    del self._deadlines[key]
+
+        self._tick = target
+        return expired
+
+    def _tick_for(self, when):
+        return int(when / self.resolution)
@@ -21,11 +21,22 @@ To this end, we are using Tornado to build a very simple TCP proxy.
 """
 from tornado.tcpserver import TCPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
 import tornado.options
 from tornado.options import options
 import signal
-from participant import Participant
+from conga import Conga, congas
+from participant import Participant, SLOW_CONSUMER_POLICIES
+from sharding import ShardRouter, fork_workers
 from db import SqliteDatabase, PostgresDatabase
+from db.base import BaseDatabase
+from membership import MembershipCache
+from restart import Handover, take_over
+from peering import Peering, parse_peers
+from watchdog import watchdog
+import eventlog
+import metrics
 
 
 # We need to define our command line options.
@@ -39,6 +50,114 @@ tornado.options.define("pghost", default="",
                        help="The host for the Postgres database.")
 tornado.options.define("pgport", default="",
                        help="The port for the Postgres database.")
+tornado.options.define("pg_min_connections", default=1, type=int,
+                       help="The fewest Postgres connections to keep open.")
+tornado.options.define("pg_max_connections", default=4, type=int,
+                       help="The most Postgres connections to open at once.")
+tornado.options.define("port", default=8888, type=int,
+                       help="The port to listen on.")
+tornado.options.define("sqlite_path", default="server/piconga.db",
+                       help="The path to the Sqlite database.")
+tornado.options.define("workers", default=1, type=int,
+                       help="The number of worker processes. Each conga is "
+                            "owned by a single worker. 0 starts one worker "
+                            "per CPU.")
+tornado.options.define("db_threads", default=4, type=int,
+                       help="The number of threads running database "
+                            "queries.")
+tornado.options.define("outbound_high_water", default=1024 * 1024, type=int,
+                       help="The most bytes to buffer for a participant.")
+tornado.options.define("outbound_low_water", default=64 * 1024, type=int,
+                       help="The most bytes to hand a participant's socket "
+                            "at once. Beyond this, messages wait where they "
+                            "can still be dropped.")
+tornado.options.define("slow_consumer", default="drop_oldest",
+                       help="What to do when a participant would go over "
+                            "the high water mark: %s." %
+                            ", ".join(SLOW_CONSUMER_POLICIES))
+tornado.options.define("write_behind_ms", default=0, type=int,
+                       help="Milliseconds to hold back database writes so "
+                            "they can be committed together. 0 commits them "
+                            "once per IOLoop iteration.")
+tornado.options.define("write_behind_limit", default=100, type=int,
+                       help="The most database writes to hold back at once, "
+                            "and so the most that can be lost in a crash.")
+tornado.options.define("membership_ttl", default=30.0, type=float,
+                       help="Seconds to trust a cached conga membership.")
+tornado.options.define("membership_cache_size", default=100000, type=int,
+                       help="The most conga memberships to cache.")
+tornado.options.define("stateless_loops", default=False, type=bool,
+                       help="Stop looping messages using the Origin-ID and "
+                            "Hops-Remaining headers rather than a table of "
+                            "outstanding messages. Requires clients that "
+                            "echo those headers.")
+tornado.options.define("message_ttl", default=60.0, type=float,
+                       help="Seconds to remember a message that has not "
+                            "returned to its sender.")
+tornado.options.define("max_outstanding", default=10000, type=int,
+                       help="The most messages to remember per conga.")
+tornado.options.define("trace_latency", default=True, type=bool,
+                       help="Time messages on their way round each conga. "
+                            "Not available with --stateless_loops.")
+tornado.options.define("replay_messages", default=100, type=int,
+                       help="The most recent messages to keep in each conga "
+                            "for participants catching up after rejoining. "
+                            "0 keeps none.")
+tornado.options.define("replay_bytes", default=64 * 1024, type=int,
+                       help="The most bytes of recent messages to keep in "
+                            "each conga.")
+tornado.options.define("metrics_port", default=0, type=int,
+                       help="The port to serve metrics on over HTTP, at "
+                            "/metrics for Prometheus and /metrics.json. Each "
+                            "worker adds its worker ID to the port. 0 turns "
+                            "the metrics off.")
+tornado.options.define("metrics_address", default="127.0.0.1",
+                       help="The address to serve metrics on.")
+tornado.options.define("handoff_path", default="",
+                       help="A Unix socket on which to wait for a new server "
+                            "process to hand every connection over to. A "
+                            "server started with the same path takes over "
+                            "from the one running. Needs --workers=1.")
+tornado.options.define("snapshot_path", default="server/piconga.snapshot",
+                       help="Where to write the snapshot of every conga "
+                            "when handing over to a new process.")
+tornado.options.define("handshake_timeout", default=10.0, type=float,
+                       help="Seconds a new connection has to join a conga "
+                            "before it is closed. 0 for no limit.")
+tornado.options.define("idle_timeout", default=30.0, type=float,
+                       help="Seconds a participant who asked for heartbeats "
+                            "can be quiet before being sent a PING. 0 turns "
+                            "heartbeats off.")
+tornado.options.define("ping_timeout", default=10.0, type=float,
+                       help="Seconds a participant has to answer a PING "
+                            "before being taken out of their conga.")
+tornado.options.define("resume_grace", default=30.0, type=float,
+                       help="Seconds to hold the place of a participant who "
+                            "asked for a resume token after their connection "
+                            "drops, for them to pick up again. 0 turns "
+                            "resume tokens off.")
+tornado.options.define("log_json", default=False, type=bool,
+                       help="Write the log as JSON lines, one per record.")
+tornado.options.define("log_sample", default="",
+                       help="How many records of each event type to log one "
+                            "of, as in join=10,stop_loop=100.")
+tornado.options.define("log_rate_cap", default=0, type=int,
+                       help="The most records of each event type to log a "
+                            "second. 0 for no limit.")
+tornado.options.define("log_async", default=False, type=bool,
+                       help="Write the log from a background thread, so "
+                            "that connections never wait on a disk. This "
+                            "costs more per record than writing it "
+                            "directly, unless the disk is slow.")
+tornado.options.define("node_id", default=0, type=int,
+                       help="This server's ID among its peers, from 1. "
+                            "Needed with --peers.")
+tornado.options.define("peers", default="",
+                       help="The other servers that congas can span, as in "
+                            "2=10.0.0.2:9000,3=10.0.0.3:9000, each with the "
+                            "address of its --peer_port. Needs --workers=1.")
+tornado.options.define("peer_port", default=0, type=int,
+                       help="The port to listen on for links from peers.")
 
 
 def handle_signal(sig, frame):
@@ -56,9 +175,14 @@ class TCPProxy(TCPServer):
     """
     db = None
 
-    def __init__(self, use_pg, db_path='', db_kwargs={}, *args, **kwargs):
+    def __init__(self, use_pg, db_path='', db_kwargs={}, shard=None,
+                 membership_ttl=30.0, membership_cache_size=100000, *args,
+                 **kwargs):
         super(TCPProxy, self).__init__(*args, **kwargs)
 
+        #: The ShardRouter shared between workers, if there's more than one.
+        self.shard = shard
+
         if use_pg:
             self.db = PostgresDatabase()
             self.db.connect(**db_kwargs)
@@ -66,15 +190,37 @@ class TCPProxy(TCPServer):
             self.db = SqliteDatabase()
             self.db.connect(db_path)
 
+        #: The cache of which conga each member belongs to.
+        self.members = MembershipCache(self.db, membership_ttl,
+                                       membership_cache_size)
+
     def handle_stream(self, stream, address):
         """
         When a new incoming connection is found, this function is called. Wrap
         the incoming connection in a Participant, then wait until it sends some
         data.
         """
-        r = Participant(stream, self.db)
+        r = Participant(stream, self)
         r.wait_for_headers()
 
+    def adopt_stream(self, stream, hello_data, conga_id):
+        """
+        When another worker hands us a connection for a conga we own, this
+        function is called. Wrap the connection in a Participant, and finish
+        bringing it up.
+        """
+        r = Participant(stream, self)
+        r.adopt(hello_data, conga_id)
+
+    def resume_stream(self, stream, state, conga_id, unsent):
+        """
+        When taking over from an old server process, this function is called
+        for each of its participants. Wrap the connection in a Participant,
+        and put them back in their conga.
+        """
+        r = Participant(stream, self)
+        r.resume(state, conga_id, unsent)
+
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, handle_signal)
@@ -82,6 +228,31 @@ if __name__ == '__main__':
 
     tornado.options.parse_command_line()
 
+    if options.slow_consumer not in SLOW_CONSUMER_POLICIES:
+        raise tornado.options.Error(
+            "--slow_consumer must be one of %s" %
+            ", ".join(SLOW_CONSUMER_POLICIES)
+        )
+
+    Conga.stateless_loops = options.stateless_loops
+    Conga.message_ttl = options.message_ttl
+    Conga.max_outstanding = options.max_outstanding
+    Conga.trace_latency = options.trace_latency
+    Conga.replay_messages = options.replay_messages
+    Conga.replay_bytes = options.replay_bytes
+    Participant.high_water = options.outbound_high_water
+    Participant.low_water = options.outbound_low_water
+    Participant.slow_consumer_policy = options.slow_consumer
+    Participant.handshake_timeout = options.handshake_timeout
+    Participant.idle_timeout = options.idle_timeout
+    Participant.ping_timeout = options.ping_timeout
+    Participant.resume_grace = options.resume_grace
+    BaseDatabase.pool_size = options.db_threads
+    BaseDatabase.write_behind_ms = options.write_behind_ms
+    BaseDatabase.write_behind_limit = options.write_behind_limit
+    PostgresDatabase.min_connections = options.pg_min_connections
+    PostgresDatabase.max_connections = options.pg_max_connections
+
     # Work out whether we're going to use a Postgres DB or the Sqlite one.
     opts = {'db_name': options.pgname, 'user': options.pguser,
             'password': options.pgpass, 'host': options.pghost,
@@ -89,12 +260,77 @@ if __name__ == '__main__':
 
     use_pg = any(opts.values())
 
+    if options.handoff_path and options.workers != 1:
+        raise tornado.options.Error("--handoff_path needs --workers=1")
+
+    peering = None
+    if options.peers:
+        if options.node_id < 1 or not options.peer_port:
+            raise tornado.options.Error(
+                "--peers needs --node_id and --peer_port"
+            )
+        if options.workers != 1 or options.stateless_loops or \
+                options.handoff_path:
+            raise tornado.options.Error(
+                "--peers needs --workers=1, and can't be used with "
+                "--stateless_loops or --handoff_path"
+            )
+
+        peering = Peering(options.node_id, parse_peers(options.peers))
+        Conga.node_id = options.node_id
+        Conga.peering = peering
+
     if use_pg:
         # Fixup the keyword arguments dictionary.
         opts = {key: val for (key, val) in opts.items() if val}
 
-    proxy = TCPProxy(use_pg, db_path='server/piconga.db', db_kwargs=opts)
-    proxy.listen(8888)
+    if options.workers == 1:
+        worker_id = 0
+        proxy = TCPProxy(use_pg, db_path=options.sqlite_path, db_kwargs=opts,
+                         membership_ttl=options.membership_ttl,
+                         membership_cache_size=options.membership_cache_size)
+
+        if not (options.handoff_path and
+                take_over(options.handoff_path, options.snapshot_path,
+                          proxy)):
+            proxy.listen(options.port)
+    else:
+        # Bind before forking, so that every worker accepts connections from
+        # the same socket. Each worker then needs its own DB connection.
+        sockets = bind_sockets(options.port)
+        shard = ShardRouter(options.workers or cpu_count())
+        worker_id = fork_workers(shard.workers)
+
+        proxy = TCPProxy(use_pg, db_path=options.sqlite_path, db_kwargs=opts,
+                         shard=shard, membership_ttl=options.membership_ttl,
+                         membership_cache_size=options.membership_cache_size)
+        proxy.add_sockets(sockets)
+        shard.bind(worker_id, proxy.adopt_stream)
+
+    metrics_server = None
+    if options.metrics_port:
+        metrics_server = metrics.listen(options.metrics_port + worker_id,
+                                        proxy.members,
+                                        options.metrics_address)
+
+    if peering is not None:
+        peering.listen(options.peer_port)
+        peering.connect()
+
+    if options.handoff_path:
+        Handover(options.handoff_path, options.snapshot_path, proxy,
+                 metrics_server).listen()
+
+    eventlog.install(json_lines=options.log_json,
+                     rates=eventlog.parse_rates(options.log_sample),
+                     cap=options.log_rate_cap or None,
+                     background=options.log_async)
+
+    watchdog.start()
     IOLoop.instance().start()
 
+    proxy.members.log_stats()
+    for conga in congas():
+        conga.log_latency()
+    proxy.db.close()
     IOLoop.instance().close()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+tornado_server.watchdog
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Keeps the handshake and idle deadlines for every connection. Rather than
+giving each connection an IOLoop timeout of its own, every deadline lives on
+one TimingWheel, which a single PeriodicCallback advances once a tick. The
+IOLoop's timeout heap stays small however many connections there are, and
+moving a deadline is a couple of dictionary operations.
+"""
+import logging
+from tornado.ioloop import PeriodicCallback
+from timers import TimingWheel
+
+
+class Watchdog(object):
+    """
+    Calls timed_out() on each object scheduled with it once its deadline has
+    passed, to the nearest resolution seconds. Nothing fires until the
+    watchdog has been started.
+    """
+    #: The seconds between ticks of the wheel.
+    resolution = 1.0
+
+    def __init__(self):
+        #: The deadlines, keyed by the object to call when they pass.
+        self.wheel = TimingWheel(self.resolution, slots=64)
+
+        # The PeriodicCallback advancing the wheel, once started.
+        self._ticker = None
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def schedule(self, key, delay):
+        """
+        Call key.timed_out() after delay seconds, instead of at any deadline
+        it already has.
+        """
+        self.wheel.schedule(key, delay)
+
+    def cancel(self, key):
+        """
+        Forget about key. Does nothing if it has no deadline.
+        """
+        self.wheel.cancel(key)
+
+    def start(self):
+        """
+        Start ticking on the current IOLoop.
+        """
+        if self._ticker is None:
+            self._ticker = PeriodicCallback(self.tick,
+                                            self.resolution * 1000)
+            self._ticker.start()
+
+    def stop(self):
+        if self._ticker is not None:
+            self._ticker.stop()
+            self._ticker = None
+
+    def tick(self, now=None):
+        """
+        Advance the wheel, and call everything whose deadline has passed.
+        One failing doesn't stop the rest.
+        """
+        for key in self.wheel.advance(now):
+            try:
+                key.timed_out()
+            except Exception:
+                logging.exception("Watchdog callback for %r failed.", key)
+
+
+#: The watchdog for this process.
+watchdog = Watchdog()